@@ -0,0 +1,97 @@
+# Use the pwpd.yml conda environment
+#
+# Import-time benchmark for the pwpd module.
+#
+# Each repetition runs "import pwpd" in a fresh interpreter (with
+# python -X importtime) and records the wall time of the import.  The
+# median is compared against the startup budget below, and the script
+# also checks that none of the heavy, non-core packages were pulled in.
+# It exits with a non-zero status if either check fails, so it can be
+# used as a guard before committing changes to pwpd.py.
+#
+import sys
+import os
+import subprocess
+import numpy as np
+
+#==================
+#=== Parameters ===
+#==================
+#
+#--- Maximum allowed median time (in seconds) for "import pwpd"
+import_budget_s = 0.5
+#--- Number of fresh-interpreter imports to time
+Nrepeat = 7
+#--- Packages that must NOT be imported by "import pwpd"
+forbidden_modules = ['matplotlib', 'folium', 'geopandas', 'pandas',
+                     'scipy', 'pyproj']
+#--- Number of slowest imported modules to display
+Nslowest = 10
+
+#=================
+#=== Main code ===
+#=================
+#
+srcdir = os.path.dirname(os.path.abspath(__file__))
+
+def time_import():
+    """Import pwpd in a fresh interpreter, return total time (s) and the
+    per-module cumulative times (us) reported by -X importtime"""
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c",
+                           "import pwpd"],
+                          cwd=srcdir, capture_output=True, text=True)
+    if (proc.returncode != 0):
+        print("***Error: \"import pwpd\" failed:")
+        print(proc.stderr)
+        exit(1)
+    # lines look like "import time:   self [us] | cumulative | module"
+    cumulative = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:"):].split("|")
+        try:
+            cumulative[fields[2].strip()] = int(fields[1])
+        except ValueError:
+            # the header line
+            continue
+    return cumulative['pwpd']/1e6, cumulative
+
+def get_loaded_modules():
+    proc = subprocess.run([sys.executable, "-c",
+                           "import sys, pwpd; print(' '.join(sys.modules))"],
+                          cwd=srcdir, capture_output=True, text=True)
+    return set(proc.stdout.split())
+
+times = []
+for i in range(Nrepeat):
+    (t, cumulative) = time_import()
+    times.append(t)
+median_time = np.median(times)
+
+print("=" * 80)
+print(f"\"import pwpd\" over {Nrepeat:d} fresh interpreters:")
+print(f"\tmedian = {median_time:.3f} s, min = {np.min(times):.3f} s,"
+      + f" max = {np.max(times):.3f} s  (budget = {import_budget_s:.3f} s)")
+print(f"\nSlowest top-level imports (cumulative, last run):")
+toplevel = {m: t for (m, t) in cumulative.items()
+            if ('.' not in m) & (m != 'pwpd')}
+for m in sorted(toplevel, key=toplevel.get, reverse=True)[:Nslowest]:
+    print(f"\t{toplevel[m]/1e6:.3f} s\t{m:s}")
+
+loaded = get_loaded_modules()
+bad = [m for m in forbidden_modules if m in loaded]
+
+status = 0
+if (median_time > import_budget_s):
+    print(f"\n***Error: import time {median_time:.3f} s exceeds the budget"
+          + f" of {import_budget_s:.3f} s")
+    status = 1
+if bad:
+    print("\n***Error: \"import pwpd\" loaded non-core packages: "
+          + ", ".join(bad))
+    status = 1
+if (status == 0):
+    print("\nImport time is within budget.")
+print("=" * 80)
+exit(status)
@@ -0,0 +1,114 @@
+# Use the pwpd.yml conda environment
+#
+# Check of the hot-pixel cleaning (see pwpd_hotpixels.py) on a synthetic
+# GHS image (see pwpd_synthetic.py).
+#
+# A hot-pixel layer is made for the image, and each region of the
+# synthetic counties and countries is cleaned on each of the paths that
+# reduce a region:
+#
+#   single     pwpd.get_pop_pwpd_pwlogpd (one window)
+#   parallel   the same with pwpd.region_Nworkers set, so that every
+#              window is split into row strips reduced on a pool
+#   tiled      pwpd_schedule.get_tiled_pop_pwpd_pwlogpd (row strips, one
+#              at a time, as the split regions of a scheduled run)
+#
+# The script reports how many regions the cleaning changed and exits with
+# a non-zero status if the three paths do not agree.
+#
+#   python bench_pwpd-hotpixels.py
+#
+import os
+import sys
+import time
+import numpy as np
+import pwpd
+import pwpd_synthetic
+import pwpd_hotpixels
+import pwpd_schedule
+
+#==================
+#=== Parameters ===
+#==================
+#
+#--- Size (GPW pixels per side) of the synthetic image
+image_size = 1000
+#--- Number of regions in the synthetic layers
+Nregions = {'counties': 100, 'countries': 12}
+#--- Number of row strips of the tiled path, and of workers of the
+#    parallel path
+Ntiles = 4
+Nworkers = 2
+#--- Cleaning parameters (see pwpd_hotpixels.py)
+hotpixels_Ncheck = 100
+hotpixels_Nclean = 20
+hotpixels_maxNzero = 4
+#--- Directory for the synthetic data and the layer
+bench_dir = "../output/bench/"
+#--- Allowed relative difference between the paths
+tolerance = 1e-9
+
+#=================
+#=== Main code ===
+#=================
+#
+datadir = os.path.join(bench_dir, f"data_{image_size:d}")
+if not all([os.path.exists(f) for f in
+            pwpd_synthetic.get_synthetic_filepaths(datadir)]):
+    pwpd_synthetic.make_synthetic_images(datadir, image_size)
+pwpd_synthetic.set_synthetic_popimage_pars(datadir, 'GHS')
+pwpd_hotpixels.hotpixels_Ncheck = hotpixels_Ncheck
+pwpd_hotpixels.hotpixels_Nclean = hotpixels_Nclean
+pwpd_hotpixels.hotpixels_maxNzero = hotpixels_maxNzero
+layer_filepath = os.path.join(datadir, "hotpixels.npz")
+pwpd_hotpixels.make_hotpixel_layer(layer_filepath)
+
+def get_results(regions_t, path):
+    results = []
+    for geom in regions_t.geometry.values:
+        if (path == 'tiled'):
+            r = pwpd_schedule.get_tiled_pop_pwpd_pwlogpd(geom, Ntiles)
+        else:
+            r = pwpd.get_pop_pwpd_pwlogpd({'geometry': [geom]})
+        results.append([r[0], r[1], r[2], r[4], r[5]])
+    return np.array(results)
+
+def max_relative_difference(a, b):
+    return np.max(np.abs(a - b)/np.maximum(np.abs(a), 1.0))
+
+print("=" * 80)
+print(f"{'regions':>10s} {'path':>10s} {'wall s':>8s} {'changed':>8s}"
+      + f" {'max rel diff':>13s}")
+status = 0
+for (layer, N) in Nregions.items():
+    regions_t = pwpd.transform_shapefile(
+        pwpd_synthetic.make_synthetic_regions(layer, N, image_size))
+    pwpd_hotpixels.unload_hotpixel_layer()
+    uncleaned = get_results(regions_t, 'single')
+    pwpd_hotpixels.load_hotpixel_layer(layer_filepath)
+    reference = None
+    for path in ['single', 'parallel', 'tiled']:
+        if (path == 'parallel'):
+            # (split every region, however small)
+            (pwpd.region_Nworkers, region_min_pixels) = \
+                (Nworkers, pwpd_schedule.region_min_pixels)
+            pwpd_schedule.region_min_pixels = 0
+        t0 = time.perf_counter()
+        results = get_results(regions_t, path)
+        seconds = time.perf_counter() - t0
+        if (path == 'parallel'):
+            pwpd.region_Nworkers = None
+            pwpd_schedule.region_min_pixels = region_min_pixels
+        if reference is None:
+            reference = results
+        changed = np.count_nonzero(np.abs(results[:, 1] - uncleaned[:, 1])
+                                   > tolerance*uncleaned[:, 1])
+        diff = max_relative_difference(reference, results)
+        print(f"{layer:>10s} {path:>10s} {seconds:8.2f} {changed:8d}"
+              + f" {diff:13.2e}")
+        if (diff > tolerance):
+            print(f"***Error: the cleaned {path:s} results disagree with"
+                  + " the single-window results")
+            status = 1
+print("=" * 80)
+sys.exit(status)
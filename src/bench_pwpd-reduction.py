@@ -0,0 +1,136 @@
+# Use the pwpd.yml conda environment
+#
+# Benchmark of the per-region reduction (pop, PWPD, PWlogPD and the
+# population centroid) on synthetic population images.
+#
+# The fused, block-wise reduction in pwpd.py (pwpd.get_fused_sums, used
+# by pwpd.get_pwpd_from_count and pwpd.get_pwpd_from_count_and_density)
+# is compared with the previous implementation, kept below as the
+# reference: copy and clamp the image, flatten it, select the populated
+# pixels, take the sums, then a separate center_of_mass pass.  For each
+# image size the script reports the time per megapixel and the peak
+# number of bytes allocated (from tracemalloc, which numpy reports its
+# array allocations to) per megapixel, and checks that both give the
+# same results.
+#
+import sys
+import time
+import tracemalloc
+import numpy as np
+import pwpd
+
+#==================
+#=== Parameters ===
+#==================
+#
+#--- Image sizes (rows, cols) to benchmark
+image_shapes = [(1000, 1000), (4000, 4000), (8000, 8000)]
+#--- Image data type (GHS-POP and GPW rasters are float32/float64)
+image_dtype = np.float32
+#--- Fraction of pixels that are populated (the rest are 0 or no data)
+populated_fraction = 0.3
+#--- Number of timed repetitions (the fastest is reported)
+Nrepeat = 5
+
+#=================================
+#=== Reference implementation  ===
+#=================================
+#
+def reference_pwpd_from_count(img, Acell_in_kmsqd):
+    import scipy.ndimage as spndi
+    arr = np.array(img)
+    arr[arr < 0.0] = 0.0
+    farr = arr.flatten()
+    selected = (farr > 0)
+    farr = farr[selected]
+    totalpop = np.sum(farr)
+    pwd = np.sum(np.multiply(farr / Acell_in_kmsqd, farr)) / totalpop
+    pwlogpd = \
+        np.sum( np.multiply( np.log(farr/Acell_in_kmsqd), farr)) / totalpop
+    (pc_row, pc_col) = spndi.center_of_mass(arr)
+    return (totalpop, pwd, pwlogpd, pc_row, pc_col)
+
+def reference_pwpd_from_count_and_density(pcimg, pdimg):
+    import scipy.ndimage as spndi
+    pcarr = np.array(pcimg)
+    pdarr = np.array(pdimg)
+    pcarr[pcarr < 0.0] = 0.0
+    fpcarr = pcarr.flatten()
+    fpdarr = pdarr.flatten()
+    selected = (fpcarr > 0)
+    fpcarr = fpcarr[selected]
+    fpdarr = fpdarr[selected]
+    totalpop = np.sum(fpcarr)
+    pwd = np.sum(np.multiply(fpdarr, fpcarr)) / totalpop
+    pwlogpd = np.sum( np.multiply( np.log(fpdarr), fpcarr) ) / totalpop
+    (pc_row, pc_col) = spndi.center_of_mass(pcarr)
+    return (totalpop, pwd, pwlogpd, pc_row, pc_col)
+
+#=================
+#=== Main code ===
+#=================
+#
+def make_images(shape, seed=1):
+    """Synthetic population count image (lognormal populations, with
+    empty and no data pixels) and a matching density image"""
+    rng = np.random.default_rng(seed)
+    pc = rng.lognormal(2.0, 1.5, size=shape).astype(image_dtype)
+    pc[rng.random(shape) > populated_fraction] = 0.0
+    pc[:, :shape[1]//20] = -200.0
+    pd = (pc * rng.uniform(0.5, 2.0, size=shape)).astype(image_dtype)
+    return (pc, pd)
+
+def measure(func, *args):
+    """Fastest time (s) and peak bytes allocated by one call"""
+    times = []
+    for i in range(Nrepeat):
+        t0 = time.perf_counter()
+        result = func(*args)
+        times.append(time.perf_counter() - t0)
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    func(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return (min(times), peak, result)
+
+def max_relative_difference(r1, r2):
+    return max([abs(a - b)/max(abs(a), 1e-300) for (a, b) in zip(r1, r2)])
+
+pwpd.set_popimage_pars('GHS', '2015', '1km')
+Acell = pwpd.GHS_Acell_in_kmsqd
+
+print("=" * 80)
+print(f"{'image':>12s} {'method':>10s} {'ms/MP':>9s} {'MB alloc':>9s}"
+      + f" {'bytes/pix':>9s} {'speedup':>8s} {'max rel diff':>13s}")
+status = 0
+for shape in image_shapes:
+    (pc, pd) = make_images(shape)
+    MP = pc.size/1e6
+    cases = [('GHS',
+              lambda: reference_pwpd_from_count(pc, Acell),
+              lambda: pwpd.get_pwpd_from_count(pc)),
+             ('GPW',
+              lambda: reference_pwpd_from_count_and_density(pc, pd),
+              lambda: pwpd.get_fused_sums(pc, pdimg=pd))]
+    for (name, ref_func, new_func) in cases:
+        (t_ref, b_ref, r_ref) = measure(ref_func)
+        if (name == 'GHS'):
+            (t_new, b_new, r_new) = measure(new_func)
+        else:
+            (t_new, b_new, sums) = measure(new_func)
+            (S1, S2, SL, moments) = sums
+            r_new = (S1, S2/S1, SL/S1, moments[0]/S1, moments[1]/S1)
+        diff = max_relative_difference(r_ref, r_new)
+        label = f"{shape[0]:d}x{shape[1]:d}"
+        print(f"{label:>12s} {name + ' ref':>10s} {1e3*t_ref/MP:9.2f}"
+              + f" {b_ref/1e6:9.1f} {b_ref/pc.size:9.2f}")
+        print(f"{label:>12s} {name + ' fused':>10s} {1e3*t_new/MP:9.2f}"
+              + f" {b_new/1e6:9.1f} {b_new/pc.size:9.2f}"
+              + f" {t_ref/t_new:7.2f}x {diff:13.2e}")
+        if (diff > 1e-6):
+            print(f"***Error: the fused {name:s} reduction disagrees with"
+                  + " the reference")
+            status = 1
+print("=" * 80)
+sys.exit(status)
@@ -0,0 +1,275 @@
+# Use the pwpd.yml conda environment
+#
+# Benchmark suite on synthetic population images and region layers (see
+# pwpd_synthetic.py), so that performance can be measured without the
+# GHS-POP/GPW images and the shapefiles.
+#
+# For each image size and population image type, each stage below is run
+# in a fresh interpreter (so that its peak memory is its own):
+#
+#   windowed_subimage   pwpd.get_windowed_subimage for every county
+#   pwpd_from_count     the per-region reduction (get_pwpd_from_count or
+#                       get_pwpd_from_count_and_density) of every county
+#                       window, already read
+#   cleaned_pwpd        pwpd.get_cleaned_pwpd for the countries (GHS only)
+#   sorted_imarray      pwpd.get_sorted_imarray for the countries (GHS only)
+#   counties_loop       pwpd.get_pwpd_UScounties (the all-us-counties loop)
+#   healthregions_loop  the all-canada-health-regions loop
+#   countries_loop      the all-countries loop
+#
+# and the throughput (regions/s, megapixels/s of the windows read) and
+# peak resident memory are printed and appended, with the date, git
+# commit and package versions, to a JSON history file.  Each stage is
+# compared with its last recorded run, and the script exits with a
+# non-zero status if any stage got slower by more than the tolerance.
+#
+#   python bench_pwpd-suite.py                    (run the suite)
+#   python bench_pwpd-suite.py <stage> <GHS|GPW> <size>   (one stage)
+#
+import sys
+import os
+import io
+import json
+import time
+import datetime
+import platform
+import resource
+import contextlib
+import subprocess
+import numpy as np
+
+#==================
+#=== Parameters ===
+#==================
+#
+#--- Sizes (GPW pixels per side) of the synthetic images
+image_sizes = [1000, 3000]
+#--- Population image types
+popimage_types = ['GHS', 'GPW']
+#--- Number of regions in the synthetic layers
+Nregions = {'counties': 300, 'healthregions': 60, 'countries': 12}
+#--- Cleaning/sorting parameters (as in get_pwpd_country.py)
+clean_Nclean = 20
+clean_Ncheck = 100
+clean_maxNzero = 4
+clean_Nmaxpix = 10
+sort_Ntop = 100
+#--- Stages to run
+stages = ['windowed_subimage', 'pwpd_from_count', 'cleaned_pwpd',
+          'sorted_imarray', 'counties_loop', 'healthregions_loop',
+          'countries_loop']
+ghs_only_stages = ['cleaned_pwpd', 'sorted_imarray']
+#--- Directory for the synthetic data and output files
+bench_dir = "../output/bench/"
+#--- History of results
+history_filepath = "../output/bench_pwpd-history.json"
+#--- Allowed slowdown (fraction of regions/s) relative to the last run
+regression_tolerance = 0.25
+
+#==============
+#=== Stages ===
+#==============
+#
+def get_region_windows(layer_df):
+    """Each region of a layer, transformed to the image coordinates"""
+    import pwpd
+    return [pwpd.transform_shapefile(layer_df.iloc[[i]])
+            for i in range(len(layer_df))]
+
+def get_window_pixels(windows):
+    """Number of pixels in the (cropped) windows of the regions"""
+    import pwpd
+    import rasterio
+    import rasterio.features
+    if (pwpd.popimage_type == 'GHS'):
+        filepath = pwpd.GHS_filepath
+    else:
+        filepath = pwpd.GPW_popcount_filepath
+    Npix = 0
+    with rasterio.open(filepath) as src:
+        for w in windows:
+            window = rasterio.features.geometry_window(src, w["geometry"])
+            Npix += int(window.height)*int(window.width)
+    # (GPW reads both the count and density images)
+    return Npix if (pwpd.popimage_type == 'GHS') else 2*Npix
+
+def run_stage(stage, popimtype, size):
+    """Time one stage, return the result record"""
+    import pwpd
+    import pwpd_synthetic
+    datadir = os.path.join(bench_dir, f"data_{size:d}")
+    pwpd_synthetic.set_synthetic_popimage_pars(datadir, popimtype)
+    if stage in ['cleaned_pwpd', 'sorted_imarray', 'countries_loop']:
+        layer = 'countries'
+    elif (stage == 'healthregions_loop'):
+        layer = 'healthregions'
+    else:
+        layer = 'counties'
+    layer_df = pwpd_synthetic.make_synthetic_regions(layer, Nregions[layer],
+                                                     size)
+    windows = get_region_windows(layer_df)
+    Npix = get_window_pixels(windows)
+    if (stage == 'pwpd_from_count'):
+        # read the windows first, so only the reduction is timed
+        if (popimtype == 'GHS'):
+            images = [pwpd.get_windowed_subimage(w, pwpd.GHS_filepath)[0]
+                      for w in windows]
+        else:
+            images = [(pwpd.get_windowed_subimage(w, pwpd.GPW_popcount_filepath)[0],
+                       pwpd.get_windowed_subimage(w, pwpd.GPW_popdensity_filepath)[0])
+                      for w in windows]
+    setup_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    outfilepath = os.path.join(bench_dir, f"{stage:s}_{popimtype:s}.csv")
+    # the loops print their progress
+    quiet = contextlib.redirect_stdout(io.StringIO())
+    t0 = time.perf_counter()
+    cpu0 = time.process_time()
+    with quiet:
+        if (stage == 'windowed_subimage'):
+            for w in windows:
+                if (popimtype == 'GHS'):
+                    pwpd.get_windowed_subimage(w, pwpd.GHS_filepath)
+                else:
+                    pwpd.get_windowed_subimage(w, pwpd.GPW_popcount_filepath)
+                    pwpd.get_windowed_subimage(w, pwpd.GPW_popdensity_filepath)
+        elif (stage == 'pwpd_from_count'):
+            for img in images:
+                if (popimtype == 'GHS'):
+                    pwpd.get_pwpd_from_count(img)
+                else:
+                    pwpd.get_pwpd_from_count_and_density(*img)
+        elif (stage == 'cleaned_pwpd'):
+            for w in windows:
+                pwpd.get_cleaned_pwpd(w, clean_Nclean, clean_Ncheck,
+                                      clean_maxNzero, clean_Nmaxpix)
+        elif (stage == 'sorted_imarray'):
+            for w in windows:
+                pwpd.get_sorted_imarray(w, sort_Ntop, printout=False)
+        elif (stage == 'counties_loop'):
+            pwpd.get_pwpd_UScounties(layer_df, outfilepath)
+        elif (stage in ['healthregions_loop', 'countries_loop']):
+            # as in get_pwpd_all-canada-health-regions.py and
+            # get_pwpd_all-countries.py
+            area_col = 'area' if (layer == 'healthregions') else None
+            pwpd_df = layer_df.drop(columns='geometry').copy()
+            for col in ['pop', 'pwpd', 'pwlogpd', 'popdens', 'gamma']:
+                pwpd_df[col] = 0.0
+            for (i, w) in enumerate(windows):
+                if area_col is None:
+                    area = w.to_crs({'proj': 'cea'}).area.sum()/1e6
+                else:
+                    area = layer_df[area_col].iloc[i]/1e6
+                (pop, pwd, pwlogpd, imgshape, lat, lon) = \
+                    pwpd.get_pop_pwpd_pwlogpd(w)
+                pwpd_df.at[i, 'pop'] = pop
+                pwpd_df.at[i, 'pwpd'] = pwd
+                pwpd_df.at[i, 'pwlogpd'] = pwlogpd
+                pwpd_df.at[i, 'popdens'] = pop/area
+                pwpd_df.at[i, 'gamma'] = \
+                    pwpd.get_gamma(pop, area, pwd, pwpd.popimage_type,
+                                   pwpd.popimage_resolution)
+            pwpd_df.to_csv(outfilepath, index=False)
+    wall = time.perf_counter() - t0
+    cpu = time.process_time() - cpu0
+    # ru_maxrss is in kB on Linux (bytes on macOS)
+    rss_scale = 1.0 if (sys.platform == 'darwin') else 1024.0
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {'stage': stage, 'popimage_type': popimtype, 'size': size,
+            'Nregions': len(windows), 'megapixels': Npix/1e6,
+            'wall_s': wall, 'cpu_s': cpu,
+            'regions_per_s': len(windows)/wall,
+            'megapixels_per_s': Npix/1e6/wall,
+            'setup_rss_MB': setup_rss*rss_scale/1e6,
+            'peak_rss_MB': peak_rss*rss_scale/1e6}
+
+#=================
+#=== Main code ===
+#=================
+#
+srcdir = os.path.dirname(os.path.abspath(__file__))
+
+def get_git_commit():
+    proc = subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                          cwd=srcdir, capture_output=True, text=True)
+    return proc.stdout.strip() if (proc.returncode == 0) else None
+
+def get_versions():
+    import rasterio
+    import geopandas
+    return {'python': platform.python_version(), 'numpy': np.__version__,
+            'rasterio': rasterio.__version__, 'gdal': rasterio.__gdal_version__,
+            'geopandas': geopandas.__version__}
+
+def load_history():
+    if not os.path.exists(history_filepath):
+        return []
+    with open(history_filepath) as f:
+        return json.load(f)
+
+def get_last_result(history, stage, popimtype, size):
+    for run in reversed(history):
+        for r in run['results']:
+            if ( (r['stage'] == stage) & (r['popimage_type'] == popimtype)
+                 & (r['size'] == size) ):
+                return r
+    return None
+
+#=== A single stage (run by the suite in a fresh interpreter)
+if (len(sys.argv) == 4):
+    print(json.dumps(run_stage(sys.argv[1], sys.argv[2], int(sys.argv[3]))))
+    exit(0)
+
+#=== The suite
+import pwpd_synthetic
+os.makedirs(bench_dir, exist_ok=True)
+history = load_history()
+results = []
+status = 0
+print("=" * 96)
+print(f"{'stage':>20s} {'image':>5s} {'size':>6s} {'regions':>8s} {'MP':>8s}"
+      + f" {'wall s':>8s} {'regions/s':>10s} {'MP/s':>8s} {'peak MB':>8s}"
+      + f" {'change':>8s}")
+for size in image_sizes:
+    datadir = os.path.join(bench_dir, f"data_{size:d}")
+    if not all([os.path.exists(f) for f in
+                pwpd_synthetic.get_synthetic_filepaths(datadir)]):
+        pwpd_synthetic.make_synthetic_images(datadir, size)
+    for popimtype in popimage_types:
+        for stage in stages:
+            if ( (stage in ghs_only_stages) & (popimtype != 'GHS') ):
+                continue
+            proc = subprocess.run([sys.executable, os.path.abspath(__file__),
+                                   stage, popimtype, str(size)],
+                                  cwd=srcdir, capture_output=True, text=True)
+            if (proc.returncode != 0):
+                print(f"***Error: stage {stage:s} ({popimtype:s}, {size:d})"
+                      + " failed:")
+                print(proc.stdout[-2000:] + proc.stderr[-2000:])
+                status = 1
+                continue
+            r = json.loads(proc.stdout.strip().splitlines()[-1])
+            results.append(r)
+            last = get_last_result(history, stage, popimtype, size)
+            if last is None:
+                change = ""
+            else:
+                ratio = r['regions_per_s']/last['regions_per_s']
+                change = f"{100.0*(ratio - 1.0):+7.1f}%"
+                if (ratio < 1.0 - regression_tolerance):
+                    change += " ***"
+                    status = 1
+            print(f"{stage:>20s} {popimtype:>5s} {size:6d} {r['Nregions']:8d}"
+                  + f" {r['megapixels']:8.1f} {r['wall_s']:8.2f}"
+                  + f" {r['regions_per_s']:10.2f} {r['megapixels_per_s']:8.1f}"
+                  + f" {r['peak_rss_MB']:8.0f} {change:>8s}")
+history.append({'date': datetime.datetime.now().isoformat(timespec='seconds'),
+                'commit': get_git_commit(), 'host': platform.node(),
+                'versions': get_versions(), 'results': results})
+with open(history_filepath, 'w') as f:
+    json.dump(history, f, indent=1)
+print(f"\nResults appended to {history_filepath:s}")
+if (status != 0):
+    print(f"***Error: a stage failed or got more than"
+          + f" {100*regression_tolerance:.0f}% slower (***) than its last run")
+print("=" * 96)
+exit(status)
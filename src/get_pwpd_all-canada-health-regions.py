@@ -1,8 +1,11 @@
 # Use the pwpd.yml conda environment
 import sys
-import numpy as np
 import pandas as pd
 import pwpd
+import pwpd_trace
+import pwpd_simplify
+import pwpd_progress
+import pwpd_table
 
 pd.set_option('display.max_rows', None)
 
@@ -24,6 +27,21 @@ popimage_resolution = '1km'
 #popimage_resolution = '30as'
 # set this to False for GPW with resolution > 30as
 do_gamma = True
+# set this to True to also get the population-weighted density quantiles
+# (median, 10th and 90th percentile) and Gini coefficient of each region
+do_quantiles = False
+# set this to a fraction of a pixel (e.g., 0.25) to simplify the region
+# shapes to that tolerance before masking (see pwpd_simplify.py), or None
+simplify_tolerance_pixels = None
+# set this to True to weight each pixel by the fraction of its area in the
+# region, instead of using the pixels with their centers in the region
+# (for small regions on coarse images; see pwpd_coverage.py)
+coverage_weighting = False
+# set this to the file of the global hot-pixel layer of the GHS image
+# (made once by pwpd_hotpixels.make_hotpixel_layer) to clean the hot pixels
+# out of every region, as get_pwpd_country.py does (see pwpd_hotpixels.py),
+# or None
+hotpixel_layer_filepath = None
 
 # get shapefile and all pop measures for entire province
 get_entire_province = True
@@ -49,9 +67,23 @@ hr_type = "covid19"  # ["statscanada" or "covid19"]
 #=== Output directory/files ===
 #==============================
 outdir = "../output/"
+#--- Format of the results table: 'csv' or 'parquet' (typed columns, plus
+#    the dataset/epoch/resolution columns; see pwpd_table.py)
+table_format = 'csv'
 pwpd_outfilepath = outdir + "pwpd_all-canada-health-regions" \
     + "_" + hr_type + "_" + popimage_type \
-    + "_" + popimage_epoch + "_" + popimage_resolution + ".csv"
+    + "_" + popimage_epoch + "_" + popimage_resolution + "." + table_format
+#--- Timing of each stage (summary table at the end of the run), and a
+#    trace of every stage of every region (.jsonl for JSON lines, .json
+#    for the Chrome trace format, or None); see pwpd_trace.py
+do_timing = True
+trace_filepath = None
+#--- Per-region results as JSON lines (None: warnings only, to stderr);
+#    the console shows a single progress line, see pwpd_progress.py
+log_filepath = outdir + "pwpd_all-canada-health-regions" \
+    + "_" + hr_type + "_" + popimage_type \
+    + "_" + popimage_epoch + "_" + popimage_resolution + ".log.jsonl"
+log_level = 'INFO'
 
 #=================
 #=== Main code ===
@@ -59,6 +91,18 @@ pwpd_outfilepath = outdir + "pwpd_all-canada-health-regions" \
 #
 #=== Set the population image parameters
 pwpd.set_popimage_pars(popimage_type, popimage_epoch, popimage_resolution)
+pwpd.simplify_tolerance_pixels = simplify_tolerance_pixels
+pwpd.coverage_weighting = coverage_weighting
+if hotpixel_layer_filepath is not None:
+    import pwpd_hotpixels
+    pwpd_hotpixels.load_hotpixel_layer(hotpixel_layer_filepath)
+
+#=== Time each stage of the calculations (see pwpd_trace.py)
+if do_timing:
+    pwpd_trace.enable()
+
+#=== Log the results to file (see pwpd_progress.py)
+pwpd_progress.set_log_output(log_filepath, log_level)
 
 #=== Load the dataframe all Canadian health region shapefiles
 #
@@ -279,21 +323,34 @@ pwpd_df = pwpd_df.sort_values( by=['province_abb', 'hr_uid'])
 shapes_df = shapes_df.sort_values( by=['province_abb', 'hr_uid'])
 # convert area to km^2 from m^2
 pwpd_df['area'] = pwpd_df['area']/1e6
+if do_quantiles:
+    import pwpd_sketch
+    for col in pwpd_sketch.get_sketch_summary_columns():
+        pwpd_df[col] = 0.0
 
-#=== Make calculations for each region, output result to user, save csv
-prev_fips_state = 0
+#=== Make calculations for each region, report progress, save table
+progress = pwpd_progress.Progress(len(pwpd_df), "health regions")
 for index, row in pwpd_df.iterrows():
     name = row.region
     prov_id = row.province_abb
     hr_uid = row.hr_uid
     area = row.area
-    # Get the shapefile for this health region
-    hregion = pwpd.get_CanadaHR_by_hr_uid(shapes_df, hr_uid)
-    # Transform shapefile to coordinate system of population image
-    hregion_t = pwpd.transform_shapefile(hregion)
-    # Get population and population-weighted--population density
-    (pop_orig, pwd_orig, pwlogpd_orig, imgshape) = \
-        pwpd.get_pop_pwpd_pwlogpd(hregion_t)
+    with pwpd_trace.region(str(hr_uid)):
+        # Get the shapefile for this health region
+        hregion = pwpd.get_CanadaHR_by_hr_uid(shapes_df, hr_uid)
+        # Transform shapefile to coordinate system of population image
+        hregion_t = pwpd.transform_shapefile(hregion)
+        # Get population and population-weighted--population density
+        # (and the density quantiles, if requested)
+        if do_quantiles:
+            sketch = pwpd_sketch.new_sketch()
+        else:
+            sketch = None
+        (pop_orig, pwd_orig, pwlogpd_orig, imgshape, lat, lon) = \
+            pwpd.get_pop_pwpd_pwlogpd(hregion_t, sketch=sketch)
+    if do_quantiles:
+        for (col, val) in pwpd_sketch.get_sketch_summary(sketch).items():
+            pwpd_df.at[index, col] = val
     pwpd_df.at[index, 'pop'] = pop_orig
     pwpd_df.at[index, 'pwpd'] = pwd_orig
     pwpd_df.at[index, 'pwlogpd'] = pwlogpd_orig
@@ -304,16 +361,19 @@ for index, row in pwpd_df.iterrows():
         pwpd_df.at[index, 'gamma'] = \
             pwpd.get_gamma(pop_orig, area, pwd_orig,
                            popimage_type, popimage_resolution)
-    # Print result to user
-    print("=" * 80)
-    print(f"Using a {imgshape[0]:d}x{imgshape[1]:d} window of the "
-          + popimage_epoch + " " + popimage_type 
-          + " image with resolution " + popimage_resolution + "...\n")
-    print(name + " (" + prov_id + "_" + str(hr_uid) + ") "
-          + f"has a population of {int(pop_orig):,d}.\n"
-          + f"The PWPD_{popimage_type:s}_{popimage_resolution:s}"
-          + f" is {pwd_orig:.1f} per km^2"
-          + f" and exp[ PWlogPD ] = {np.exp(pwlogpd_orig):.1f}")
+    # Report progress (and log the result)
+    progress.update(name + " (" + prov_id + "_" + str(hr_uid) + ")",
+                    hr_uid=hr_uid, pop=pop_orig, pwpd=pwd_orig,
+                    pwlogpd=pwlogpd_orig, window=imgshape, lat=lat, lon=lon)
+progress.finish()
 # save to file
-pwpd_df.to_csv(pwpd_outfilepath, index=False)
+with pwpd_trace.stage('write_table'):
+    pwpd_table.write_table(pwpd_df, pwpd_outfilepath)
+
+#=== Timing summary and trace
+if do_timing:
+    pwpd_trace.print_summary()
+    if trace_filepath is not None:
+        pwpd_trace.write_trace(trace_filepath)
+pwpd_simplify.print_summary()
 
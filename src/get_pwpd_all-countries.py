@@ -1,7 +1,10 @@
 # Use the pwpd.yml conda environment
 import sys
-import numpy as np
 import pwpd
+import pwpd_trace
+import pwpd_simplify
+import pwpd_progress
+import pwpd_table
 
 
 #===========================================
@@ -20,13 +23,36 @@ popimage_epoch = '2015'
 popimage_resolution = '30as'
 # set this to False for GPW with resolution > 30as
 do_gamma = True
+# set this to True to also get the population-weighted density quantiles
+# (median, 10th and 90th percentile) and Gini coefficient of each country
+do_quantiles = False
+# set this to a fraction of a pixel (e.g., 0.25) to simplify the region
+# shapes to that tolerance before masking (see pwpd_simplify.py), or None
+simplify_tolerance_pixels = None
+# set this to True to weight each pixel by the fraction of its area in the
+# region, instead of using the pixels with their centers in the region
+# (for small regions on coarse images; see pwpd_coverage.py)
+coverage_weighting = False
 
 #==============================
 #=== Output directory/files ===
 #==============================
 outdir = "../output/"
+#--- Format of the results table: 'csv' or 'parquet' (typed columns, plus
+#    the dataset/epoch/resolution columns; see pwpd_table.py)
+table_format = 'csv'
 pwpd_outfilepath = outdir + "pwpd_all-countries" + "_" + popimage_type \
-    + "_" + popimage_epoch + "_" + popimage_resolution + ".csv"
+    + "_" + popimage_epoch + "_" + popimage_resolution + "." + table_format
+#--- Timing of each stage (summary table at the end of the run), and a
+#    trace of every stage of every region (.jsonl for JSON lines, .json
+#    for the Chrome trace format, or None); see pwpd_trace.py
+do_timing = True
+trace_filepath = None
+#--- Per-country results as JSON lines (None: warnings only, to stderr);
+#    the console shows a single progress line, see pwpd_progress.py
+log_filepath = outdir + "pwpd_all-countries" + "_" + popimage_type \
+    + "_" + popimage_epoch + "_" + popimage_resolution + ".log.jsonl"
+log_level = 'INFO'
 
 #=================
 #=== Main code ===
@@ -34,6 +60,15 @@ pwpd_outfilepath = outdir + "pwpd_all-countries" + "_" + popimage_type \
 #
 #=== Set the population image parameters
 pwpd.set_popimage_pars(popimage_type, popimage_epoch, popimage_resolution)
+pwpd.simplify_tolerance_pixels = simplify_tolerance_pixels
+pwpd.coverage_weighting = coverage_weighting
+
+#=== Time each stage of the calculations (see pwpd_trace.py)
+if do_timing:
+    pwpd_trace.enable()
+
+#=== Log the results to file (see pwpd_progress.py)
+pwpd_progress.set_log_output(log_filepath, log_level)
 
 #=== Load the shapefiles for all countries
 allcountries_df = pwpd.load_world_shapefiles()
@@ -44,20 +79,35 @@ allcountries_df = pwpd.load_world_shapefiles()
 #   columns = [name, threelett, area, pop, pwpd, pwlogpd, popdens, gamma]
 #
 pwpd_countries = pwpd.create_countries_dataframe_with_areas(allcountries_df)
+if do_quantiles:
+    import pwpd_sketch
+    for col in pwpd_sketch.get_sketch_summary_columns():
+        pwpd_countries[col] = 0.0
 
-#=== Make calculations for each country, output result to user, save csv
-for index, row in pwpd_countries.iterrows():
+#=== Make calculations for each country, report progress, save table
+progress = pwpd_progress.Progress(len(pwpd_countries), "countries")
+tablewriter = pwpd_table.TableWriter(pwpd_outfilepath)
+for (i, (index, row)) in enumerate(pwpd_countries.iterrows()):
     countrycode = row['threelett']
     area = row['area']
     if (area > 0.0):
-        # Get the shapefile for the requested country
-        (country, countryname) = \
-            pwpd.get_country_by_countrycode(allcountries_df, countrycode)
-        # Transform shapefile to coordinate system of population image
-        country_t = pwpd.transform_shapefile(country)
-        # Get population and population-weighted--population density
-        (pop_orig, pwd_orig, pwlogpd_orig, imgshape) = \
-            pwpd.get_pop_pwpd_pwlogpd(country_t)
+        with pwpd_trace.region(countrycode):
+            # Get the shapefile for the requested country
+            (country, countryname) = \
+                pwpd.get_country_by_countrycode(allcountries_df, countrycode)
+            # Transform shapefile to coordinate system of population image
+            country_t = pwpd.transform_shapefile(country)
+            # Get population and population-weighted--population density
+            # (and the density quantiles, if requested)
+            if do_quantiles:
+                sketch = pwpd_sketch.new_sketch()
+            else:
+                sketch = None
+            (pop_orig, pwd_orig, pwlogpd_orig, imgshape, lat, lon) = \
+                pwpd.get_pop_pwpd_pwlogpd(country_t, sketch=sketch)
+        if do_quantiles:
+            for (col, val) in pwpd_sketch.get_sketch_summary(sketch).items():
+                pwpd_countries.at[index, col] = val
         # Save in dataframe
         pwpd_countries.at[index, 'pop'] = pop_orig
         pwpd_countries.at[index, 'pwpd'] = pwd_orig
@@ -69,17 +119,23 @@ for index, row in pwpd_countries.iterrows():
             pwpd_countries.at[index, 'gamma'] = \
                 pwpd.get_gamma(pop_orig, area, pwd_orig,
                                popimage_type, popimage_resolution)
-        # Print result to user
-        print("=" * 80)
-        print(f"Using a {imgshape[0]:d}x{imgshape[1]:d} window of the "
-              + popimage_epoch + " " + popimage_type 
-              + " image with resolution " + popimage_resolution + "...\n")
-        print("The country of " + countryname + " (" + countrycode
-              + f") has a population of {int(pop_orig):,d}.\n"
-              + f"The PWPD_{popimage_type:s}_{popimage_resolution:s}"
-              + f" is {pwd_orig:.1f} per km^2"
-              + f" and exp[ PWlogPD ] = {np.exp(pwlogpd_orig):.1f}")
+        # Report progress (and log the result)
+        progress.update(countryname + " (" + countrycode + ")",
+                        countrycode=countrycode, pop=pop_orig, pwpd=pwd_orig,
+                        pwlogpd=pwlogpd_orig, window=imgshape,
+                        lat=lat, lon=lon)
     else:
-        print("No area found for " + countrycode)
-    pwpd_countries.to_csv(pwpd_outfilepath, index=False)
+        pwpd_progress.logger.warning("No area found for " + countrycode)
+        progress.update(countrycode)
+    with pwpd_trace.stage('write_table'):
+        tablewriter.write(pwpd_countries, Ndone=i+1)
+tablewriter.close()
+progress.finish()
+
+#=== Timing summary and trace
+if do_timing:
+    pwpd_trace.print_summary()
+    if trace_filepath is not None:
+        pwpd_trace.write_trace(trace_filepath)
+pwpd_simplify.print_summary()
 
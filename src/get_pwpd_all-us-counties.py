@@ -2,6 +2,9 @@
 import sys
 import numpy as np
 import pwpd
+import pwpd_trace
+import pwpd_simplify
+import pwpd_progress
 
 outdir = "../output/"
 
@@ -21,13 +24,68 @@ popimage_resolution = '1km'
 #popimage_resolution = '30as'
 # set this to False for GPW with resolution > 30as
 do_gamma = True
+# set this to True to also get the population-weighted density quantiles
+# (median, 10th and 90th percentile) and Gini coefficient of each county
+do_quantiles = False
+# set this to True to also get the means and 95% intervals of the pop,
+# pwpd, pwlogpd and gamma of each county over Monte Carlo draws of the
+# pixel counts (see pwpd_uncertainty.py)
+do_uncertainty = False
+# set this to a fraction of a pixel (e.g., 0.25) to simplify the region
+# shapes to that tolerance before masking (see pwpd_simplify.py), or None
+simplify_tolerance_pixels = None
+# set this to True to weight each pixel by the fraction of its area in the
+# region, instead of using the pixels with their centers in the region
+# (for small regions on coarse images; see pwpd_coverage.py)
+coverage_weighting = False
+# set this to the file of the global hot-pixel layer of the GHS image
+# (made once by pwpd_hotpixels.make_hotpixel_layer) to clean the hot pixels
+# out of every region, as get_pwpd_country.py does (see pwpd_hotpixels.py),
+# or None
+hotpixel_layer_filepath = None
+# set this to a list of epochs (e.g., ['1975', '1990', '2000', '2015'] for
+# GHS) to reduce all of them together, with one mask per county, into one
+# table with pop/pwpd/pwlogpd columns per epoch (see pwpd_stack.py), or None
+stack_epochs = None
+# set this to True to run the counties on a pool of worker processes,
+# packed by window size within a memory budget (see pwpd_schedule.py; the
+# plan, with its predicted run time and peak memory, is printed first)
+run_scheduled = False
+schedule_Nworkers = None
+schedule_memory_budget = None
+# with run_scheduled, set this to True to decode each image block once for
+# all of the workers, in a block cache in shared memory (see
+# pwpd_blockcache.py)
+shared_block_cache = False
 
 #==============================
 #=== Output directory/files ===
 #==============================
 outdir = "../output/"
+#--- Format of the results table: 'csv' or 'parquet' (typed columns, plus
+#    the dataset/epoch/resolution columns; see pwpd_table.py)
+table_format = 'csv'
 pwpd_counties_outfilepath = outdir + "pwpd_all-us-counties" + "_" + popimage_type \
-    + "_" + popimage_epoch + "_" + popimage_resolution + ".csv"
+    + "_" + popimage_epoch + "_" + popimage_resolution + "." + table_format
+# the table of all epochs (if stack_epochs)
+stack_outfilepath = outdir + "pwpd_all-us-counties" + "_" + popimage_type \
+    + "_epochs_" + popimage_resolution + "." + table_format
+# the table of the scheduled run (if run_scheduled)
+scheduled_outfilepath = outdir + "pwpd_all-us-counties" + "_" + popimage_type \
+    + "_" + popimage_epoch + "_" + popimage_resolution + "_scheduled." + table_format
+# the density sketches of all counties (used for composites, if do_quantiles)
+sketch_outfilepath = outdir + "pwpd_all-us-counties" + "_" + popimage_type \
+    + "_" + popimage_epoch + "_" + popimage_resolution + "_sketches.npz"
+#--- Timing of each stage (summary table at the end of the run), and a
+#    trace of every stage of every region (.jsonl for JSON lines, .json
+#    for the Chrome trace format, or None); see pwpd_trace.py
+do_timing = True
+trace_filepath = None
+#--- Per-county results as JSON lines (None: warnings only, to stderr);
+#    the console shows a single progress line, see pwpd_progress.py
+log_filepath = outdir + "pwpd_all-us-counties" + "_" + popimage_type \
+    + "_" + popimage_epoch + "_" + popimage_resolution + ".log.jsonl"
+log_level = 'INFO'
 
 #=================
 #=== Main code ===
@@ -35,6 +93,18 @@ pwpd_counties_outfilepath = outdir + "pwpd_all-us-counties" + "_" + popimage_typ
 #
 #=== Set the population image parameters
 pwpd.set_popimage_pars(popimage_type, popimage_epoch, popimage_resolution)
+pwpd.simplify_tolerance_pixels = simplify_tolerance_pixels
+pwpd.coverage_weighting = coverage_weighting
+if hotpixel_layer_filepath is not None:
+    import pwpd_hotpixels
+    pwpd_hotpixels.load_hotpixel_layer(hotpixel_layer_filepath)
+
+#=== Time each stage of the calculations (see pwpd_trace.py)
+if do_timing:
+    pwpd_trace.enable()
+
+#=== Log the results to file (see pwpd_progress.py)
+pwpd_progress.set_log_output(log_filepath, log_level)
 
 #=== Load the dataframe all US-county shapefiles
 countyshapes_df = pwpd.load_UScounty_shapefiles()
@@ -52,8 +122,45 @@ countyshapes_df = countyshapes_df.sort_values( by=['fips_state', 'fips_county'])
 #                 'countylong', 'state', 'stateabb', 'landarea'
 #                 'pop', 'pwpd', 'pwlogpd', 'popdens', 'gamma',
 #                 'pop_centroid_lat', 'pop_centroid_lon']
+#
+#    plus ['pd_p10', 'pd_median', 'pd_p90', 'pd_gini'] if do_quantiles
+#    and ['pop_mean', 'pop_lo', 'pop_hi', 'pwpd_mean', ...] if do_uncertainty
 #           
-pwpd_counties = \
-    pwpd.get_pwpd_UScounties(countyshapes_df, pwpd_counties_outfilepath,
-                             do_gamma=do_gamma)
+if run_scheduled:
+    #    columns = ['fips_state', 'fips_county', ..., 'pop', 'pwpd',
+    #               'pwlogpd', 'pop_centroid_lat', 'pop_centroid_lon']
+    import pwpd_schedule
+    pwpd_schedule.schedule_Nworkers = schedule_Nworkers
+    pwpd_schedule.schedule_memory_budget = schedule_memory_budget
+    if shared_block_cache:
+        import pwpd_blockcache
+        pwpd_blockcache.create()
+    pwpd_counties = \
+        pwpd_schedule.get_pwpd_regions_scheduled(countyshapes_df,
+                                                 scheduled_outfilepath)
+    if shared_block_cache:
+        pwpd_blockcache.print_summary()
+        pwpd_blockcache.close()
+elif stack_epochs is None:
+    pwpd_counties = \
+        pwpd.get_pwpd_UScounties(countyshapes_df, pwpd_counties_outfilepath,
+                                 do_gamma=do_gamma, do_quantiles=do_quantiles,
+                                 sketch_outfilepath=sketch_outfilepath,
+                                 do_uncertainty=do_uncertainty)
+else:
+    #    columns = ['fips_state', 'fips_county', ..., 'landarea',
+    #               'pop_<epoch>', 'pwpd_<epoch>', 'pwlogpd_<epoch>', ...]
+    import pwpd_stack
+    stack = pwpd_stack.make_epoch_stack(stack_epochs)
+    pwpd_counties = \
+        pwpd_stack.get_pwpd_regions_stack(countyshapes_df, stack,
+                                          stack_outfilepath,
+                                          name_col='countylong')
+
+#=== Timing summary and trace
+if do_timing:
+    pwpd_trace.print_summary()
+    if trace_filepath is not None:
+        pwpd_trace.write_trace(trace_filepath)
+pwpd_simplify.print_summary()
 
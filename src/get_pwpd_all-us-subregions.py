@@ -3,6 +3,10 @@ import sys
 import numpy as np
 import pandas as pd
 import pwpd
+import pwpd_trace
+import pwpd_simplify
+import pwpd_progress
+import pwpd_table
 
 #######################################################
 # NOTE: Run the script:                               #
@@ -31,6 +35,17 @@ popimage_resolution = '1km'
 #popimage_resolution = '2.5am'
 # set this to False for GPW with resolution > 30as
 do_gamma = True
+# set this to True to get the density quantiles of the composites by merging
+# the county density sketches (get_pwpd_all-us-counties.py must have been
+# run with do_quantiles = True)
+do_quantiles = False
+# set this to a fraction of a pixel (e.g., 0.25) to simplify the region
+# shapes to that tolerance before masking (see pwpd_simplify.py), or None
+simplify_tolerance_pixels = None
+# set this to True to weight each pixel by the fraction of its area in the
+# region, instead of using the pixels with their centers in the region
+# (for small regions on coarse images; see pwpd_coverage.py)
+coverage_weighting = False
 # set this to True to check some of the values produced by dissolving composites
 check_summable_values_for_composites = False
 
@@ -38,16 +53,33 @@ check_summable_values_for_composites = False
 #=== Output directory/files ===
 #==============================
 outdir = "../output/"
+#--- Format of the results tables (this script's output and the input from
+#    get_pwpd_all-us-counties.py): 'csv' or 'parquet' (typed columns, plus
+#    the dataset/epoch/resolution columns; see pwpd_table.py)
+table_format = 'csv'
 # output data for all subregions (including composite counties, metro, states)
 pwpd_subregions_outfilepath = outdir + "pwpd_all-us-subregions" + "_" + popimage_type \
-    + "_" + popimage_epoch + "_" + popimage_resolution + ".csv"
+    + "_" + popimage_epoch + "_" + popimage_resolution + "." + table_format
+#--- Timing of each stage (summary table at the end of the run), and a
+#    trace of every stage of every region (.jsonl for JSON lines, .json
+#    for the Chrome trace format, or None); see pwpd_trace.py
+do_timing = True
+trace_filepath = None
+#--- Per-region results as JSON lines (None: warnings only, to stderr);
+#    the console shows a single progress line, see pwpd_progress.py
+log_filepath = outdir + "pwpd_all-us-subregions" + "_" + popimage_type \
+    + "_" + popimage_epoch + "_" + popimage_resolution + ".log.jsonl"
+log_level = 'INFO'
 
 #===================
 #=== Input files ===
 #===================
 # The output file from "get_pwpd_all-us-counties.py" is used as a starting point
 pwpd_counties_filepath = outdir + "pwpd_all-us-counties" + "_" + popimage_type \
-    + "_" + popimage_epoch + "_" + popimage_resolution + ".csv"
+    + "_" + popimage_epoch + "_" + popimage_resolution + "." + table_format
+# ... along with its density sketches (if do_quantiles)
+sketch_filepath = outdir + "pwpd_all-us-counties" + "_" + popimage_type \
+    + "_" + popimage_epoch + "_" + popimage_resolution + "_sketches.npz"
 # The output of "projects/2021-04-02.../external-data/covid19/curate_covid19.py"
 # which has the FIPS (or fake-FIPS) values for every county, every composite county,
 # every metro region, and every state
@@ -60,6 +92,8 @@ fips_filepath = "../../2021-04-02_new-python-implementation-nonlinear-regression
 #
 #=== Set the population image parameters
 pwpd.set_popimage_pars(popimage_type, popimage_epoch, popimage_resolution)
+pwpd.simplify_tolerance_pixels = simplify_tolerance_pixels
+pwpd.coverage_weighting = coverage_weighting
 
 #=== Load the dataframe of all US-county shapefiles
 countyshapes_df = pwpd.load_UScounty_shapefiles()
@@ -71,7 +105,7 @@ countyshapes_df = countyshapes_df.sort_values( by=['fips_state', 'fips_county'])
 #               'countylong', 'state', 'stateabb', 'landarea'
 #               'pop', 'pwpd', 'pwlogpd', 'popdens', 'gamma']
 #
-pwpd_counties = pd.read_csv(pwpd_counties_filepath)
+pwpd_counties = pwpd_table.read_table(pwpd_counties_filepath)
 
 #=== Load the FIPS file with composite counties
 fips_df = pd.read_csv(fips_filepath)
@@ -96,29 +130,52 @@ df = pd.merge(fips_df, pwpd_counties, how='left', on='fips')
 #              'fips_state_y', 'fips_county_y', 'county_y', 'countylong_y',
 #              'state_y', 'stateabb_y', 'landarea', 'pop', 'pwpd', 'pwlogpd',
 #              'popdens', 'gamma']
+quantile_cols = []
+if do_quantiles:
+    import pwpd_sketch
+    quantile_cols = pwpd_sketch.get_sketch_summary_columns()
 df = df[['fips_state_x', 'fips_county_x', 'fips', 'county_type', 'ccFIPS', 'state_x',
          'county_x', 'dma', 'dmaname', 'landarea', 'pop', 'pwpd', 'pwlogpd',
-         'popdens', 'gamma']].copy()
+         'popdens', 'gamma'] + quantile_cols].copy()
 df.columns = ['sfips', 'cfips', 'fips', 'county_type', 'ccFIPS', 'state', 'county', 'dma', 'dmaname',
-              'landarea', 'pop', 'pwpd', 'pwlogpd', 'popdens', 'gamma']
+              'landarea', 'pop', 'pwpd', 'pwlogpd', 'popdens', 'gamma'] + quantile_cols
+
+#=== Load the county density sketches (with the same Valdez-Cordova change)
+sketches = None
+if do_quantiles:
+    sketches = pwpd_sketch.load_sketches(sketch_filepath)
+    if 2261 in sketches:
+        sketches[2903] = sketches.pop(2261)
 
 #=== Calculate PWPD for composites
 #
-#       save to csv file after each category
+#       save to file after each category
 #
+# time each stage of the calculations (see pwpd_trace.py)
+if do_timing:
+    pwpd_trace.enable()
+# log the results to file (see pwpd_progress.py)
+pwpd_progress.set_log_output(log_filepath, log_level)
 # add fips column to shapes dataframe
 countyshapes_df['fips'] = 0
 for index, row in countyshapes_df.iterrows():
     countyshapes_df.at[index, 'fips'] = int(f"{row['fips_state']:02d}{row['fips_county']:03d}")
 # do all states
-df = pwpd.get_composite_pwds(df, countyshapes_df, 'state')
-df.to_csv(pwpd_subregions_outfilepath, index=False)
+df = pwpd.get_composite_pwds(df, countyshapes_df, 'state', sketches=sketches)
+pwpd_table.write_table(df, pwpd_subregions_outfilepath)
 # do all composite counties
-df = pwpd.get_composite_pwds(df, countyshapes_df, 'composite-county')
-df.to_csv(pwpd_subregions_outfilepath, index=False)
+df = pwpd.get_composite_pwds(df, countyshapes_df, 'composite-county',
+                             sketches=sketches)
+pwpd_table.write_table(df, pwpd_subregions_outfilepath)
 # do all DMAs
-df = pwpd.get_composite_pwds(df, countyshapes_df, 'metro')
-df.to_csv(pwpd_subregions_outfilepath, index=False)
+df = pwpd.get_composite_pwds(df, countyshapes_df, 'metro', sketches=sketches)
+pwpd_table.write_table(df, pwpd_subregions_outfilepath)
+# timing summary and trace
+if do_timing:
+    pwpd_trace.print_summary()
+    if trace_filepath is not None:
+        pwpd_trace.write_trace(trace_filepath)
+pwpd_simplify.print_summary()
 
 
 if check_summable_values_for_composites:
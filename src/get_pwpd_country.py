@@ -19,6 +19,10 @@ popimage_epoch = '2015'
 #      GPW: '30as' (~1km), 2.5am', '15am', '30am', '1deg'
 popimage_resolution = '1km'
 #popimage_resolution = '1deg'
+#--- Number of worker processes over which the country's window is split
+#    (in row strips, masked, read and reduced in parallel, with the sums
+#    added exactly; see pwpd_schedule.py), or None for a single window
+region_Nworkers = None
 
 #================================================================
 #=== Parameters for sorting and displaying max-valued pixels ====
@@ -32,7 +36,9 @@ sort_Ntop = 5000  # number of top pixels to return (csv file and plot)
 #=== Parameters for cleaning the image  (GHS only) ===
 #=====================================================
 #
-#--- Type of cleaning: 'by_neighbors' or 'by_force' or None
+#--- Type of cleaning: 'by_neighbors' or 'by_force' or 'sweep' (the
+#    'by_neighbors' cleaning for every combination of the clean_sweep_*
+#    values below, saved to a csv file) or None
 cleanpwd = None
 #--- Maximum number of pixels to check for cleaning
 clean_Ncheck = 500     
@@ -42,6 +48,24 @@ clean_Npixels = 500
 clean_maxNzero = 4     
 #--- Number of max-valued pixels to output to user in cleaned image
 clean_Nmaxpix = 100    
+#--- Save the cleaned image ('by_force' only) as a cloud-optimized GeoTIFF
+clean_write_image = False
+#--- Values of clean_Ncheck, clean_maxNzero and clean_Npixels to sweep
+#    ('sweep' only)
+clean_sweep_Ncheck = [100, 250, 500, 1000]
+clean_sweep_maxNzero = [3, 4, 5, 6]
+clean_sweep_Npixels = [10, 50, 100, 500]
+
+#===========================================================
+#=== Parameters for the smoothed ("experienced") density ===
+#===                     (GHS only)                      ===
+#===========================================================
+#
+#--- Radii (km) of the disks over which the density around each person
+#    is measured, e.g. [1, 5, 10] (empty list to skip)
+smooth_radii_km = []
+#--- Write the smoothed density surfaces to GeoTIFF files in outdir
+smooth_write_surfaces = False
 
 #=============================================================
 #=== Commandline input:  Accept three-letter country code  ===
@@ -62,6 +86,7 @@ else:
 #
 #=== Set the population image parameters
 pwpd.set_popimage_pars(popimage_type, popimage_epoch, popimage_resolution)
+pwpd.region_Nworkers = region_Nworkers
 
 #=== Load the shapefiles for all countries
 allcountries_df = pwpd.load_world_shapefiles()
@@ -75,7 +100,7 @@ country_t = pwpd.transform_shapefile(country)
 
 #=== Get population, population-weighted population density
 #    and the population-weighted log(pop density)
-(pop_orig, pwd_orig, pwlogpd_orig, imgshape) = \
+(pop_orig, pwd_orig, pwlogpd_orig, imgshape, lat, lon) = \
     pwpd.get_pop_pwpd_pwlogpd(country_t)
 
 #=== Display result for user
@@ -90,7 +115,22 @@ print("The country of " + countryname + " (" + countrycode
       + f" and exp[ PWlogPD ] = {np.exp(pwlogpd_orig):.1f}")
 print("=" * 80)
 
-
+#=== Population-weighted smoothed density within each radius
+if ( bool(smooth_radii_km) & (popimage_type == 'GHS') ):
+    import pwpd_smooth
+    print(f"\nSmoothing the image over disks of radius {smooth_radii_km} km...")
+    if smooth_write_surfaces:
+        smooth_outfileprefix = outdir + countrycode \
+            + "_" + popimage_type + "-" + popimage_resolution + "_smoothed"
+    else:
+        smooth_outfileprefix = None
+    (pop, pwd_r, surfaces, surface_transform) = \
+        pwpd_smooth.get_smoothed_pwpd(country_t, smooth_radii_km,
+                                      outfileprefix=smooth_outfileprefix,
+                                      return_surface=False)
+    for r in smooth_radii_km:
+        print(f"\tPWPD within {r:g} km = {pwd_r[r]:.1f} per km^2")
+    print("=" * 80)
 
 #=======================================================
 #===   Sorting the GHS-POP image to view max pixels  ===
@@ -172,13 +212,40 @@ if ((cleanpwd == 'by_neighbors') & (popimage_type == 'GHS')):
 elif ((cleanpwd == 'by_force') & (popimage_type == 'GHS')):
     #=== Clean by simply removing the top clean_Npixels pixels
     print(f"\nCleaning the image by simply removing the top {clean_Npixels:d} pixels.")
+    if clean_write_image:
+        clean_outfile = outdir + countrycode \
+            + "_" + popimage_type \
+            + "-" + popimage_resolution + "_cleaned.tif"
+        print("Saving the cleaned image to the file:")
+        print("\t" + clean_outfile)
+    else:
+        clean_outfile = None
     (maxpix, newimg) = pwpd.get_cleaned_pwpd_force(country_t, clean_Npixels,
-                                                   clean_Nmaxpix)
-    (pop, pwd, pwlogpd) = pwpd.get_pwpd_from_count(newimg, nparr=True)
+                                                   clean_Nmaxpix,
+                                                   outfilepath=clean_outfile)
+    (pop, pwd, pwlogpd, pc_row, pc_col) = pwpd.get_pwpd_from_count(newimg, nparr=True)
     print(f"New pwd = {pwd:.1f}, with pop = {int(pop):,d} and pwlogpd = {pwlogpd:.4f}\n")
+elif ((cleanpwd == 'sweep') & (popimage_type == 'GHS')):
+    #=== The 'by_neighbors' cleaning for every combination of the
+    #    parameters, from one candidate table (see pwpd_cleaning.py)
+    #
+    #    columns = ['Ncheck', 'maxNzero', 'Nclean', 'Nchecked', 'Ncleaned',
+    #               'pop', 'pwpd', 'pwlogpd']
+    #
+    print("\nSweeping the cleaning parameters...")
+    sweep_df = pwpd.get_cleaning_sweep(country_t, clean_sweep_Ncheck,
+                                       clean_sweep_maxNzero,
+                                       clean_sweep_Npixels)
+    print(sweep_df.to_string(index=False))
+    sweep_outfile = outdir + countrycode \
+        + "_" + popimage_type \
+        + "-" + popimage_resolution + "_clean-sweep.csv"
+    print("Saving the sweep to the file:")
+    print("\t" + sweep_outfile)
+    sweep_df.to_csv(sweep_outfile, index=False)
 
 #=== Print out locations of top clean_Nmaxpix pixels after cleaning
-if (bool(cleanpwd) & (popimage_type == 'GHS')):
+if ((cleanpwd in ['by_neighbors', 'by_force']) & (popimage_type == 'GHS')):
     print(f"The locations of the top-valued {clean_Nmaxpix:d} pixels after cleaning:")
     for p in maxpix:
         print("\t",p)
@@ -0,0 +1,55 @@
+# Use the pwpd.yml conda environment
+import sys
+import pwpd
+import pwpd_grid
+
+#===========================================
+#=== Parameters for the population image ===
+#===========================================
+#
+#--- possible types are 'GHS' and 'GPW'
+popimage_type = 'GHS' 
+#popimage_type = 'GPW'  
+#--- possible epochs are 2015 (GHS or GPW) and 2020 (GPW only)
+popimage_epoch = '2015'  
+#--- possible resolutions (~ pixel length scale) are:
+#      GHS: '250m', '1km'
+#      GPW: '30as' (~1km), 2.5am', '15am', '30am', '1deg'
+popimage_resolution = '1km'
+#popimage_resolution = '30as'
+
+#=============================================================
+#=== Size of the output grid cells (a whole number of image ===
+#=== pixels): in km for GHS (e.g., '10km', '50km') and in    ===
+#=== degrees for GPW (e.g., '0.5deg', '1deg')                ===
+#=============================================================
+#
+grid_cellsize = '10km'
+#grid_cellsize = '1deg'
+
+#--- Cell size can also be given on the command line
+if (len(sys.argv) == 2):
+    grid_cellsize = sys.argv[1]
+elif (len(sys.argv) > 2):
+    print("***Error: Unrecognized commandline option")
+    exit(0)
+
+#==============================
+#=== Output directory/files ===
+#==============================
+outdir = "../output/"
+grid_outfilepath = outdir + "pwpd_global-grid" + "_" + popimage_type \
+    + "_" + popimage_epoch + "_" + popimage_resolution \
+    + "_" + grid_cellsize + ".tif"
+
+#=================
+#=== Main code ===
+#=================
+#
+#=== Set the population image parameters
+pwpd.set_popimage_pars(popimage_type, popimage_epoch, popimage_resolution)
+
+#=== Stream the image in strips and write the (pop, pwpd, pwlogpd) grid
+pwpd_grid.make_pwpd_grid(grid_outfilepath, grid_cellsize)
+print("Saved the gridded pop, PWPD and PWlogPD to the file:")
+print("\t" + grid_outfilepath)
@@ -1,15 +1,18 @@
 # Use the pwpd.yml conda environment
+#
+# Only the modules needed by the core reduction path (numpy, rasterio)
+# are imported here.  The heavier packages (geopandas, pandas, pyproj,
+# scipy) are imported inside the functions that use them, and the
+# cleaning/sorting and plotting methods live in the pwpd_cleaning and
+# pwpd_plotting modules, which are only imported on first use (see
+# "Lazily-loaded submodules" at the end of this file).
 import sys
-import datetime
+import importlib
+import threading
 import numpy as np
-import scipy.ndimage as spndi
-import matplotlib.pyplot as plt
-import geopandas as gpd
-import pandas as pd
 import rasterio
 import rasterio.mask
-import pyproj
-import folium  # for making html maps with leaflet.js 
+import pwpd_trace
 
 ############################################################
 #         Population image parameters and methods          #
@@ -153,26 +156,95 @@ def set_popimage_pars(popimtype, epoch, lengthstring):
         print("\n***Error: Population image", popimtype, "not recognized.")
         exit(0)
 
-def get_windowed_subimage(window_df, filepath):
+#
+# === Open raster handles
+#
+#  By default each windowed read opens (and closes) the raster file.  A
+#  long-lived process (e.g., pwpd_server.py) can instead set
+#
+#      pwpd.keep_rasters_open = True
+#
+#  to keep the handles open between reads.  Rasterio datasets must not be
+#  shared between threads, so each thread keeps its own handles.
+#
+keep_rasters_open = False
+raster_handles = threading.local()
+#  The block cache shared by the worker processes of a run, if one is
+#  attached (see pwpd_blockcache.py)
+block_cache = None
+
+def get_open_raster(filepath):
+    """Return this thread's open handle for the raster at filepath"""
+    if not hasattr(raster_handles, 'datasets'):
+        raster_handles.datasets = {}
+    if filepath not in raster_handles.datasets:
+        raster_handles.datasets[filepath] = rasterio.open(filepath)
+    return raster_handles.datasets[filepath]
+
+def close_open_rasters():
+    """Close this thread's open raster handles"""
+    for src in getattr(raster_handles, 'datasets', {}).values():
+        src.close()
+    raster_handles.datasets = {}
+
+def get_windowed_subimage(window_df, filepath, return_meta=False,
+                          all_touched=False):
     # get polygon shape(s) from the geopandas dataframe
     windowshapes = window_df["geometry"]
+    return get_masked_subimage(windowshapes, filepath, return_meta=return_meta,
+                               all_touched=all_touched)
+
+def get_masked_subimage(windowshapes, filepath, return_meta=False,
+                        all_touched=False, keep_open=None):
+    """Mask the raster at filepath with a list of shapes (already in the
+    coordinates of the raster) and crop to their bounding window.  With
+    return_meta, the metadata for writing the window to a GeoTIFF (see
+    pwpd_io.py) is returned as a third value.  With all_touched, every
+    pixel touched by the shapes is kept (not only those with their centers
+    in the shapes).  With keep_open (keep_rasters_open, if None), this
+    thread's handle is kept open for the next read."""
+    # read the window from the block cache shared by the workers, if any
+    # (see pwpd_blockcache.py)
+    if ( (block_cache is not None) and (filepath in block_cache.fileids)
+         and not return_meta ):
+        with pwpd_trace.stage('mask_read', file=filepath.split('/')[-1],
+                              cache='shared') as span:
+            (img, img_transform) = block_cache.get_masked_subimage(
+                windowshapes, filepath, all_touched=all_touched)
+            span.add(bytes=img.nbytes, window=img.shape)
+        return img, img_transform
+    if keep_open is None:
+        keep_open = keep_rasters_open
     # mask GHS-POP image with entire set of shapes
     try:
-        with rasterio.open(filepath) as src:
-            img, img_transform = \
-                rasterio.mask.mask(src, windowshapes, crop=True)
+        if keep_open:
+            src = get_open_raster(filepath)
+        else:
+            src = rasterio.open(filepath)
+        try:
+            with pwpd_trace.stage('mask_read',
+                                  file=filepath.split('/')[-1]) as span:
+                img, img_transform = \
+                    rasterio.mask.mask(src, windowshapes, crop=True,
+                                       all_touched=all_touched)
+                span.add(bytes=img.nbytes, window=img.shape[1:])
             img_profile = src.profile
             img_meta = src.meta
             img_meta.update( { "driver": "GTiff",
                                "height": img.shape[1],
                                "width": img.shape[2],
                                "transform": img_transform} )
+        finally:
+            if not keep_open:
+                src.close()
     except rasterio.errors.RasterioIOError:
         print("\n***Error: File with path:")
         print("\n", filepath, "\n")
         print("          not found. Check the popimage type, epoch, and resolution.")
         exit(0)
     # return only the first band (rasterio returns 3D array)
+    if return_meta:
+        return img[0], img_transform, img_meta
     return img[0], img_transform
 
 
@@ -265,6 +337,7 @@ world_shape_filepath = world_shape_dir + "ne_50m_admin_0_countries.shp"
 places_w_no_shapefile = ['PSE', 'GIB', 'SSD', 'TUV']
 
 def load_world_shapefiles():
+    import geopandas as gpd
     #=== read in dataframe of shapefiles for all countries
     #    (keep only relevant columns and rename like in "codes")
     allcountries_df = gpd.read_file(world_shape_filepath)
@@ -273,6 +346,7 @@ def load_world_shapefiles():
     return allcountries_df
 
 def create_countries_dataframe_with_areas(allcountries_df):
+    import pandas as pd
     # load the areas dataframe, keep only three columns and rename, add Taiwan
     areas_df = pd.read_csv(areas_filepath)
     areas_df = areas_df[areas_collist]
@@ -299,7 +373,8 @@ def create_countries_dataframe_with_areas(allcountries_df):
     return pwpd_countries
 
 def get_country_by_countrycode(allcountries_df, countrycode):
-    country = allcountries_df[allcountries_df['threelett'] == countrycode]
+    with pwpd_trace.stage('lookup'):
+        country = allcountries_df[allcountries_df['threelett'] == countrycode]
     try:
         countryname = country['name'].to_list()[0]
     except IndexError:
@@ -308,13 +383,33 @@ def get_country_by_countrycode(allcountries_df, countrycode):
         exit(0)
     return (country, countryname)
 
-def transform_shapefile(shapefile):
+#=== Simplification of the region shapes
+#
+#   The masked reads rasterize the full-detail shapes, which, for long
+#   coastlines and boundaries at 1km or coarser, can take longer than the
+#   reduction itself.  Setting
+#
+#       pwpd.simplify_tolerance_pixels = 0.25
+#
+#   simplifies (preserving topology) the transformed shapes to that
+#   fraction of a pixel, with the simplified shapes cached per image
+#   resolution and their pixel membership checked against the full-detail
+#   shapes (see pwpd_simplify.py).
+#
+simplify_tolerance_pixels = None
+
+def transform_shapefile(shapefile, simplify=True):
+    if (simplify & (simplify_tolerance_pixels is not None)):
+        import pwpd_simplify
+        return pwpd_simplify.transform_and_simplify(shapefile)
     if (popimage_type == 'GHS'):
         # transform to Mollweide
-        return shapefile.to_crs(crs=GHS_coordinates)
+        with pwpd_trace.stage('to_crs'):
+            return shapefile.to_crs(crs=GHS_coordinates)
     elif (popimage_type == 'GPW'):
         # transform to WGS84
-        return shapefile.to_crs(crs=GPW_coordinates)        
+        with pwpd_trace.stage('to_crs'):
+            return shapefile.to_crs(crs=GPW_coordinates)
     else:
         print("\n***Error: Population image coordinates unknown/undefined.")
         exit(0)
@@ -369,6 +464,8 @@ CanadaHR_province_filepath = CanadaHR_shape_dir + "canada-provinces_w-hr-prefix.
 
 
 def load_CanadaHR_shapefiles(hr_type):
+    import geopandas as gpd
+    import pandas as pd
     #=== read in Canada Health Regions dataframe
     #    (keep only relevant columns and rename like in "codes")
     if (hr_type == "statscanada"):
@@ -425,8 +522,9 @@ def create_canada_hr_dataframe(df):
     return pwpd_df
 
 def get_CanadaHR_by_hr_uid(shapes_df, hr_uid):
-    the_hregion = (shapes_df['hr_uid'] == hr_uid)
-    Nselected = len(shapes_df[the_hregion])
+    with pwpd_trace.stage('lookup'):
+        the_hregion = (shapes_df['hr_uid'] == hr_uid)
+        Nselected = len(shapes_df[the_hregion])
     if (Nselected != 1):
         print(f"\n***Error: For the requested Health Region ({hr_uid:d})")
         print(f"          {Nselected:d} regions were found.")
@@ -528,6 +626,8 @@ UScounty_shape_filepath = UScounty_shape_dir + "tl_2019_us_county/tl_2019_us_cou
 USstate_fips_filepath = UScounty_shape_dir + "US-state_fips-codes.csv"
 
 def load_UScounty_shapefiles():
+    import geopandas as gpd
+    import pandas as pd
     #=== read in UScounties dataframe
     #    (keep only relevant columns and rename like in "codes")
     allcounties_df = gpd.read_file(UScounty_shape_filepath)
@@ -572,9 +672,10 @@ def create_uscounties_dataframe(allcounties_df):
     return pwpd_counties
 
 def get_UScounty_by_fips(allcounties_df, fips_state, fips_county):
-    thecounty = ( (allcounties_df['fips_state'] == fips_state)
-                  & (allcounties_df['fips_county'] == fips_county) )
-    Nselected = len(allcounties_df[thecounty])
+    with pwpd_trace.stage('lookup'):
+        thecounty = ( (allcounties_df['fips_state'] == fips_state)
+                      & (allcounties_df['fips_county'] == fips_county) )
+        Nselected = len(allcounties_df[thecounty])
     if (Nselected != 1):
         print(f"\n***Error: For the requested FIPS = ({fips_state:d},{fips_county:d})")
         print(f"          {Nselected:d} counties were found.")
@@ -585,10 +686,15 @@ def get_UScounty_by_fips(allcounties_df, fips_state, fips_county):
     countylong = county['countylong'].to_list()[0]
     return (county, state, stateabb, countylong)
 
-def get_composite_pwds(df, countyshapes_df, composite_type, do_gamma=True):
+def get_composite_pwds(df, countyshapes_df, composite_type, do_gamma=True,
+                       sketches=None):
     """
     Get PWPD etc for composite counties,
     composite_type = ['state', 'composite-county', 'metro']
+
+    If sketches = {fips: density sketch} of the member counties is given
+    (see get_pwpd_UScounties), the density quantiles of each composite are
+    found by merging its counties' sketches.
     """
     # Make new copy of the dataframe
     #
@@ -638,19 +744,24 @@ def get_composite_pwds(df, countyshapes_df, composite_type, do_gamma=True):
             fips_lists.append(thefips)
     # Get composite shape for each list of FIPS, calculated the PWPD etc for
     # this region, and place the results in the row for the composite
+    import pwpd_progress
+    progress = pwpd_progress.Progress(len(fips), composite_type + " composites")
     for i in range(len(fips)):
         # Get name for output to user
         if (composite_type == 'state'):
             thename = df[df['fips'] == fips[i]]['state'].to_list()[0]            
         else:
             thename = df[df['fips'] == fips[i]]['county'].to_list()[0]
-        # merge the counties into one shape
-        comp_county = get_composite_UScounties_by_fips(countyshapes_df, fips_lists[i])
-        # Transform shapefile to coordinate system of population image        
-        comp_county_t = transform_shapefile(comp_county)
-        # Get population and population-weighted--population density of composite
-        (pop_orig, pwd_orig, pwlogpd_orig, imgshape, lat, lon) = \
-            get_pop_pwpd_pwlogpd(comp_county_t)
+        with pwpd_trace.region(f"{composite_type:s} {fips[i]:d}"):
+            # merge the counties into one shape
+            with pwpd_trace.stage('dissolve'):
+                comp_county = get_composite_UScounties_by_fips(countyshapes_df,
+                                                               fips_lists[i])
+            # Transform shapefile to coordinate system of population image
+            comp_county_t = transform_shapefile(comp_county)
+            # Get population and population-weighted--population density of composite
+            (pop_orig, pwd_orig, pwlogpd_orig, imgshape, lat, lon) = \
+                get_pop_pwpd_pwlogpd(comp_county_t)
         # Place output into new dataframe
         outputrow = (newdf['fips'] == fips[i])
         area = comp_county['landarea'].to_list()[0]
@@ -668,19 +779,18 @@ def get_composite_pwds(df, countyshapes_df, composite_type, do_gamma=True):
             newdf.loc[outputrow, 'gamma'] = \
                 get_gamma(pop_orig, area, pwd_orig,
                           popimage_type, popimage_resolution)
-        # Print result to user
-        print("=" * 80)
-        print(f"Using a {imgshape[0]:d}x{imgshape[1]:d} window of the "
-              + popimage_epoch + " " + popimage_type 
-              + " image with resolution " + popimage_resolution + "...\n")
-        print(composite_type + " " + thename 
-              + f", with FIPS = {fips[i]:d}, "
-              + f"has a population of {int(pop_orig):,d}.\n"
-              + f"The PWPD_{popimage_type:s}_{popimage_resolution:s}"
-              + f" is {pwd_orig:.1f} per km^2"
-              + f" and exp[ PWlogPD ] = {np.exp(pwlogpd_orig):.1f}\n"
-              + "The population centroid is at (lat, lon) = "
-              + f"({lat:0.2f}, {lon:0.2f})")
+        # Density quantiles from the merged county sketches
+        if sketches is not None:
+            import pwpd_sketch
+            comp_sketch = pwpd_sketch.merge_sketches(
+                [sketches[f] for f in fips_lists[i] if f in sketches])
+            for (col, val) in pwpd_sketch.get_sketch_summary(comp_sketch).items():
+                newdf.loc[outputrow, col] = val
+        # Report progress (and log the result)
+        progress.update(composite_type + " " + thename, fips=fips[i],
+                        pop=pop_orig, pwpd=pwd_orig, pwlogpd=pwlogpd_orig,
+                        window=imgshape, lat=lat, lon=lon)
+    progress.finish()
     return newdf
 
 def get_composite_UScounties_by_fips(allcounties_df, fips_list):                         
@@ -717,7 +827,9 @@ def get_UScounty_by_name(allcounties_df, stateabb, name_county):
 #        Population-weighted Density Calculation           #
 ############################################################
 
-def get_pwpd_UScounties(countyshapes_df, pwpd_counties_outfilepath, do_gamma=True):
+def get_pwpd_UScounties(countyshapes_df, pwpd_counties_outfilepath, do_gamma=True,
+                        do_quantiles=False, sketch_outfilepath=None,
+                        do_uncertainty=False):
     #=== Copy the county data from the shapefiles dataframe
     #
     #    columns = ['fips_state', 'fips_county', 'county',
@@ -725,25 +837,77 @@ def get_pwpd_UScounties(countyshapes_df, pwpd_counties_outfilepath, do_gamma=Tru
     #               'pop', 'pwpd', 'pwlogpd', 'popdens', 'gamma',
     #               'pop_centroid_lat', 'pop_centroid_lon']
     #
+    #    plus, if do_quantiles, the population-weighted density quantiles
+    #    and Gini coefficient (see pwpd_sketch.py):
+    #
+    #               'pd_p10', 'pd_median', 'pd_p90', 'pd_gini'
+    #
+    #    The density sketch of every county is kept (keyed by the 5-digit
+    #    FIPS code) and saved to sketch_outfilepath, if given, so that
+    #    get_composite_pwds can merge them.
+    #
+    #    plus, if do_uncertainty, the means and percentile intervals of the
+    #    pop, pwpd, pwlogpd (and gamma, if do_gamma) over Monte Carlo draws
+    #    of the pixel counts, shifted to the point values and seeded by the
+    #    FIPS code (see pwpd_uncertainty.py):
+    #
+    #               'pop_mean', 'pop_lo', 'pop_hi', 'pwpd_mean', ...
+    #
+    #    The table is saved after each state, as CSV or (if the filepath
+    #    ends with .parquet) as Parquet, one row group per state (see
+    #    pwpd_table.py).
+    #
     pwpd_counties = create_uscounties_dataframe(countyshapes_df)
+    sketches = {}
+    if do_quantiles:
+        import pwpd_sketch
+        for col in pwpd_sketch.get_sketch_summary_columns():
+            pwpd_counties[col] = 0.0
+    if do_uncertainty:
+        import pwpd_uncertainty
+        for col in pwpd_uncertainty.get_uncertainty_columns(do_gamma):
+            pwpd_counties[col] = 0.0
     # convert area to km^2 from m^2
     pwpd_counties['landarea'] = pwpd_counties['landarea']/1e6
-    #=== Make calculations for each county, output result to user, save csv
+    #=== Make calculations for each county, report progress, save table
+    import pwpd_progress
+    import pwpd_table
+    progress = pwpd_progress.Progress(len(pwpd_counties), "counties")
+    tablewriter = pwpd_table.TableWriter(pwpd_counties_outfilepath,
+                                         row_group_rows=1)
     prev_fips_state = 0
-    for index, row in pwpd_counties.iterrows():
+    for (i, (index, row)) in enumerate(pwpd_counties.iterrows()):
         fips_state = row['fips_state']
         fips_county = row['fips_county']
         area = row['landarea']
         name_countylong = row['countylong']
         name_state = row['state']
-        # get the shapefile for a county, along with its names
-        (county, name_state, stateabb, name_countylong) = \
-            get_UScounty_by_fips(countyshapes_df, fips_state, fips_county)
-        # Transform shapefile to coordinate system of population image
-        county_t = transform_shapefile(county)
-        # Get population and population-weighted--population density
-        (pop_orig, pwd_orig, pwlogpd_orig, imgshape, lat, lon) = \
-            get_pop_pwpd_pwlogpd(county_t)
+        with pwpd_trace.region(f"{fips_state:02d}{fips_county:03d}"):
+            # get the shapefile for a county, along with its names
+            (county, name_state, stateabb, name_countylong) = \
+                get_UScounty_by_fips(countyshapes_df, fips_state, fips_county)
+            # Transform shapefile to coordinate system of population image
+            county_t = transform_shapefile(county)
+            # Get population and population-weighted--population density
+            # (and fill the county's density sketch)
+            if do_quantiles:
+                sketch = pwpd_sketch.new_sketch()
+            else:
+                sketch = None
+            (pop_orig, pwd_orig, pwlogpd_orig, imgshape, lat, lon) = \
+                get_pop_pwpd_pwlogpd(county_t, sketch=sketch)
+            # Monte Carlo uncertainty of the above
+            if do_uncertainty:
+                uncertainty = pwpd_uncertainty.get_uncertainty(
+                    county_t, area=(area if do_gamma else None),
+                    key=int(f"{fips_state:02d}{fips_county:03d}"))
+        if do_uncertainty:
+            for (col, val) in uncertainty.items():
+                pwpd_counties.at[index, col] = val
+        if do_quantiles:
+            sketches[int(f"{fips_state:02d}{fips_county:03d}")] = sketch
+            for (col, val) in pwpd_sketch.get_sketch_summary(sketch).items():
+                pwpd_counties.at[index, col] = val
         pwpd_counties.at[index, 'pop'] = pop_orig
         pwpd_counties.at[index, 'pwpd'] = pwd_orig
         pwpd_counties.at[index, 'pwlogpd'] = pwlogpd_orig
@@ -757,38 +921,90 @@ def get_pwpd_UScounties(countyshapes_df, pwpd_counties_outfilepath, do_gamma=Tru
             pwpd_counties.at[index, 'gamma'] = \
                 get_gamma(pop_orig, area, pwd_orig,
                           popimage_type, popimage_resolution)
-        # Print result to user
-        print("=" * 80)
-        print(f"Using a {imgshape[0]:d}x{imgshape[1]:d} window of the "
-              + popimage_epoch + " " + popimage_type 
-              + " image with resolution " + popimage_resolution + "...\n")
-        print(name_countylong + " in " + name_state
-              + f", with FIPS = ({fips_state:d}, {fips_county:d}), "
-              + f"has a population of {int(pop_orig):,d}.\n"
-              + f"The PWPD_{popimage_type:s}_{popimage_resolution:s}"
-              + f" is {pwd_orig:.1f} per km^2"
-              + f" and exp[ PWlogPD ] = {np.exp(pwlogpd_orig):.1f}\n"
-              + "The population centroid is at (lat, lon) = "
-              + f"({lat:0.2f}, {lon:0.2f})")
-        # Save to csv file after each state
+        # Report progress (and log the result)
+        progress.update(name_countylong + ", " + stateabb,
+                        fips=f"{fips_state:02d}{fips_county:03d}",
+                        pop=pop_orig, pwpd=pwd_orig, pwlogpd=pwlogpd_orig,
+                        window=imgshape, lat=lat, lon=lon)
+        # Save to file after each state (the counties before this one)
         if (fips_state != prev_fips_state):
-            pwpd_counties.to_csv(pwpd_counties_outfilepath, index=False)
+            save_pwpd_UScounties(pwpd_counties, tablewriter,
+                                 sketches, sketch_outfilepath, Ndone=i)
         prev_fips_state = fips_state
+    progress.finish()
+    save_pwpd_UScounties(pwpd_counties, tablewriter,
+                         sketches, sketch_outfilepath)
+    tablewriter.close()
     return pwpd_counties
 
-def get_pop_pwpd_pwlogpd(window_df):
-    # get windowed subimage(s) of population/popdensity rasters
+def save_pwpd_UScounties(pwpd_counties, tablewriter,
+                         sketches, sketch_outfilepath, Ndone=None):
+    with pwpd_trace.stage('write_table'):
+        tablewriter.write(pwpd_counties, Ndone=Ndone)
+    if (bool(sketches) & (sketch_outfilepath is not None)):
+        import pwpd_sketch
+        with pwpd_trace.stage('write_sketches'):
+            pwpd_sketch.save_sketches(sketches, sketch_outfilepath)
+
+def get_pop_pwpd_pwlogpd(window_df, sketch=None, progressive=False):
+    """
+    Population, PWPD, PWlogPD, window shape and population centroid for
+    the region(s) in window_df.  If a density sketch (see pwpd_sketch.py)
+    is given, the region's pixels are also added to it.  With progressive,
+    a generator of ever better estimates of the pop, PWPD and PWlogPD,
+    with bounds, is returned instead (see pwpd_progressive.py).  If
+    region_Nworkers is set (and there is no sketch), large windows are
+    split into row strips reduced on that many processes (see
+    pwpd_schedule.py).
+    """
+    if progressive:
+        import pwpd_progressive
+        return pwpd_progressive.get_progressive_estimates(window_df)
+    if ( (region_Nworkers is not None) & (sketch is None) ):
+        import pwpd_schedule
+        return pwpd_schedule.get_parallel_pop_pwpd_pwlogpd(window_df,
+                                                           region_Nworkers)
+    # get windowed subimage(s) of population/popdensity rasters (with the
+    # fraction of each pixel in the region, if coverage_weighting)
     if (popimage_type == 'GHS'):
         popimg, popimg_transform = \
-            get_windowed_subimage(window_df, GHS_filepath)
-        totalpop, pwd, pwlogpd, pc_row, pc_col = \
-            get_pwpd_from_count(popimg)
+            get_windowed_subimage(window_df, GHS_filepath,
+                                  all_touched=coverage_weighting)
+        coverage = get_region_coverage(window_df, popimg, popimg_transform)
+        with pwpd_trace.stage('reduce'):
+            totalpop, pwd, pwlogpd, pc_row, pc_col = \
+                get_pwpd_from_count(popimg, img_transform=popimg_transform,
+                                    coverage=coverage)
+        if sketch is not None:
+            import pwpd_sketch
+            with pwpd_trace.stage('sketch'):
+                # (without the hot pixels removed from the sums above)
+                hot = None
+                if hot_pixels is not None:
+                    import pwpd_hotpixels
+                    hot = pwpd_hotpixels.get_hot_pixel_mask(popimg,
+                                                            popimg_transform)
+                pwpd_sketch.add_image_to_sketch(
+                    sketch, popimg, Acell_in_kmsqd=GHS_Acell_in_kmsqd,
+                    coverage=coverage, exclude=hot)
     elif (popimage_type == 'GPW'):
         popimg, popimg_transform = \
-            get_windowed_subimage(window_df, GPW_popcount_filepath)
+            get_windowed_subimage(window_df, GPW_popcount_filepath,
+                                  all_touched=coverage_weighting)
         pdimg, pdimg_transform = \
-            get_windowed_subimage(window_df, GPW_popdensity_filepath)
-        totalpop, pwd, pwlogpd, pc_row, pc_col = get_pwpd_from_count_and_density(popimg, pdimg)
+            get_windowed_subimage(window_df, GPW_popdensity_filepath,
+                                  all_touched=coverage_weighting)
+        coverage = get_region_coverage(window_df, popimg, popimg_transform)
+        with pwpd_trace.stage('reduce'):
+            totalpop, pwd, pwlogpd, pc_row, pc_col = \
+                get_pwpd_from_count_and_density(popimg, pdimg,
+                                                img_transform=popimg_transform,
+                                                coverage=coverage)
+        if sketch is not None:
+            import pwpd_sketch
+            with pwpd_trace.stage('sketch'):
+                pwpd_sketch.add_image_to_sketch(sketch, popimg, pdimg=pdimg,
+                                                coverage=coverage)
     else:
         print("\n***Error: Population image type unknown/unset")
         exit(0)
@@ -822,65 +1038,154 @@ def get_gamma(pop, area, pwpd, popimage_type, popimage_resolution_string):
     return ( ( np.log(pwpd) - np.log(pop/area) ) \
              / (np.log(area) - np.log(areascale)) )
 
-def get_pwpd_from_count(img, nparr=False):
-    if (nparr == True):
-        arr=img
-    else:
-        arr = np.array(img)
-        # set (negative) no data values to zero
-        arr[arr < 0.0] = 0.0
-    # First flatten the array and remove zero-valued elements
-    farr = arr.flatten()
-    selected = (farr > 0)
-    farr = farr[selected]
-    # total population is sum of population in each pixel
-    totalpop = np.sum(farr)
+#--- Population centroid from the 3D unit-vector moments of the pixels
+#    on the sphere, sum p*(cos(lat)cos(lon), cos(lat)sin(lon), sin(lat)),
+#    instead of the moments in the image plane.  This is correct for
+#    regions near the poles or straddling the antimeridian, but needs the
+#    lat/lon of every populated pixel.
+pop_centroid_on_sphere = False
+
+#--- Number of image rows reduced at a time (bounds the temporaries)
+reduction_block_rows = 256
+
+#--- Split the window of a large region into row strips that are masked,
+#    read and reduced on this many worker processes, and add their sums
+#    (see pwpd_schedule.py), or None for the single window
+region_Nworkers = None
+
+#--- Weight each pixel by the fraction of its area in the region (exact,
+#    see pwpd_coverage.py), instead of counting the pixels with their
+#    centers in the region.  For small regions on coarse images.
+coverage_weighting = False
+
+#  The global layer of the GHS-POP image's largest pixels, if one is
+#  loaded, with which every region is cleaned of its hot pixels (see
+#  pwpd_hotpixels.py)
+hot_pixels = None
+
+def get_region_coverage(window_df, img, img_transform):
+    """Coverage of the pixels of a window by its region(s), or None if
+    not coverage_weighting"""
+    if not coverage_weighting:
+        return None
+    import pwpd_coverage
+    return pwpd_coverage.get_coverage(window_df["geometry"], img.shape,
+                                      img_transform)
+
+def get_centroid_moments(pop, rows, cols, img_transform=None):
+    """Population moments of the pixels, for the centroid: either
+    (sum p*row, sum p*col) or, with pop_centroid_on_sphere and the image
+    transform given, the 3D unit-vector moments"""
+    if ( pop_centroid_on_sphere & (img_transform is not None) ):
+        (lat, lon) = get_pixel_latlon(rows, cols, img_transform)
+        (lat, lon) = (np.radians(lat), np.radians(lon))
+        coslat = np.cos(lat)
+        return np.array([np.dot(pop, coslat*np.cos(lon)),
+                         np.dot(pop, coslat*np.sin(lon)),
+                         np.dot(pop, np.sin(lat))])
+    return np.array([np.dot(pop, rows), np.dot(pop, cols)])
+
+def get_pop_centroid(moments, totalpop, img_transform=None):
+    """
+    Population centroid, as a (fractional) (row, col) position in the
+    image.  The centroid is found in the image plane or, with
+    pop_centroid_on_sphere and the image transform given, on the sphere
+    (and then placed back in the image).
+    """
+    if (totalpop <= 0):
+        return (np.nan, np.nan)
+    if (len(moments) == 3):
+        (X, Y, Z) = moments
+        lat_c = np.degrees(np.arctan2(Z, np.hypot(X, Y)))
+        lon_c = np.degrees(np.arctan2(Y, X))
+        return latlon_to_pixel(lat_c, lon_c, img_transform)
+    return (moments[0]/totalpop, moments[1]/totalpop)
+
+def get_fused_sums(pcimg, pdimg=None, Acell_in_kmsqd=None,
+                   img_transform=None, coverage=None):
+    """
+    Single pass, reduction_block_rows rows at a time, over a population
+    image and either the pixel area (GHS) or the population density image
+    (GPW), returning
+
+        (sum p, sum p*d, sum p*log(d), centroid moments)
+
+    over the populated (p > 0) pixels, where d is the pixel density.  The
+    images (float32 or float64, with negative no data values) are not
+    copied; only the populated pixels of one block are gathered, and the
+    sums are accumulated in float64.  If the coverage of each pixel by
+    the region is given, p is weighted by it (d is not).
+    """
+    S1 = 0.0
+    S2 = 0.0
+    SL = 0.0
+    moments = 0.0
+    Ncols = pcimg.shape[1]
+    for r in range(0, pcimg.shape[0], reduction_block_rows):
+        pblock = np.asarray(pcimg[r:r+reduction_block_rows])
+        index = np.flatnonzero(pblock > 0)
+        pop = pblock.ravel()[index].astype(np.float64)
+        if pdimg is None:
+            density = pop / Acell_in_kmsqd
+        else:
+            dblock = np.asarray(pdimg[r:r+reduction_block_rows])
+            density = dblock.ravel()[index].astype(np.float64)
+        if coverage is not None:
+            # the population of the part of the pixel in the region
+            cblock = np.asarray(coverage[r:r+reduction_block_rows])
+            pop = pop * cblock.ravel()[index]
+        S1 += np.sum(pop)
+        S2 += np.dot(pop, density)
+        SL += np.dot(pop, np.log(density))
+        (rows, cols) = np.divmod(index, Ncols)
+        moments = moments + get_centroid_moments(pop, rows + r, cols,
+                                                 img_transform)
+    return (S1, S2, SL, moments)
+
+def get_pwpd_from_count(img, nparr=False, img_transform=None, coverage=None,
+                        clean_hot_pixels=True):
+    # (the image is reduced in place, so nparr no longer matters)
+    if (popimage_type == 'GPW'):
+        print("\n***Error: GPW not yet set up to measure areas...")
+        exit(0)
+    (totalpop, S2, SL, moments) = \
+        get_fused_sums(img, Acell_in_kmsqd=GHS_Acell_in_kmsqd,
+                       img_transform=img_transform, coverage=coverage)
+    if ( (hot_pixels is not None) & (img_transform is not None)
+         & clean_hot_pixels ):
+        import pwpd_hotpixels
+        (totalpop, S2, SL, moments) = pwpd_hotpixels.get_cleaned_sums(
+            (totalpop, S2, SL, moments), img, img_transform, coverage)
     if (totalpop > 0):
-        if (popimage_type == 'GHS'):
-            # calculate population-weighted population density
-            pwd = np.sum(np.multiply(farr / GHS_Acell_in_kmsqd, farr)) / totalpop
-            # calculate the pop-weighted log(popdensity)
-            pwlogpd = \
-                np.sum( np.multiply( np.log(farr/GHS_Acell_in_kmsqd), farr)) \
-                / totalpop 
-        elif (popimage_type == 'GPW'):
-            print("\n***Error: GPW not yet set up to measure areas...")
-            exit(0)
+        # population-weighted population density
+        pwd = S2 / totalpop
+        # pop-weighted log(popdensity)
+        pwlogpd = SL / totalpop
     else:
         pwd = 0.0
         pwlogpd = 0.0
     # Find the population centroid ("center of mass")
-    (pc_row, pc_col) = spndi.measurements.center_of_mass(arr)
+    (pc_row, pc_col) = get_pop_centroid(moments, totalpop, img_transform)
     return (totalpop, pwd, pwlogpd, pc_row, pc_col)
 
-def get_pwpd_from_count_and_density(pcimg, pdimg):
+def get_pwpd_from_count_and_density(pcimg, pdimg, img_transform=None,
+                                    coverage=None):
     if (popimage_type == 'GHS'):
         print("\n***Error: GHS has no population density image...")
         exit(0)
-    pcarr = np.array(pcimg)
-    pdarr = np.array(pdimg)
-    # Set (negative) no data values to zero
-    pcarr[pcarr < 0.0] = 0.0
-    # Flatten the arrays and remove zero-pop elements
-    fpcarr = pcarr.flatten()
-    fpdarr = pdarr.flatten()
-    selected = (fpcarr > 0)
-    fpcarr = fpcarr[selected]
-    fpdarr = fpdarr[selected]
-    # total population is sum of population in each pixel
-    totalpop = np.sum(fpcarr)
+    (totalpop, S2, SL, moments) = \
+        get_fused_sums(pcimg, pdimg=pdimg, img_transform=img_transform,
+                       coverage=coverage)
     if (totalpop > 0):
-        # calculate population-weighted population density
-        pwd = np.sum(np.multiply(fpdarr, fpcarr)) / totalpop
-        # calculate the pop-weighted log(popdensity)
-        pwlogpd = \
-            np.sum( np.multiply( np.log(fpdarr), fpcarr) ) \
-            / totalpop
+        # population-weighted population density
+        pwd = S2 / totalpop
+        # pop-weighted log(popdensity)
+        pwlogpd = SL / totalpop
     else:
         pwd = 0.0
         pwlogpd = 0.0 
     # Find the population centroid ("center of mass")
-    (pc_row, pc_col) = spndi.measurements.center_of_mass(pcarr)
+    (pc_row, pc_col) = get_pop_centroid(moments, totalpop, img_transform)
     return (totalpop, pwd, pwlogpd, pc_row, pc_col)
 
 def GHS_pixels_to_coordinates(xpix, ypix, img_shape, img_transform,
@@ -905,195 +1210,99 @@ def GHS_pixels_to_coordinates(xpix, ypix, img_shape, img_transform,
     # I should try to figure this out sometime, but can't now.
     return (xgeo, ygeo)
 
+# pyproj transformers are expensive to build, so keep one per CRS pair
+transformers = {}
+
+def get_transformer(from_crs, to_crs):
+    import pyproj
+    key = (from_crs, to_crs)
+    if key not in transformers:
+        transformers[key] = pyproj.Transformer.from_crs(from_crs, to_crs)
+    return transformers[key]
+
 def transform_mollweide_to_latlon(x, y):
     # Transform Mollweide (esri:54009) to LatLong coordinates (epsg:4326)
     #  <copied in from metrocounties.py>
-    transformer = pyproj.Transformer.from_crs('esri:54009', 'epsg:4326')
+    transformer = get_transformer('esri:54009', 'epsg:4326')
     lat, lon = transformer.transform(x, y)
     return (lat, lon)
 
 def transform_NAD83_to_WGS84(x, y):
     # Transform between the two Geographic (Lat/Lon) Coordinate systems:
     #      NAD83 (epsg:4269) to WSG84 (epsg:4326)
-    transformer = pyproj.Transformer.from_crs('epsg:4269', 'epsg:4326')
+    transformer = get_transformer('epsg:4269', 'epsg:4326')
     lat, lon = transformer.transform(x, y)
     return (lat, lon)
 
-def get_latlon(xpix, ypix, img_shape, img_transform):
-    (xgeo, ygeo) = GHS_pixels_to_coordinates(xpix, ypix,
-                                             img_shape, img_transform)
-    (lat, lon) = transform_mollweide_to_latlon(xgeo, ygeo)
-    return (lat, lon)
+def get_image_crs():
+    """Coordinates of the population image"""
+    if (popimage_type == 'GHS'):
+        return GHS_coordinates
+    elif (popimage_type == 'GPW'):
+        return GPW_coordinates
+    else:
+        print("\n***Error: Population image coordinates unknown/undefined.")
+        exit(0)
 
-############################################################
-#    Image cleaning subroutines (only for GHS-POP images)  #
-############################################################
+crs_is_geographic = {}
 
-def count_nonzero_neighbors(arr, r, c, rows, cols):
-    if ( (r==0) | (r==(rows-1))  | (c==0) | (c==(cols-1)) ):
-        print(f"***Warning: edge pixel at ({r:d},{c:d}) not checked, but deleted.")
-        return 0
-    rr = [r-1, r-1, r-1, r, r, r+1, r+1, r+1]
-    cc = [c-1, c, c+1, c-1, c+1, c-1, c, c+1]
-    count = 0
-    for rrr,ccc in zip(rr,cc):
-        if (arr[rrr,ccc] > 0):
-            count += 1
-    return count
-    
-def get_cleaned_pwpd(window_df, Nclean, Ncheck, maxNzero, Nmaxpix):
-    # only do this for GHS-POP images
-    if (popimage_type == 'GPW'):
-        print("\n***Error: Not currently set up to do cleaning of GPW images.")
-        exit(0)
-    # Get windowed subimage(s) of population raster
-    popimg, popimg_transform = \
-        get_windowed_subimage(window_df, GHS_filepath)
-    arr = np.array(popimg)
-    (rows,cols) = arr.shape
-    # set no data valued (negative) pixels to zero
-    arr[arr < 0.0] = 0.0
-    # make new copy of image for cleaning
-    cl_arr = arr.copy()
-    # and another one for for checking (will delete max each check)
-    ch_arr = arr.copy()    
-    Ncleaned = 0
-    Nchecked = 0
-    totalpop = []; pwd = []; pwlogpd = []; lat = []; lon = []
-    checked = []; zeros = []
-    while ( (Ncleaned < Nclean) & (Nchecked < Ncheck) ):
-        Nchecked += 1
-        # find max-valued pixel in checked image and zero out that pixel
-        (y,x) = np.unravel_index(np.argmax(ch_arr, axis=None), arr.shape)
-        ch_arr[y,x] = 0.0
-        # but check for neighbors in uncleaned image
-        nonzeropix = count_nonzero_neighbors(arr, y, x, rows, cols)
-        if ((8-nonzeropix) > maxNzero):
-            Ncleaned += 1
-            # zero out that pixel in the cleaned image
-            cl_arr[y,x] = 0.0
-            # get the latitude and longitude of the pixel
-            (la, lo) = get_latlon(x, y, popimg.shape, popimg_transform)
-            lat.append(la); lon.append(lo)
-            # calculate pwpd etc from cleaned image
-            (p, pw, pl, px, py) = get_pwpd_from_count(cl_arr, nparr=True)
-            totalpop.append(p); pwd.append(pw); pwlogpd.append(pl)
-            checked.append(Nchecked); zeros.append(8-nonzeropix)
-    # After cleaning, find the new max pixels
-    maxpix = []
-    for i in np.arange(Nmaxpix):
-        (y,x) = np.unravel_index(np.argmax(arr, axis=None), arr.shape)
-        arr[y,x] = 0.0
-        (la, lo) = get_latlon(x, y, popimg.shape, popimg_transform)
-        maxpix.append((la,lo))
-    return (checked, zeros, totalpop, pwd, pwlogpd, lat, lon, maxpix)
-
-def get_cleaned_pwpd_force(window_df, Npixels, Nmaxpix):
-    # only do this for GHS-POP images
-    if (popimage_type == 'GPW'):
-        print("\n***Error: Not currently set up to do cleaning of GPW images.")
-        exit(0)
-    # Get windowed subimage(s) of population raster
-    popimg, popimg_transform = \
-        get_windowed_subimage(window_df, GHS_filepath)
-    arr = np.array(popimg)
-    # set no data valued (negative) pixels to zero    
-    arr[arr < 0.0] = 0.0
-    # make new copy of image for cleaning    
-    for i in np.arange(Npixels):
-        (y,x) = np.unravel_index(np.argmax(arr, axis=None), arr.shape)
-        arr[y,x] = 0.0
-    # After cleaning, find the new max pixels
-    maxpix = []
-    for i in np.arange(Nmaxpix):
-        (y,x) = np.unravel_index(np.argmax(arr, axis=None), arr.shape)
-        arr[y,x] = 0.0
-        (la, lo) = get_latlon(x, y, popimg.shape, popimg_transform)
-        maxpix.append((la,lo))
-    return (maxpix, arr)
+def is_geographic(crs):
+    if crs not in crs_is_geographic:
+        import pyproj
+        crs_is_geographic[crs] = pyproj.CRS(crs).is_geographic
+    return crs_is_geographic[crs]
 
-############################################################
-#        Sorting the Image  (only for GHS-POP images)      #
-############################################################
+def get_pixel_latlon(rows, cols, img_transform):
+    """Lat/lon of the centers of the pixels (rows, cols) of an image with
+    the given transform, in the coordinates of the population image"""
+    (xgeo, ygeo) = img_transform * (np.asarray(cols) + 0.5,
+                                    np.asarray(rows) + 0.5)
+    crs = get_image_crs()
+    if is_geographic(crs):
+        # (lon, lat), with lon wrapped to [-180, 180)
+        return (ygeo, (xgeo + 180.0) % 360.0 - 180.0)
+    transformer = get_transformer(crs, 'epsg:4326')
+    (lat, lon) = transformer.transform(xgeo, ygeo)
+    return (lat, lon)
 
-def flatten_and_sort_image(img):
-    # First record the (row,col) values in arrays
-    arr = np.array(img)
-    (rows,cols) = arr.shape
-    grid = np.indices((rows,cols))
-    farr = arr.flatten()
-    farr_r = grid[0].flatten()
-    farr_c = grid[1].flatten()
-    # Then delete all nonpositive values in the flattened array
-    selected = (farr > 0)
-    farr = farr[selected]
-    farr_r = farr_r[selected]
-    farr_c = farr_c[selected]
-    # Then sort the remaining values
-    sortind = np.flip(farr.argsort())
-    # return the flattened array, sorted from max to min,
-    # along with the corresponding row and column labels
-    return farr[sortind], farr_r[sortind], farr_c[sortind]
-
-def get_sorted_imarray(window_df, sort_Ntop, printout=True):
-    # Get windowed subimage
-    if (popimage_type == 'GHS'):
-        img, img_transform = \
-            get_windowed_subimage(window_df, GHS_filepath)
-    elif (popimage_type == 'GPW'):
-        print("\n***Error: Not currently set up to do sorting for GPW images.")
-        exit(0)
-    # Set no data valued (negative) pixels to zero    
-    arr = np.array(img)
-    arr[arr < 0.0] = 0.0
-    (rows,cols) = arr.shape
-    # Get a flattened and sorted array
-    print("\tFlattening and sorting the array...")
-    farr, farr_r, farr_c = flatten_and_sort_image(img)
-    sorted_df = pd.DataFrame({'pixpop': farr[0:sort_Ntop],
-                              'r': farr_r[0:sort_Ntop],
-                              'c': farr_c[0:sort_Ntop]})
-    sorted_df['NnonzeroN'] = 0
-    sorted_df['lat'] = 0.0
-    sorted_df['lon'] = 0.0
-    count = 0
-    print(f"\tGetting neighbors and positions of top {sort_Ntop:d} pixels...")
-    print("\t\tStarted: ", datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
-    for index, row in sorted_df.iterrows():
-        x = int(row.c)
-        y = int(row.r)
-        (la, lo) = get_latlon(x, y, img.shape, img_transform)
-        sorted_df.at[index,'lat'] = la
-        sorted_df.at[index,'lon'] = lo
-        nonzeropix = count_nonzero_neighbors(arr, y, x, rows, cols)
-        sorted_df.at[index,'NnonzeroN'] = nonzeropix
-        if printout:
-            print(f"{count:d}   ({x:d},{y:d}) {row.pixpop:.1f} {nonzeropix:d} ({la:.3f},{lo:.3f})")
-        count += 1
-    print("\t\tEnded:   ", datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'))    
-    return sorted_df
-
-def plot_sorted(sorted_df, outfile):
-    # only do this for GHS-POP images
-    if (popimage_type == 'GPW'):
-        print("\n***Error: Not currently set up to do sorting of GPW images.")
-        exit(0)
-    # First make a 10-point average of the NnonzeroN
-    sorted_df['NnonzeroN_avg'] = sorted_df['NnonzeroN'].rolling(10).mean()
-    # Then make plots of NnonzeroN_avg and pixpop
-    fig, (ax1,ax2) = plt.subplots(nrows=2, ncols=1, sharex=True, figsize=(6,8))
-    nonzero = sorted_df['NnonzeroN_avg'].to_numpy()
-    pixpop = sorted_df['pixpop'].to_numpy()
-    ax1.plot(nonzero)
-    ax1.set_ylabel("Nonzero neighbors")
-    ax1.set_ylim([0,9])
-    ax2.plot(pixpop)
-    ax2.set_ylabel("Pixel population")
-    ax2.set_xlabel("Pixel rank")
-    plt.tight_layout()
-    plt.savefig(outfile)
+def latlon_to_pixel(lat, lon, img_transform):
+    """Inverse of get_pixel_latlon: (fractional) (row, col) of a lat/lon"""
+    crs = get_image_crs()
+    if is_geographic(crs):
+        (xgeo, ygeo) = (lon, lat)
+    else:
+        transformer = get_transformer('epsg:4326', crs)
+        (xgeo, ygeo) = transformer.transform(lat, lon)
+    (col, row) = ~img_transform * (xgeo, ygeo)
+    return (row - 0.5, col - 0.5)
+
+def get_latlon(xpix, ypix, img_shape, img_transform):
+    """Lat/lon of the center of the pixel at column xpix and row ypix
+    (e.g., the population centroid from get_pwpd_from_count)"""
+    return get_pixel_latlon(ypix, xpix, img_transform)
 
 ############################################################
-#                     Mapping Methods                      #
+#                Lazily-loaded submodules                  #
 ############################################################
+#
+# The image cleaning/sorting methods (pwpd_cleaning.py) and the plotting
+# methods (pwpd_plotting.py, which needs matplotlib) are kept out of this
+# module so that "import pwpd" stays cheap for the one-shot helper scripts.
+# They are still reachable as pwpd.<name>; the submodule is imported the
+# first time one of its methods is requested.
+#
+lazy_submodule_attrs = {
+    'count_nonzero_neighbors': 'pwpd_cleaning',
+    'get_cleaned_pwpd': 'pwpd_cleaning',
+    'get_cleaned_pwpd_force': 'pwpd_cleaning',
+    'get_cleaning_sweep': 'pwpd_cleaning',
+    'flatten_and_sort_image': 'pwpd_cleaning',
+    'get_sorted_imarray': 'pwpd_cleaning',
+    'plot_sorted': 'pwpd_plotting',
+}
 
+def __getattr__(name):
+    if name in lazy_submodule_attrs:
+        submodule = importlib.import_module(lazy_submodule_attrs[name])
+        return getattr(submodule, name)
+    raise AttributeError(f"module 'pwpd' has no attribute '{name}'")
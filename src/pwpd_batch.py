@@ -0,0 +1,187 @@
+# Use the pwpd.yml conda environment
+#
+# Asyncio batch API for scoring many polygons (e.g., candidate service
+# areas, buffers or isochrones) against the population image.
+#
+# For each geometry, the masked read (pwpd.get_masked_subimage) runs on a
+# thread pool, where rasterio releases the GIL while decompressing, and
+# the reduction (pwpd.get_pwpd_from_count or
+# pwpd.get_pwpd_from_count_and_density) runs on a process pool.  At most
+# max_concurrency geometries are in flight at once, which bounds memory,
+# and results are yielded as they complete (not in input order):
+#
+#     import asyncio, pwpd, pwpd_batch
+#     pwpd.set_popimage_pars('GHS', '2015', '1km')
+#
+#     async def main(geoms):
+#         async for (i, result) in pwpd_batch.score_geometries(geoms):
+#             if result is not None:
+#                 (pop, pwd, pwlogpd, imgshape, lat, lon) = result
+#                 ...
+#     asyncio.run(main(geoms))
+#
+# or, to collect everything into a dataframe (in input order):
+#
+#     df = pwpd_batch.get_pwpd_for_geometries(geoms)
+#
+import os
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import numpy as np
+import pwpd
+
+def init_reduction_worker(popimtype, epoch, lengthstring,
+                          pop_centroid_on_sphere=False,
+                          coverage_weighting=False, blockcache_spec=None,
+                          hotpixel_filepath=None):
+    """Give each reduction process the parent's population image settings
+    (and attach it to the parent's shared block cache, and load its
+    hot-pixel layer, if any)"""
+    pwpd.set_popimage_pars(popimtype, epoch, lengthstring)
+    pwpd.pop_centroid_on_sphere = pop_centroid_on_sphere
+    pwpd.coverage_weighting = coverage_weighting
+    # (the workers do not split regions over pools of their own)
+    pwpd.region_Nworkers = None
+    if blockcache_spec is not None:
+        import pwpd_blockcache
+        pwpd_blockcache.attach(blockcache_spec)
+    if hotpixel_filepath is not None:
+        import pwpd_hotpixels
+        pwpd_hotpixels.load_hotpixel_layer(hotpixel_filepath)
+
+def read_geometry(geom):
+    """Masked read(s) of the population image(s) for a single geometry
+    (keeping one set of open raster handles per read thread), and the
+    coverage of its pixels (if pwpd.coverage_weighting)"""
+    if (pwpd.popimage_type == 'GHS'):
+        popimg, popimg_transform = pwpd.get_masked_subimage(
+            [geom], pwpd.GHS_filepath, all_touched=pwpd.coverage_weighting,
+            keep_open=True)
+        pdimg = None
+    elif (pwpd.popimage_type == 'GPW'):
+        popimg, popimg_transform = pwpd.get_masked_subimage(
+            [geom], pwpd.GPW_popcount_filepath,
+            all_touched=pwpd.coverage_weighting, keep_open=True)
+        pdimg, pdimg_transform = pwpd.get_masked_subimage(
+            [geom], pwpd.GPW_popdensity_filepath,
+            all_touched=pwpd.coverage_weighting, keep_open=True)
+    else:
+        print("\n***Error: Population image type unknown/unset")
+        exit(0)
+    coverage = pwpd.get_region_coverage({'geometry': [geom]}, popimg,
+                                        popimg_transform)
+    return (popimg, pdimg, popimg_transform, coverage)
+
+def reduce_images(popimg, pdimg, img_transform=None, coverage=None):
+    if pdimg is None:
+        return pwpd.get_pwpd_from_count(popimg, img_transform=img_transform,
+                                        coverage=coverage)
+    else:
+        return pwpd.get_pwpd_from_count_and_density(
+            popimg, pdimg, img_transform=img_transform, coverage=coverage)
+
+def get_geometry_transformer(crs):
+    """Function mapping (x, y) in crs to the population image coordinates"""
+    if (pwpd.popimage_type == 'GHS'):
+        image_crs = pwpd.GHS_coordinates
+    else:
+        image_crs = pwpd.GPW_coordinates
+    import pyproj
+    transformer = pyproj.Transformer.from_crs(crs, image_crs, always_xy=True)
+    return transformer.transform
+
+async def score_geometries(geometries, crs=None, max_concurrency=32,
+                           Nthreads=8, Nprocs=None):
+    """
+    Asynchronously yield (index, result) for each geometry, as completed.
+
+    geometries = iterable of shapely (Multi)Polygons, in the coordinates
+                 of the population image unless crs is given (e.g.,
+                 crs='epsg:4326' for lat/lon)
+    result     = (totalpop, pwpd, pwlogpd, imgshape, lat, lon), as returned
+                 by pwpd.get_pop_pwpd_pwlogpd, or None if the geometry
+                 could not be scored (e.g., it does not overlap the image)
+    Nprocs     = number of reduction processes (default: number of CPUs);
+                 with Nprocs=0 the reductions run on the read threads
+    """
+    import shapely.ops
+    if crs is not None:
+        to_image_coords = get_geometry_transformer(crs)
+    if Nprocs is None:
+        Nprocs = os.cpu_count()
+    loop = asyncio.get_running_loop()
+    threads = ThreadPoolExecutor(max_workers=Nthreads)
+    if (Nprocs > 0):
+        import pwpd_blockcache
+        import pwpd_hotpixels
+        procs = ProcessPoolExecutor(
+            max_workers=Nprocs, initializer=init_reduction_worker,
+            initargs=(pwpd.popimage_type, pwpd.popimage_epoch,
+                      pwpd.popimage_resolution, pwpd.pop_centroid_on_sphere,
+                      pwpd.coverage_weighting, pwpd_blockcache.get_spec(),
+                      pwpd_hotpixels.get_layer_filepath()))
+    else:
+        procs = threads
+
+    async def score_one(index, geom):
+        try:
+            if crs is not None:
+                geom = shapely.ops.transform(to_image_coords, geom)
+            (popimg, pdimg, popimg_transform, coverage) = \
+                await loop.run_in_executor(threads, read_geometry, geom)
+            (totalpop, pwd, pwlogpd, pc_row, pc_col) = \
+                await loop.run_in_executor(procs, reduce_images, popimg, pdimg,
+                                           popimg_transform, coverage)
+            (lat, lon) = pwpd.get_latlon(pc_col, pc_row, popimg.shape,
+                                         popimg_transform)
+            return (index, (totalpop, pwd, pwlogpd, popimg.shape, lat, lon))
+        except (ValueError, SystemExit) as e:
+            print(f"***Warning: geometry {index:d} could not be scored ({e})")
+            return (index, None)
+
+    try:
+        geometry_iter = enumerate(geometries)
+        exhausted = False
+        pending = set()
+        while True:
+            # keep up to max_concurrency geometries in flight
+            while ( (not exhausted) & (len(pending) < max_concurrency) ):
+                try:
+                    (index, geom) = next(geometry_iter)
+                except StopIteration:
+                    exhausted = True
+                    break
+                pending.add(asyncio.ensure_future(score_one(index, geom)))
+            if not pending:
+                break
+            (done, pending) = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield task.result()
+    finally:
+        threads.shutdown(wait=True)
+        if (Nprocs > 0):
+            procs.shutdown(wait=True)
+
+def get_pwpd_for_geometries(geometries, crs=None, max_concurrency=32,
+                            Nthreads=8, Nprocs=None):
+    """Score all geometries and return a dataframe in input order, with
+    columns = [pop, pwpd, pwlogpd, pop_centroid_lat, pop_centroid_lon]"""
+    import pandas as pd
+    rows = {}
+
+    async def collect():
+        async for (index, result) in score_geometries(
+                geometries, crs=crs, max_concurrency=max_concurrency,
+                Nthreads=Nthreads, Nprocs=Nprocs):
+            if result is None:
+                rows[index] = (np.nan, np.nan, np.nan, np.nan, np.nan)
+            else:
+                (pop, pwd, pwlogpd, imgshape, lat, lon) = result
+                rows[index] = (pop, pwd, pwlogpd, lat, lon)
+
+    asyncio.run(collect())
+    index = sorted(rows)
+    return pd.DataFrame([rows[i] for i in index], index=index,
+                        columns=['pop', 'pwpd', 'pwlogpd',
+                                 'pop_centroid_lat', 'pop_centroid_lon'])
@@ -0,0 +1,333 @@
+# Use the pwpd.yml conda environment
+#
+# Block cache shared by the worker processes of a run.
+#
+# When the county or country loops run on a pool of processes (see
+# pwpd_batch.py and pwpd_schedule.py), each worker decompresses the
+# GeoTIFF blocks of its own regions and keeps them in its own GDAL cache,
+# so neighbouring regions on different workers decode the same blocks
+# again, and the memory of the caches grows with the number of workers.
+# A BlockCache is a fixed arena in multiprocessing.shared_memory of slots
+# of one (decoded) block each, keyed by (file, block row, block col):
+#
+#     cache = pwpd_blockcache.create()      # in the parent, before the pool
+#     ...                                   # the workers attach to it
+#     pwpd_blockcache.print_summary()
+#     pwpd_blockcache.close()
+#
+# While a cache is attached, pwpd.get_masked_subimage assembles the window
+# of a region from the blocks in the cache (decoding, once for all of the
+# workers, only the blocks that are missing) and masks it as
+# rasterio.mask.mask does.  The blocks are copied straight from the shared
+# arena into the window, with no decode and no copy between processes.
+#
+# The cache is set-associative: a block can only go in one of the
+# blockcache_ways slots of its set, and replaces the least recently used
+# one that no worker is reading.  A single lock (shared by the processes)
+# guards the slot table; the blocks are decoded and copied outside of it.
+# The process decoding a block is recorded in its slot, and if it dies
+# before the block is ready (e.g., killed for lack of memory), the next
+# worker waiting for the block takes over the slot and decodes it.
+#
+import os
+import time
+import threading
+from multiprocessing import shared_memory
+import multiprocessing
+import numpy as np
+import rasterio
+import rasterio.errors
+import rasterio.features
+from rasterio.windows import Window
+import pwpd
+
+#--- Size of the shared arena (bytes)
+blockcache_bytes = 2**30
+#--- Number of slots in each set of the cache
+blockcache_ways = 8
+
+# slot states
+EMPTY = 0
+LOADING = 1
+READY = 2
+
+cache = None
+
+def is_process_alive(pid):
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+class BlockCache:
+    """
+    A block cache in shared memory for the images in filepaths (created
+    by the parent with spec=None, attached by the workers with its spec)
+    """
+    def __init__(self, filepaths, nbytes=None, spec=None):
+        self.filepaths = list(filepaths)
+        self.fileids = {f: i for (i, f) in enumerate(self.filepaths)}
+        self.block_shapes = []
+        self.dtypes = []
+        self.nodata = []
+        self.shapes = []
+        for f in self.filepaths:
+            with rasterio.open(f) as src:
+                self.block_shapes.append(src.block_shapes[0])
+                self.dtypes.append(np.dtype(src.dtypes[0]))
+                self.nodata.append(src.nodata)
+                self.shapes.append(src.shape)
+        self.slot_bytes = max(h*w*dtype.itemsize for ((h, w), dtype)
+                              in zip(self.block_shapes, self.dtypes))
+        if spec is None:
+            nbytes = blockcache_bytes if nbytes is None else nbytes
+            self.Nslots = max(1, nbytes//self.slot_bytes)
+            self.ways = min(blockcache_ways, self.Nslots)
+            self.lock = multiprocessing.Lock()
+            self.shm = shared_memory.SharedMemory(
+                create=True, size=self.get_table_bytes()
+                + self.Nslots*self.slot_bytes)
+            self.owner = True
+        else:
+            (name, self.Nslots, self.ways, self.lock) = spec
+            self.shm = shared_memory.SharedMemory(name=name)
+            self.owner = False
+        self.Nsets = self.Nslots//self.ways
+        buf = self.shm.buf
+        n = self.Nslots
+        # the slot table: key (file, block row, block col), state, number
+        # of readers, last use, process loading it; and the counters
+        # (clock, hits, misses)
+        self.keys = np.ndarray((n, 3), dtype=np.int64, buffer=buf, offset=0)
+        self.state = np.ndarray(n, dtype=np.int64, buffer=buf, offset=24*n)
+        self.pins = np.ndarray(n, dtype=np.int64, buffer=buf, offset=32*n)
+        self.stamp = np.ndarray(n, dtype=np.int64, buffer=buf, offset=40*n)
+        self.loader = np.ndarray(n, dtype=np.int64, buffer=buf, offset=48*n)
+        self.counters = np.ndarray(4, dtype=np.int64, buffer=buf,
+                                   offset=56*n)
+        self.data = np.ndarray(n*self.slot_bytes, dtype=np.uint8, buffer=buf,
+                               offset=self.get_table_bytes())
+        if self.owner:
+            self.keys[:] = -1
+            self.state[:] = EMPTY
+            self.pins[:] = 0
+            self.stamp[:] = 0
+            self.loader[:] = 0
+            self.counters[:] = 0
+        # (rasterio datasets must not be shared between threads)
+        self.local = threading.local()
+
+    def get_table_bytes(self):
+        # (the blocks start on a page boundary)
+        return -(-(56*self.Nslots + 4*8)//4096)*4096
+
+    def get_spec(self):
+        """What a worker needs to attach to the cache"""
+        return (self.shm.name, self.Nslots, self.ways, self.lock)
+
+    def get_dataset(self, fileid):
+        if not hasattr(self.local, 'datasets'):
+            self.local.datasets = {}
+        if fileid not in self.local.datasets:
+            self.local.datasets[fileid] = rasterio.open(self.filepaths[fileid])
+        return self.local.datasets[fileid]
+
+    def get_set(self, key):
+        (f, br, bc) = key
+        h = (f*73856093) ^ (br*19349663) ^ (bc*83492791)
+        s = h % self.Nsets
+        return range(s*self.ways, (s + 1)*self.ways)
+
+    def acquire_slot(self, key):
+        """(slot, ready) for the key, with the slot pinned; if not ready, the
+        caller loads the block into it.  None if every slot of the set is
+        in use (the block is then read without the cache)."""
+        while True:
+            with self.lock:
+                self.counters[0] += 1
+                slots = self.get_set(key)
+                found = None
+                for i in slots:
+                    if ( (self.keys[i, 0] == key[0]) & (self.keys[i, 1] == key[1])
+                         & (self.keys[i, 2] == key[2]) ):
+                        found = i
+                        break
+                if found is not None:
+                    if (self.state[found] == READY):
+                        self.pins[found] += 1
+                        self.stamp[found] = self.counters[0]
+                        self.counters[1] += 1
+                        return (found, True)
+                    if not is_process_alive(self.loader[found]):
+                        # (its loader died: decode it here instead)
+                        self.loader[found] = os.getpid()
+                        self.pins[found] = 1
+                        self.stamp[found] = self.counters[0]
+                        return (found, False)
+                    # (another worker is decoding it)
+                else:
+                    victim = None
+                    for i in slots:
+                        if ( (self.pins[i] == 0) & (self.state[i] != LOADING)
+                             & ( (victim is None)
+                                 or (self.stamp[i] < self.stamp[victim]) ) ):
+                            victim = i
+                    if victim is None:
+                        self.counters[3] += 1
+                        return None
+                    self.counters[2] += 1
+                    self.keys[victim] = key
+                    self.state[victim] = LOADING
+                    self.pins[victim] = 1
+                    self.stamp[victim] = self.counters[0]
+                    self.loader[victim] = os.getpid()
+                    return (victim, False)
+            time.sleep(1e-4)
+
+    def release_slot(self, slot, loaded=False):
+        with self.lock:
+            if loaded:
+                self.state[slot] = READY
+            self.pins[slot] -= 1
+
+    def discard_slot(self, slot):
+        with self.lock:
+            self.keys[slot] = -1
+            self.state[slot] = EMPTY
+            self.pins[slot] -= 1
+
+    def get_block_window(self, fileid, br, bc):
+        (bh, bw) = self.block_shapes[fileid]
+        (H, W) = self.shapes[fileid]
+        return Window(bc*bw, br*bh, min(bw, W - bc*bw), min(bh, H - br*bh))
+
+    def get_slot_block(self, slot, fileid, block_window):
+        """The block in a slot, as an array in the shared arena (no copy)"""
+        dtype = self.dtypes[fileid]
+        nbytes = int(block_window.height*block_window.width)*dtype.itemsize
+        start = slot*self.slot_bytes
+        return self.data[start:start + nbytes].view(dtype).reshape(
+            int(block_window.height), int(block_window.width))
+
+    def read_window(self, filepath, window):
+        """The pixels of the image at filepath in the window (which must be
+        within the image), from the cached blocks"""
+        fileid = self.fileids[filepath]
+        (bh, bw) = self.block_shapes[fileid]
+        (r0, c0) = (int(window.row_off), int(window.col_off))
+        (r1, c1) = (r0 + int(window.height), c0 + int(window.width))
+        out = np.empty((r1 - r0, c1 - c0), dtype=self.dtypes[fileid])
+        for br in range(r0//bh, -(-r1//bh)):
+            for bc in range(c0//bw, -(-c1//bw)):
+                block_window = self.get_block_window(fileid, br, bc)
+                # the part of the block in the window
+                (rr0, rr1) = (max(r0, br*bh), min(r1, (br + 1)*bh))
+                (cc0, cc1) = (max(c0, bc*bw), min(c1, (bc + 1)*bw))
+                acquired = self.acquire_slot((fileid, br, bc))
+                if acquired is None:
+                    out[rr0-r0:rr1-r0, cc0-c0:cc1-c0] = \
+                        self.get_dataset(fileid).read(1, window=Window(
+                            cc0, rr0, cc1 - cc0, rr1 - rr0))
+                    continue
+                (slot, ready) = acquired
+                block = self.get_slot_block(slot, fileid, block_window)
+                if not ready:
+                    try:
+                        block[:] = self.get_dataset(fileid).read(
+                            1, window=block_window)
+                    except BaseException:
+                        self.discard_slot(slot)
+                        raise
+                out[rr0-r0:rr1-r0, cc0-c0:cc1-c0] = \
+                    block[rr0-br*bh:rr1-br*bh, cc0-bc*bw:cc1-bc*bw]
+                self.release_slot(slot, loaded=(not ready))
+        return out
+
+    def get_masked_subimage(self, windowshapes, filepath, all_touched=False):
+        """As pwpd.get_masked_subimage (rasterio.mask.mask with crop=True),
+        with the window read from the cache"""
+        fileid = self.fileids[filepath]
+        src = self.get_dataset(fileid)
+        try:
+            window = rasterio.features.geometry_window(src, windowshapes)
+        except rasterio.errors.WindowError:
+            raise ValueError('Input shapes do not overlap raster.')
+        img_transform = src.window_transform(window)
+        img = self.read_window(filepath, window)
+        outside = rasterio.features.geometry_mask(
+            windowshapes, img.shape, img_transform, all_touched=all_touched)
+        nodata = self.nodata[fileid]
+        img[outside] = 0 if nodata is None else nodata
+        return (img, img_transform)
+
+    def get_stats(self):
+        (clock, hits, misses, bypassed) = self.counters.tolist()
+        return {'hits': hits, 'misses': misses, 'bypassed': bypassed,
+                'slots': self.Nslots,
+                'slots_used': int(np.count_nonzero(self.state == READY)),
+                'slot_bytes': self.slot_bytes}
+
+    def close(self):
+        for src in getattr(self.local, 'datasets', {}).values():
+            src.close()
+        self.local.datasets = {}
+        # (the arrays in the arena must go before the arena)
+        del self.keys, self.state, self.pins, self.stamp, self.loader
+        del self.counters
+        del self.data
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+def get_image_filepaths():
+    if (pwpd.popimage_type == 'GHS'):
+        return [pwpd.GHS_filepath]
+    return [pwpd.GPW_popcount_filepath, pwpd.GPW_popdensity_filepath]
+
+def create(nbytes=None):
+    """Create the shared cache for the current population image(s), and
+    use it in this process too"""
+    global cache
+    close()
+    cache = BlockCache(get_image_filepaths(), nbytes=nbytes)
+    pwpd.block_cache = cache
+    return cache
+
+def get_spec():
+    """(filepaths, spec) for the workers to attach with, or None if there
+    is no cache"""
+    if cache is None:
+        return None
+    return (cache.filepaths, cache.get_spec())
+
+def attach(spec):
+    """Attach a worker to the parent's cache (spec from get_spec)"""
+    global cache
+    if spec is None:
+        return
+    (filepaths, cache_spec) = spec
+    cache = BlockCache(filepaths, spec=cache_spec)
+    pwpd.block_cache = cache
+
+def print_summary():
+    if cache is None:
+        return
+    s = cache.get_stats()
+    Nreads = s['hits'] + s['misses']
+    print("=" * 80)
+    print(f"Shared block cache: {s['hits']:,d} hits, {s['misses']:,d} blocks"
+          + f" decoded ({100*s['hits']/max(Nreads, 1):.1f}% hits),"
+          + f" {s['bypassed']:,d} read around a full set;"
+          + f" {s['slots_used']:,d} of {s['slots']:,d} slots"
+          + f" of {s['slot_bytes']/1e3:,.0f} kB in use")
+    print("=" * 80)
+
+def close():
+    global cache
+    if cache is not None:
+        cache.close()
+        cache = None
+        pwpd.block_cache = None
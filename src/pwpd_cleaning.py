@@ -0,0 +1,254 @@
+# Use the pwpd.yml conda environment
+#
+# Image cleaning and sorting methods (only for GHS-POP images).
+#
+# These are loaded lazily by pwpd.py, so they can be called either
+# directly or as pwpd.get_cleaned_pwpd(...), etc.
+#
+import datetime
+import itertools
+import numpy as np
+import pandas as pd
+import pwpd
+import pwpd_trace
+
+############################################################
+#    Image cleaning subroutines (only for GHS-POP images)  #
+############################################################
+
+def count_nonzero_neighbors(arr, r, c, rows, cols):
+    if ( (r==0) | (r==(rows-1))  | (c==0) | (c==(cols-1)) ):
+        print(f"***Warning: edge pixel at ({r:d},{c:d}) not checked, but deleted.")
+        return 0
+    rr = [r-1, r-1, r-1, r, r, r+1, r+1, r+1]
+    cc = [c-1, c, c+1, c-1, c+1, c-1, c, c+1]
+    count = 0
+    for rrr,ccc in zip(rr,cc):
+        if (arr[rrr,ccc] > 0):
+            count += 1
+    return count
+    
+def get_cleaned_pwpd(window_df, Nclean, Ncheck, maxNzero, Nmaxpix):
+    # only do this for GHS-POP images
+    if (pwpd.popimage_type == 'GPW'):
+        print("\n***Error: Not currently set up to do cleaning of GPW images.")
+        exit(0)
+    # Get windowed subimage(s) of population raster
+    popimg, popimg_transform = \
+        pwpd.get_windowed_subimage(window_df, pwpd.GHS_filepath)
+    arr = np.array(popimg)
+    (rows,cols) = arr.shape
+    # set no data valued (negative) pixels to zero
+    arr[arr < 0.0] = 0.0
+    # make new copy of image for cleaning
+    cl_arr = arr.copy()
+    # and another one for for checking (will delete max each check)
+    ch_arr = arr.copy()    
+    Ncleaned = 0
+    Nchecked = 0
+    totalpop = []; pwd = []; pwlogpd = []; lat = []; lon = []
+    checked = []; zeros = []
+    while ( (Ncleaned < Nclean) & (Nchecked < Ncheck) ):
+        Nchecked += 1
+        # find max-valued pixel in checked image and zero out that pixel
+        (y,x) = np.unravel_index(np.argmax(ch_arr, axis=None), arr.shape)
+        ch_arr[y,x] = 0.0
+        # but check for neighbors in uncleaned image
+        nonzeropix = count_nonzero_neighbors(arr, y, x, rows, cols)
+        if ((8-nonzeropix) > maxNzero):
+            Ncleaned += 1
+            # zero out that pixel in the cleaned image
+            cl_arr[y,x] = 0.0
+            # get the latitude and longitude of the pixel
+            (la, lo) = pwpd.get_latlon(x, y, popimg.shape, popimg_transform)
+            lat.append(la); lon.append(lo)
+            # calculate pwpd etc from cleaned image
+            (p, pw, pl, px, py) = pwpd.get_pwpd_from_count(cl_arr, nparr=True)
+            totalpop.append(p); pwd.append(pw); pwlogpd.append(pl)
+            checked.append(Nchecked); zeros.append(8-nonzeropix)
+    # After cleaning, find the new max pixels
+    maxpix = []
+    for i in np.arange(Nmaxpix):
+        (y,x) = np.unravel_index(np.argmax(arr, axis=None), arr.shape)
+        arr[y,x] = 0.0
+        (la, lo) = pwpd.get_latlon(x, y, popimg.shape, popimg_transform)
+        maxpix.append((la,lo))
+    return (checked, zeros, totalpop, pwd, pwlogpd, lat, lon, maxpix)
+
+def get_cleaned_pwpd_force(window_df, Npixels, Nmaxpix, outfilepath=None):
+    # only do this for GHS-POP images
+    if (pwpd.popimage_type == 'GPW'):
+        print("\n***Error: Not currently set up to do cleaning of GPW images.")
+        exit(0)
+    # Get windowed subimage(s) of population raster
+    popimg, popimg_transform, popimg_meta = \
+        pwpd.get_windowed_subimage(window_df, pwpd.GHS_filepath,
+                                   return_meta=True)
+    arr = np.array(popimg)
+    # set no data valued (negative) pixels to zero    
+    arr[arr < 0.0] = 0.0
+    # make new copy of image for cleaning    
+    for i in np.arange(Npixels):
+        (y,x) = np.unravel_index(np.argmax(arr, axis=None), arr.shape)
+        arr[y,x] = 0.0
+    # Save the cleaned image (as a cloud-optimized GeoTIFF)
+    if outfilepath is not None:
+        import pwpd_io
+        pwpd_io.write_cog(arr, popimg_meta, outfilepath)
+    # After cleaning, find the new max pixels
+    maxpix = []
+    for i in np.arange(Nmaxpix):
+        (y,x) = np.unravel_index(np.argmax(arr, axis=None), arr.shape)
+        arr[y,x] = 0.0
+        (la, lo) = pwpd.get_latlon(x, y, popimg.shape, popimg_transform)
+        maxpix.append((la,lo))
+    return (maxpix, arr)
+
+############################################################
+#    Sweep of the cleaning parameters (only for GHS-POP)   #
+############################################################
+
+def get_cleaning_candidates(arr, Ncheck):
+    """
+    The (up to) Ncheck largest pixels of arr (with no data set to zero),
+    in the order get_cleaned_pwpd checks them (largest first, ties in
+    row-major order, as argmax), as (rows, cols, pop, Nnonzero), with
+    Nnonzero = 0 for the pixels on the edge of the window (as
+    count_nonzero_neighbors)
+    """
+    (rows, cols) = arr.shape
+    flat = arr.ravel()
+    index = np.flatnonzero(flat > 0)
+    if (index.size > Ncheck):
+        threshold = np.partition(flat[index], index.size - Ncheck)[
+            index.size - Ncheck]
+        index = index[flat[index] >= threshold]
+    index = index[np.lexsort((index, -flat[index]))][:Ncheck]
+    (r, c) = np.divmod(index, cols)
+    populated = np.pad(arr > 0, 1)
+    Nnonzero = sum(populated[1+r+i, 1+c+j].astype(np.int64)
+                   for i in [-1, 0, 1] for j in [-1, 0, 1] if (i, j) != (0, 0))
+    edge = ( (r == 0) | (r == (rows-1)) | (c == 0) | (c == (cols-1)) )
+    if np.any(edge):
+        print(f"***Warning: {np.count_nonzero(edge):d} edge pixel(s) not checked, but deleted.")
+    Nnonzero[edge] = 0
+    return (r, c, flat[index].astype(np.float64), Nnonzero)
+
+def get_cleaning_sweep(window_df, Ncheck_list, maxNzero_list, Nclean_list):
+    """
+    Pop, PWPD and PWlogPD of the region(s) in window_df cleaned as by
+    get_cleaned_pwpd(window_df, Nclean, Ncheck, maxNzero, ...), for every
+    combination of the values in the three lists, from one read of the
+    window.  The candidate pixels (the max(Ncheck_list) largest) and their
+    neighbors are found once, and each combination is a lookup in the
+    prefix sums, over the candidates, of the pixels that it would clean.
+    Returns a dataframe with the columns
+
+        ['Ncheck', 'maxNzero', 'Nclean', 'Nchecked', 'Ncleaned',
+         'pop', 'pwpd', 'pwlogpd']
+    """
+    # only do this for GHS-POP images
+    if (pwpd.popimage_type == 'GPW'):
+        print("\n***Error: Not currently set up to do cleaning of GPW images.")
+        exit(0)
+    popimg, popimg_transform = \
+        pwpd.get_windowed_subimage(window_df, pwpd.GHS_filepath)
+    arr = np.array(popimg)
+    arr[arr < 0.0] = 0.0
+    with pwpd_trace.stage('clean_sweep', pixels=arr.size):
+        (S1, S2, SL, moments) = \
+            pwpd.get_fused_sums(arr, Acell_in_kmsqd=pwpd.GHS_Acell_in_kmsqd)
+        (r, c, pop, Nnonzero) = get_cleaning_candidates(arr,
+                                                        max(Ncheck_list))
+        density = pop / pwpd.GHS_Acell_in_kmsqd
+        grid = pd.DataFrame(list(itertools.product(Ncheck_list, maxNzero_list,
+                                                   Nclean_list)),
+                            columns=['Ncheck', 'maxNzero', 'Nclean'])
+        Nchecked = np.zeros(len(grid), dtype=np.int64)
+        Ncleaned = np.zeros(len(grid), dtype=np.int64)
+        removed = np.zeros((3, len(grid)))
+        for maxNzero in np.unique(grid['maxNzero']):
+            # prefix sums over the candidates of those that would be cleaned
+            hot = ((8 - Nnonzero) > maxNzero)
+            count = np.r_[0, np.cumsum(hot)]
+            sums = np.vstack([np.r_[0.0, np.cumsum(x*hot)] for x in
+                              [pop, pop*density, pop*np.log(density)]])
+            combos = np.flatnonzero(grid['maxNzero'] == maxNzero)
+            # checking stops at Ncheck, or at the Nclean-th cleaned pixel
+            k = np.minimum(np.minimum(grid['Ncheck'].values[combos], pop.size),
+                           np.searchsorted(count, grid['Nclean'].values[combos]))
+            Nchecked[combos] = k
+            Ncleaned[combos] = count[k]
+            removed[:, combos] = sums[:, k]
+    grid['Nchecked'] = Nchecked
+    grid['Ncleaned'] = Ncleaned
+    grid['pop'] = S1 - removed[0]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        populated = (grid['pop'].values > 0)
+        grid['pwpd'] = np.where(populated, (S2 - removed[1])/grid['pop'], 0.0)
+        grid['pwlogpd'] = np.where(populated, (SL - removed[2])/grid['pop'],
+                                   0.0)
+    return grid
+
+############################################################
+#        Sorting the Image  (only for GHS-POP images)      #
+############################################################
+
+def flatten_and_sort_image(img):
+    # First record the (row,col) values in arrays
+    arr = np.array(img)
+    (rows,cols) = arr.shape
+    grid = np.indices((rows,cols))
+    farr = arr.flatten()
+    farr_r = grid[0].flatten()
+    farr_c = grid[1].flatten()
+    # Then delete all nonpositive values in the flattened array
+    selected = (farr > 0)
+    farr = farr[selected]
+    farr_r = farr_r[selected]
+    farr_c = farr_c[selected]
+    # Then sort the remaining values
+    sortind = np.flip(farr.argsort())
+    # return the flattened array, sorted from max to min,
+    # along with the corresponding row and column labels
+    return farr[sortind], farr_r[sortind], farr_c[sortind]
+
+def get_sorted_imarray(window_df, sort_Ntop, printout=True):
+    # Get windowed subimage
+    if (pwpd.popimage_type == 'GHS'):
+        img, img_transform = \
+            pwpd.get_windowed_subimage(window_df, pwpd.GHS_filepath)
+    elif (pwpd.popimage_type == 'GPW'):
+        print("\n***Error: Not currently set up to do sorting for GPW images.")
+        exit(0)
+    # Set no data valued (negative) pixels to zero    
+    arr = np.array(img)
+    arr[arr < 0.0] = 0.0
+    (rows,cols) = arr.shape
+    # Get a flattened and sorted array
+    print("\tFlattening and sorting the array...")
+    with pwpd_trace.stage('sort', array_bytes=arr.nbytes):
+        farr, farr_r, farr_c = flatten_and_sort_image(img)
+    sorted_df = pd.DataFrame({'pixpop': farr[0:sort_Ntop],
+                              'r': farr_r[0:sort_Ntop],
+                              'c': farr_c[0:sort_Ntop]})
+    sorted_df['NnonzeroN'] = 0
+    sorted_df['lat'] = 0.0
+    sorted_df['lon'] = 0.0
+    count = 0
+    print(f"\tGetting neighbors and positions of top {sort_Ntop:d} pixels...")
+    print("\t\tStarted: ", datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+    with pwpd_trace.stage('neighbors'):
+        for index, row in sorted_df.iterrows():
+            x = int(row.c)
+            y = int(row.r)
+            (la, lo) = pwpd.get_latlon(x, y, img.shape, img_transform)
+            sorted_df.at[index,'lat'] = la
+            sorted_df.at[index,'lon'] = lo
+            nonzeropix = count_nonzero_neighbors(arr, y, x, rows, cols)
+            sorted_df.at[index,'NnonzeroN'] = nonzeropix
+            if printout:
+                print(f"{count:d}   ({x:d},{y:d}) {row.pixpop:.1f} {nonzeropix:d} ({la:.3f},{lo:.3f})")
+            count += 1
+    print("\t\tEnded:   ", datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'))    
+    return sorted_df
@@ -0,0 +1,68 @@
+# Use the pwpd.yml conda environment
+#
+# Fraction of each pixel covered by a region, for coverage-weighted
+# population sums.
+#
+# rasterio.mask.mask keeps a pixel if its center is in the region, which
+# is fine when the pixels are small compared to the region, but for small
+# counties on the GPW 2.5am or 15am images gives very wrong populations
+# and PWPDs.  With pwpd.coverage_weighting = True the window is read with
+# every pixel that the region touches, and each pixel's population is
+# weighted by the fraction w of its area inside the region (its density
+# is unchanged), so the sums become
+#
+#     sum w*p,    sum w*p*d,    sum w*p*log(d)
+#
+# The coverage is exact: pixels crossed by the region's boundary (found
+# by rasterizing the boundary with all_touched) are intersected with the
+# region, the rest are fully in (center in the region) or fully out.  The
+# intersections are vectorized (shapely), first with one strip per image
+# row of boundary pixels and then with the pixels of each strip, so each
+# pixel is intersected with only the part of the boundary in its row.
+#
+# (For images in lat/lon the coverage is the fraction of the pixel's
+# extent in degrees, which differs from the fraction of its area only by
+# the change of cos(lat) across one pixel.)
+#
+import numpy as np
+import pwpd_trace
+
+def get_coverage(windowshapes, img_shape, img_transform, return_edge=False):
+    """Fraction (0 to 1) of each pixel of a window covered by the shapes
+    (already in the coordinates of the image), and, with return_edge, the
+    mask of the pixels crossed by their boundary (the other pixels are
+    entirely in or out of the shapes)"""
+    import shapely
+    import rasterio.features
+    geom = shapely.union_all(np.asarray(windowshapes))
+    with pwpd_trace.stage('coverage') as span:
+        # pixels with their centers in the region
+        coverage = (~rasterio.features.geometry_mask(
+            [geom], img_shape, img_transform)).astype(np.float32)
+        # pixels crossed by the boundary
+        edge = rasterio.features.rasterize(
+            [geom.boundary], out_shape=img_shape, transform=img_transform,
+            all_touched=True, dtype=np.uint8)
+        (rows, cols) = np.nonzero(edge)
+        span.add(edge_pixels=rows.size)
+        if (rows.size == 0):
+            return (coverage, edge.astype(bool)) if return_edge else coverage
+        # one strip per row of boundary pixels, clipped to the region
+        (strip_rows, strip_index) = np.unique(rows, return_inverse=True)
+        (xs0, ys0) = img_transform * (np.zeros(strip_rows.size), strip_rows)
+        (xs1, ys1) = img_transform * (np.full(strip_rows.size, img_shape[1]),
+                                      strip_rows + 1)
+        strips = shapely.intersection(
+            geom, shapely.box(np.minimum(xs0, xs1), np.minimum(ys0, ys1),
+                              np.maximum(xs0, xs1), np.maximum(ys0, ys1)))
+        # each boundary pixel clipped to its strip
+        (x0, y0) = img_transform * (cols, rows)
+        (x1, y1) = img_transform * (cols + 1, rows + 1)
+        pixels = shapely.box(np.minimum(x0, x1), np.minimum(y0, y1),
+                             np.maximum(x0, x1), np.maximum(y0, y1))
+        Apixel = abs(img_transform.a*img_transform.e
+                     - img_transform.b*img_transform.d)
+        coverage[rows, cols] = np.clip(
+            shapely.area(shapely.intersection(strips[strip_index], pixels))
+            / Apixel, 0.0, 1.0)
+    return (coverage, edge.astype(bool)) if return_edge else coverage
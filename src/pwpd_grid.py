@@ -0,0 +1,148 @@
+# Use the pwpd.yml conda environment
+#
+# Gridded PWPD product: a raster in which each (coarse) output cell holds
+# the population, PWPD and PWlogPD of the population-image pixels inside
+# it, i.e., the same quantities that pwpd.get_pwpd_from_count and
+# pwpd.get_pwpd_from_count_and_density give for a region, but for every
+# cell of a regular grid over the whole image.
+#
+# The source image is streamed in strips of whole output-cell rows, and
+# the per-cell sums
+#
+#     S1 = sum p ,   S2 = sum p*d ,   SL = sum p*log(d)
+#
+# (d = pixel density, p/A_cell for GHS or the density image for GPW) are
+# found by reshaping each strip to (cell rows, f, cell cols, f) and
+# summing over the two f-axes.  Then pop = S1, PWPD = S2/S1 and
+# PWlogPD = SL/S1.  Only one strip is held at a time, so memory is
+# bounded on the full-size images, and the output is written strip by
+# strip as a tiled, compressed GeoTIFF with the bands (pop, pwpd, pwlogpd),
+# which is then converted to a cloud-optimized GeoTIFF (see pwpd_io.py).
+#
+import numpy as np
+import rasterio
+import rasterio.windows
+from rasterio.transform import Affine
+import pwpd
+
+#--- Maximum number of source pixels held in one strip
+grid_strip_max_pixels = 2**24
+#--- Output bands
+grid_band_names = ['pop', 'pwpd', 'pwlogpd']
+
+def get_grid_factor(src, cellsize_string):
+    """
+    Number of source pixels along each side of an output cell, for a cell
+    size given in km (e.g., '10km', projected images) or in degrees (e.g.,
+    '1deg', '0.5deg', geographic images)
+    """
+    if cellsize_string.endswith('km'):
+        cellsize = float(cellsize_string[:-2])*1000.0
+        if src.crs.is_geographic:
+            print("\n***Error: Give the grid cell size of a geographic image in degrees.")
+            exit(0)
+    elif cellsize_string.endswith('deg'):
+        cellsize = float(cellsize_string[:-3])
+        if not src.crs.is_geographic:
+            print("\n***Error: Give the grid cell size of a projected image in km.")
+            exit(0)
+    else:
+        print("\n***Error: Grid cell size", cellsize_string, "not recognized.")
+        exit(0)
+    factor = cellsize/src.res[0]
+    if (abs(factor - np.round(factor)) > 1e-6*factor):
+        print("\n***Error: Grid cell size", cellsize_string,
+              "is not a whole number of pixels.")
+        exit(0)
+    return int(np.round(factor))
+
+def block_sum(arr, factor):
+    """Sum over factor x factor blocks (arr dimensions are multiples of factor)"""
+    (rows, cols) = arr.shape
+    return arr.reshape(rows//factor, factor, cols//factor, factor).sum(axis=(1, 3))
+
+def get_strip_sums(pstrip, dstrip, factor):
+    """Per-cell (S1, S2, SL) for a strip of population counts and densities"""
+    # (a populated GPW pixel with a nodata density is skipped)
+    populated = (pstrip > 0) & (dstrip > 0)
+    p = np.where(populated, pstrip, 0.0)
+    d = np.where(populated, dstrip, 1.0)
+    S1 = block_sum(p, factor)
+    S2 = block_sum(p*d, factor)
+    SL = block_sum(p*np.log(d), factor)
+    return (S1, S2, SL)
+
+def read_padded_strip(src, row_off, Nrows, Ncols_padded):
+    """Read a strip of rows, padded with zeros to Nrows x Ncols_padded"""
+    window = rasterio.windows.Window(0, row_off, src.width,
+                                     min(Nrows, src.height - row_off))
+    strip = np.zeros((Nrows, Ncols_padded))
+    data = src.read(1, window=window)
+    strip[:data.shape[0], :data.shape[1]] = data
+    strip[strip < 0.0] = 0.0
+    return strip
+
+def make_pwpd_grid(outfilepath, cellsize_string):
+    """Write the gridded (pop, pwpd, pwlogpd) GeoTIFF for the population
+    image set with pwpd.set_popimage_pars"""
+    if (pwpd.popimage_type == 'GHS'):
+        popfilepath = pwpd.GHS_filepath
+        pdfilepath = None
+    elif (pwpd.popimage_type == 'GPW'):
+        popfilepath = pwpd.GPW_popcount_filepath
+        pdfilepath = pwpd.GPW_popdensity_filepath
+    else:
+        print("\n***Error: Population image type unknown/unset")
+        exit(0)
+    src = rasterio.open(popfilepath)
+    pdsrc = rasterio.open(pdfilepath) if pdfilepath is not None else None
+    try:
+        factor = get_grid_factor(src, cellsize_string)
+        Ncellrows = int(np.ceil(src.height/factor))
+        Ncellcols = int(np.ceil(src.width/factor))
+        Ncols_padded = Ncellcols*factor
+        # strips of whole cell rows, within the memory limit
+        Ncellrows_per_strip = max(1, grid_strip_max_pixels
+                                  // (factor*Ncols_padded*factor))
+        Nrows_per_strip = Ncellrows_per_strip*factor
+        profile = {'driver': 'GTiff', 'height': Ncellrows,
+                   'width': Ncellcols, 'count': len(grid_band_names),
+                   'dtype': 'float32', 'crs': src.crs,
+                   'transform': src.transform*Affine.scale(factor),
+                   'nodata': None, 'tiled': True,
+                   'blockxsize': 256, 'blockysize': 256,
+                   'compress': 'deflate', 'predictor': 3,
+                   'BIGTIFF': 'IF_SAFER'}
+        print(f"Block-reducing the {src.height:d}x{src.width:d} image"
+              + f" to a {Ncellrows:d}x{Ncellcols:d} grid"
+              + f" ({factor:d}x{factor:d} pixels per cell)...")
+        with rasterio.open(outfilepath, 'w', **profile) as dst:
+            for (i, name) in enumerate(grid_band_names):
+                dst.set_band_description(i + 1, name)
+            for row_off in range(0, src.height, Nrows_per_strip):
+                pstrip = read_padded_strip(src, row_off, Nrows_per_strip,
+                                           Ncols_padded)
+                if pdsrc is None:
+                    dstrip = pstrip/pwpd.GHS_Acell_in_kmsqd
+                else:
+                    dstrip = read_padded_strip(pdsrc, row_off,
+                                               Nrows_per_strip, Ncols_padded)
+                (S1, S2, SL) = get_strip_sums(pstrip, dstrip, factor)
+                # the last strip can extend below the grid
+                Nout = min(Ncellrows_per_strip, Ncellrows - row_off//factor)
+                (S1, S2, SL) = (S1[:Nout], S2[:Nout], SL[:Nout])
+                populated = (S1 > 0)
+                safe_S1 = np.where(populated, S1, 1.0)
+                bands = [S1,
+                         np.where(populated, S2/safe_S1, 0.0),
+                         np.where(populated, SL/safe_S1, 0.0)]
+                out_window = rasterio.windows.Window(0, row_off//factor,
+                                                     Ncellcols, Nout)
+                dst.write(np.array(bands, dtype=np.float32), window=out_window)
+    finally:
+        src.close()
+        if pdsrc is not None:
+            pdsrc.close()
+    import pwpd_io
+    pwpd_io.convert_to_cog(outfilepath)
+    return outfilepath
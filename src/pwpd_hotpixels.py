@@ -0,0 +1,257 @@
+# Use the pwpd.yml conda environment
+#
+# A global layer of the GHS-POP image's largest pixels and their
+# populated neighbours, for cleaning hot pixels out of any region.
+#
+# get_cleaned_pwpd (pwpd_cleaning.py) finds the hot pixels of a region
+# (large pixels with mostly zero-valued neighbours) by looping over the
+# argmax of its window, so each country re-scans its own top pixels, a
+# pixel on the edge of the window counts its neighbours outside of the
+# region as zeros, and the counties and health regions are not cleaned at
+# all.  Instead, one pass over the whole image, in strips of
+# hotpixels_strip_rows rows, keeps the hotpixels_Ntop largest pixels,
+# each with its number of populated (of 8) neighbours in the full image,
+# sorted from largest to smallest (ties in row-major order, as argmax):
+#
+#     pwpd.set_popimage_pars('GHS', '2015', '1km')
+#     pwpd_hotpixels.make_hotpixel_layer(layerfilepath)    # once
+#
+#     pwpd_hotpixels.load_hotpixel_layer(layerfilepath)    # any run
+#
+# While a layer is loaded, pwpd.get_pwpd_from_count cleans every region
+# as get_cleaned_pwpd does, with the rules here: of the region's
+# hotpixels_Ncheck largest pixels, the first hotpixels_Nclean with more
+# than hotpixels_maxNzero zero-valued neighbours are removed.  They are
+# found from the layer's entries in the region's window, and their pop,
+# pop*density, pop*log(density) and centroid moments are subtracted from
+# the region's sums, so a cleaned region costs about as much as an
+# uncleaned one.  (A region's pixels below the smallest pixel of the
+# layer are never cleaned, so hotpixels_Ntop should be well above the
+# number of pixels checked in all of the regions together.)  A region
+# split into row strips (pwpd_schedule.py) is cleaned as a whole: each
+# strip gives its candidate pixels, and the hot pixels are picked from
+# those of all of the strips, so the result does not depend on the
+# strips.  The same hot pixels are left out of the Monte Carlo draws of
+# pwpd_uncertainty.py and the density sketches (pwpd_sketch.py), and
+# subtracted from the exact (pixel) level of pwpd_progressive.py, so all
+# of the columns of a region's row are of the cleaned region.  The epoch
+# stacks of pwpd_stack.py are not cleaned.
+#
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+import pwpd
+import pwpd_trace
+
+#--- Number of the largest pixels of the image kept in the layer
+hotpixels_Ntop = 2**20
+#--- Rows of the image read at a time when making the layer
+hotpixels_strip_rows = 256
+#--- Cleaning of each region: of its hotpixels_Ncheck largest pixels, the
+#    first hotpixels_Nclean with more than hotpixels_maxNzero (of 8)
+#    zero-valued neighbours are removed
+hotpixels_Ncheck = 500
+hotpixels_Nclean = 500
+hotpixels_maxNzero = 4
+
+def count_populated_neighbors(populated):
+    """Number of populated (of 8) neighbours of each pixel of the interior
+    of populated (a bool image with a border of one pixel)"""
+    (rows, cols) = (populated.shape[0] - 2, populated.shape[1] - 2)
+    return sum(populated[1+i:1+i+rows, 1+j:1+j+cols].astype(np.int8)
+               for i in [-1, 0, 1] for j in [-1, 0, 1] if (i, j) != (0, 0))
+
+def get_top_pixels(values, rows, cols, Nnonzero, Ntop):
+    """The Ntop largest of the pixels, largest first (ties in row-major
+    order)"""
+    if (values.size > Ntop):
+        # (keep all of the pixels tied with the Ntop-th largest)
+        threshold = np.partition(values, values.size - Ntop)[values.size
+                                                              - Ntop]
+        keep = (values >= threshold)
+        (values, rows, cols, Nnonzero) = (values[keep], rows[keep],
+                                          cols[keep], Nnonzero[keep])
+    order = np.lexsort((cols, rows, -values))[:Ntop]
+    return (values[order], rows[order], cols[order], Nnonzero[order])
+
+def make_hotpixel_layer(outfilepath, Ntop=None):
+    """One pass over the GHS-POP image, in strips, for its Ntop
+    (hotpixels_Ntop, if None) largest pixels and their populated
+    neighbours, saved to a .npz file"""
+    if (pwpd.popimage_type != 'GHS'):
+        print("\n***Error: The hot-pixel layer is only set up for GHS images.")
+        exit(0)
+    if Ntop is None:
+        Ntop = hotpixels_Ntop
+    values = np.empty(0, dtype=np.float32)
+    rows = np.empty(0, dtype=np.int64)
+    cols = np.empty(0, dtype=np.int64)
+    Nnonzero = np.empty(0, dtype=np.int8)
+    with rasterio.open(pwpd.GHS_filepath) as src:
+        (H, W) = src.shape
+        for r0 in range(0, H, hotpixels_strip_rows):
+            r1 = min(H, r0 + hotpixels_strip_rows)
+            # (with the row above and below, or zeros at the image edges)
+            (h0, h1) = (max(0, r0 - 1), min(H, r1 + 1))
+            with pwpd_trace.stage('hotpixels_strip', row=r0):
+                strip = src.read(1, window=Window(0, h0, W, h1 - h0))
+                populated = np.pad(strip > 0, ((1 - (r0 - h0), 1 - (h1 - r1)),
+                                               (1, 1)))
+                strip = strip[r0-h0:r1-h0]
+                # only the pixels that could be among the largest
+                threshold = values[-1] if (values.size == Ntop) else 0.0
+                index = np.flatnonzero(strip > threshold)
+                (srows, scols) = np.divmod(index, W)
+                counts = count_populated_neighbors(populated)
+                (values, rows, cols, Nnonzero) = get_top_pixels(
+                    np.concatenate([values, strip.ravel()[index]]),
+                    np.concatenate([rows, srows + r0]),
+                    np.concatenate([cols, scols]),
+                    np.concatenate([Nnonzero, counts.ravel()[index]]), Ntop)
+        transform = np.array(src.transform)[:6]
+    np.savez_compressed(outfilepath, values=values, rows=rows.astype(np.int32),
+                        cols=cols.astype(np.int32), Nnonzero=Nnonzero,
+                        shape=np.array([H, W]), transform=transform)
+
+def load_hotpixel_layer(infilepath):
+    """Load a layer made by make_hotpixel_layer for the current GHS-POP
+    image, and clean every region with it (see above)"""
+    data = np.load(infilepath)
+    with rasterio.open(pwpd.GHS_filepath) as src:
+        if ( (tuple(data['shape']) != src.shape)
+             | (not np.allclose(data['transform'],
+                                np.array(src.transform)[:6])) ):
+            print("\n***Error: The hot-pixel layer in", infilepath)
+            print("          was made from a different population image.")
+            exit(0)
+        transform = src.transform
+    rows = data['rows'].astype(np.int64)
+    # (the entries by row, for the entries in a window)
+    row_order = np.argsort(rows, kind='stable')
+    pwpd.hot_pixels = {'values': data['values'], 'rows': rows,
+                       'cols': data['cols'].astype(np.int64),
+                       'Nnonzero': data['Nnonzero'], 'row_order': row_order,
+                       'sorted_rows': rows[row_order], 'transform': transform,
+                       'filepath': infilepath}
+
+def get_layer_filepath():
+    """The file of the loaded layer (for the worker processes to load), or
+    None"""
+    if pwpd.hot_pixels is None:
+        return None
+    return pwpd.hot_pixels['filepath']
+
+def unload_hotpixel_layer():
+    pwpd.hot_pixels = None
+
+def get_window_origin(img_transform):
+    """(row, col) in the GHS-POP image of the first pixel of a window"""
+    (col, row) = ~pwpd.hot_pixels['transform']*(img_transform.c,
+                                                img_transform.f)
+    return (int(round(row)), int(round(col)))
+
+def get_window_entries(shape, img_transform):
+    """(rank in the layer, row, col in the window) of the layer's entries
+    in a window of the GHS-POP image, largest first"""
+    layer = pwpd.hot_pixels
+    (r0, c0) = get_window_origin(img_transform)
+    (H, W) = shape
+    (i0, i1) = np.searchsorted(layer['sorted_rows'], [r0, r0 + H])
+    index = layer['row_order'][i0:i1]
+    index = index[(layer['cols'][index] >= c0)
+                  & (layer['cols'][index] < c0 + W)]
+    index.sort()
+    return (index, layer['rows'][index] - r0, layer['cols'][index] - c0)
+
+def get_window_candidates(img, img_transform, coverage=None, inside=None):
+    """
+    The candidate hot pixels of the region in a window of the GHS-POP
+    image (its populated pixels in the layer, up to hotpixels_Ncheck of
+    them, largest first), as (rank in the layer, pop (weighted by the
+    coverage, if given), density, image row, image col).  The first
+    hotpixels_Ncheck of the candidates of all of the windows (e.g., row
+    strips) of a region are those of its whole window.  If img is None,
+    the region is the mask inside on the window, and the pops are the
+    layer's values (so the window need not be read).
+    """
+    layer = pwpd.hot_pixels
+    (r0, c0) = get_window_origin(img_transform)
+    shape = img.shape if inside is None else inside.shape
+    (index, r, c) = get_window_entries(shape, img_transform)
+    # the region's pixels in the layer, largest first
+    if img is None:
+        inregion = inside[r, c] & (layer['values'][index] > 0)
+    else:
+        inregion = (img[r, c] > 0)
+    (index, r, c) = (index[inregion][:hotpixels_Ncheck],
+                     r[inregion][:hotpixels_Ncheck],
+                     c[inregion][:hotpixels_Ncheck])
+    if img is None:
+        pop = layer['values'][index].astype(np.float64)
+    else:
+        pop = img[r, c].astype(np.float64)
+    density = pop / pwpd.GHS_Acell_in_kmsqd
+    if coverage is not None:
+        pop = pop * coverage[r, c]
+    return (index, pop, density, r + r0, c + c0)
+
+def merge_candidates(candidates_list):
+    """The candidates of the windows of a region together (None for a
+    window with none)"""
+    candidates_list = [x for x in candidates_list if x is not None]
+    if not candidates_list:
+        return None
+    return tuple(np.concatenate(x) for x in zip(*candidates_list))
+
+def get_hot_pixels(candidates):
+    """(pop, density, image row, image col) of the hot pixels to remove
+    from a region, of its candidates: of the first hotpixels_Ncheck, the
+    first hotpixels_Nclean with more than hotpixels_maxNzero zero-valued
+    neighbours"""
+    (index, pop, density, rows, cols) = candidates
+    order = np.argsort(index, kind='stable')[:hotpixels_Ncheck]
+    hot = order[(8 - pwpd.hot_pixels['Nnonzero'][index[order]])
+                > hotpixels_maxNzero][:hotpixels_Nclean]
+    return (pop[hot], density[hot], rows[hot], cols[hot])
+
+def remove_hot_pixels(sums, candidates, img_transform):
+    """The sums of pwpd.get_fused_sums of a region, with the moments
+    relative to the window with the given transform, with the region's
+    hot pixels (of its candidates) removed"""
+    (S1, S2, SL, moments) = sums
+    if candidates is None:
+        return sums
+    with pwpd_trace.stage('hotpixels') as span:
+        (pop, density, rows, cols) = get_hot_pixels(candidates)
+        (r0, c0) = get_window_origin(img_transform)
+        span.add(cleaned=int(pop.size))
+    return (S1 - np.sum(pop), S2 - np.dot(pop, density),
+            SL - np.dot(pop, np.log(density)),
+            moments - pwpd.get_centroid_moments(pop, rows - r0, cols - c0,
+                                                img_transform))
+
+def get_cleaned_sums(sums, img, img_transform, coverage=None):
+    """The sums of pwpd.get_fused_sums (of the GHS-POP window img) with
+    the region's hot pixels removed"""
+    return remove_hot_pixels(
+        sums, get_window_candidates(img, img_transform, coverage),
+        img_transform)
+
+def get_hot_pixel_mask(img, img_transform):
+    """Which pixels of the GHS-POP window img are the region's hot pixels
+    (for the paths that use the pixels themselves, not their sums)"""
+    (pop, density, rows, cols) = get_hot_pixels(
+        get_window_candidates(img, img_transform))
+    (r0, c0) = get_window_origin(img_transform)
+    hot = np.zeros(img.shape, dtype=bool)
+    hot[rows - r0, cols - c0] = True
+    return hot
+
+def get_hot_pixel_sums(inside, img_transform, coverage=None):
+    """(sum p, sum p*d, sum p*log(d)) of the hot pixels of the region with
+    the pixel mask inside on a window of the GHS-POP image (from the
+    layer's values, without reading the window)"""
+    (pop, density, rows, cols) = get_hot_pixels(
+        get_window_candidates(None, img_transform, coverage, inside=inside))
+    return np.array([np.sum(pop), np.dot(pop, density),
+                     np.dot(pop, np.log(density))])
@@ -0,0 +1,105 @@
+# Use the pwpd.yml conda environment
+#
+# Writing derived rasters (cleaned population images, smoothed density
+# surfaces, gridded PWPD products) as Cloud-Optimized GeoTIFFs (COGs):
+# tiled, compressed, with internal overviews, and with the overviews and
+# tiles laid out so that a reader (GDAL, QGIS, rasterio, a web viewer)
+# fetches only the tiles and zoom levels it needs, instead of whole
+# national arrays.
+#
+# The image metadata comes from pwpd.get_windowed_subimage(...,
+# return_meta=True), e.g.,
+#
+#     img, img_transform, img_meta = \
+#         pwpd.get_windowed_subimage(window_df, filepath, return_meta=True)
+#     pwpd_io.write_cog(arr, img_meta, "../output/cleaned.tif")
+#
+import os
+import numpy as np
+import rasterio
+import rasterio.env
+import rasterio.shutil
+from rasterio.enums import Resampling
+from rasterio.io import MemoryFile
+
+#--- Tile size of the COG (pixels)
+cog_blocksize = 512
+#--- Compression of the COG
+cog_compress = 'DEFLATE'
+#--- Overviews are added, halving the size each time, until the image
+#    fits in a single tile
+cog_min_overview_size = cog_blocksize
+
+def get_overview_factors(height, width):
+    factors = []
+    factor = 2
+    while (max(height, width)/factor >= cog_min_overview_size/2):
+        factors.append(factor)
+        factor *= 2
+    return factors
+
+def has_cog_driver():
+    return rasterio.env.GDALVersion.runtime().at_least('3.1')
+
+def copy_to_cog(src_dataset, outfilepath, resampling='average'):
+    """Copy an open dataset (with or without overviews) to a COG file"""
+    predictor = 3 if np.dtype(src_dataset.dtypes[0]).kind == 'f' else 2
+    if has_cog_driver():
+        # GDAL >= 3.1 builds the overviews and the COG layout itself
+        rasterio.shutil.copy(src_dataset, outfilepath, driver='COG',
+                             BLOCKSIZE=cog_blocksize, COMPRESS=cog_compress,
+                             PREDICTOR=predictor, BIGTIFF='IF_SAFER',
+                             OVERVIEW_RESAMPLING=resampling.upper())
+    else:
+        # older GDAL: tiled GTiff copy with the source's overviews placed
+        # before the full-resolution data
+        rasterio.shutil.copy(src_dataset, outfilepath, driver='GTiff',
+                             TILED='YES', BLOCKXSIZE=cog_blocksize,
+                             BLOCKYSIZE=cog_blocksize, COMPRESS=cog_compress,
+                             PREDICTOR=predictor, BIGTIFF='IF_SAFER',
+                             COPY_SRC_OVERVIEWS='YES')
+
+def write_cog(arr, img_meta, outfilepath, resampling='average'):
+    """
+    Write a 2D array (e.g., the cleaned image from get_cleaned_pwpd_force)
+    with the metadata of the window it came from as a COG.  Overviews are
+    made with the given resampling ('average' suits densities and
+    population counts viewed as a map; 'nearest' keeps pixel values).
+    """
+    meta = dict(img_meta)
+    meta.update({'driver': 'GTiff', 'count': 1, 'dtype': arr.dtype.name,
+                 'height': arr.shape[0], 'width': arr.shape[1],
+                 'tiled': True, 'blockxsize': cog_blocksize,
+                 'blockysize': cog_blocksize})
+    with MemoryFile() as memfile:
+        with memfile.open(**meta) as tmp:
+            tmp.write(arr, 1)
+            if not has_cog_driver():
+                tmp.build_overviews(get_overview_factors(*arr.shape),
+                                    getattr(Resampling, resampling))
+        with memfile.open() as tmp:
+            copy_to_cog(tmp, outfilepath, resampling=resampling)
+    return outfilepath
+
+def convert_to_cog(infilepath, outfilepath=None, resampling='average'):
+    """
+    Rewrite a GeoTIFF that was written tile by tile (e.g., by pwpd_smooth
+    or pwpd_grid) as a COG.  With outfilepath=None the file is replaced.
+    """
+    if outfilepath is None:
+        (root, ext) = os.path.splitext(infilepath)
+        tmpfilepath = root + "_tmp-cog" + ext
+        convert_to_cog(infilepath, tmpfilepath, resampling=resampling)
+        os.replace(tmpfilepath, infilepath)
+        return infilepath
+    if has_cog_driver():
+        with rasterio.open(infilepath) as src:
+            copy_to_cog(src, outfilepath, resampling=resampling)
+    else:
+        # the overviews must exist before the copy
+        with rasterio.open(infilepath, 'r+') as src:
+            src.build_overviews(get_overview_factors(src.height, src.width),
+                                getattr(Resampling, resampling))
+        with rasterio.open(infilepath) as src:
+            copy_to_cog(src, outfilepath, resampling=resampling)
+    return outfilepath
@@ -0,0 +1,27 @@
+# Use the pwpd.yml conda environment
+#
+# Plotting methods.  Loaded lazily by pwpd.py so that matplotlib is only
+# imported when a plot is actually requested.
+#
+import matplotlib.pyplot as plt
+import pwpd
+
+def plot_sorted(sorted_df, outfile):
+    # only do this for GHS-POP images
+    if (pwpd.popimage_type == 'GPW'):
+        print("\n***Error: Not currently set up to do sorting of GPW images.")
+        exit(0)
+    # First make a 10-point average of the NnonzeroN
+    sorted_df['NnonzeroN_avg'] = sorted_df['NnonzeroN'].rolling(10).mean()
+    # Then make plots of NnonzeroN_avg and pixpop
+    fig, (ax1,ax2) = plt.subplots(nrows=2, ncols=1, sharex=True, figsize=(6,8))
+    nonzero = sorted_df['NnonzeroN_avg'].to_numpy()
+    pixpop = sorted_df['pixpop'].to_numpy()
+    ax1.plot(nonzero)
+    ax1.set_ylabel("Nonzero neighbors")
+    ax1.set_ylim([0,9])
+    ax2.plot(pixpop)
+    ax2.set_ylabel("Pixel population")
+    ax2.set_xlabel("Pixel rank")
+    plt.tight_layout()
+    plt.savefig(outfile)
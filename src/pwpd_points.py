@@ -0,0 +1,196 @@
+# Use the pwpd.yml conda environment
+#
+# Batch lookup of points: the population and density of the pixel of the
+# population image at each lat/lon, and the country, US county and
+# Canadian health region containing it.
+#
+# Scoring a point through pwpd.get_pop_pwpd_pwlogpd needs a polygon per
+# point.  Here all of the points are done together:
+#
+#   * they are transformed to the coordinates of the population image in
+#     one pyproj call,
+#   * they are sorted by the image block (tile or strip) that they fall
+#     in, each block with points in it is read once (from the shared
+#     block cache, if one is attached, see pwpd_blockcache.py), and the
+#     pixels are picked out of it by fancy indexing,
+#   * the containing regions are found with an STRtree over each of the
+#     loaded layers, in the image coordinates, with one query for all of
+#     the points,
+#
+# and the result is a dataframe with one row per point:
+#
+#     pwpd.set_popimage_pars('GHS', '2015', '1km')
+#     pwpd_points.load_point_layers(['countries', 'us-counties'])
+#     df = pwpd_points.lookup_points(lats, lons)
+#
+#     columns = ['lat', 'lon', 'row', 'col', 'pop', 'density',
+#                'country', 'fips', ...]
+#
+# with pop and density NaN off the image (or on no-data pixels), and the
+# region columns missing (NaN, or <NA> for the codes) outside of every
+# region of a layer.  A point on a boundary is given to the region that
+# comes first in the layer.
+#
+import numpy as np
+import pandas as pd
+import rasterio
+from rasterio.windows import Window
+import pwpd
+import pwpd_trace
+
+#--- For each layer, the column(s) of the result and how they are made
+#    from the layer's dataframe
+point_layer_columns = {
+    'countries': {'country': lambda df: df['threelett'].to_numpy(object)},
+    'us-counties': {'fips': lambda df: (1000*df['fips_state']
+                                        + df['fips_county']).to_numpy()},
+    'canada-hr': {'hr_uid': lambda df: df['hr_uid'].to_numpy()},
+}
+
+#--- Number of points queried against the STRtrees at a time (bounds the
+#    memory of the shapely points)
+points_chunk = 2**20
+
+#  point_layers[layername] = (STRtree in image coordinates, {column: values})
+point_layers = {}
+
+def load_point_layers(layerlist, hr_type="covid19"):
+    """Load the shapefile layers, transform them to the coordinates of the
+    population image, and build their STRtrees"""
+    for layername in layerlist:
+        if (layername == 'countries'):
+            df = pwpd.load_world_shapefiles()
+        elif (layername == 'us-counties'):
+            df = pwpd.load_UScounty_shapefiles()
+        elif (layername == 'canada-hr'):
+            df = pwpd.load_CanadaHR_shapefiles(hr_type)
+        else:
+            print("\n***Error: Layer", layername, "not recognized.")
+            exit(0)
+        add_point_layer(layername, pwpd.transform_shapefile(df))
+
+def add_point_layer(layername, df_t, columns=None):
+    """Add a layer of regions (already in the image coordinates), with the
+    result columns {column: function of df_t}"""
+    import shapely
+    if columns is None:
+        columns = point_layer_columns[layername]
+    tree = shapely.STRtree(df_t.geometry.values)
+    point_layers[layername] = (tree, {col: make(df_t) for (col, make)
+                                      in columns.items()})
+
+def get_point_pixels(lats, lons):
+    """(x, y) of the points in the coordinates of the population image,
+    and their (row, col) pixels (which may be off the image)"""
+    crs = pwpd.get_image_crs()
+    if pwpd.is_geographic(crs):
+        (x, y) = (lons, lats)
+    else:
+        with pwpd_trace.stage('transform_points', points=lats.size):
+            (x, y) = pwpd.get_transformer('epsg:4326', crs).transform(lats,
+                                                                      lons)
+    (transform, shape) = get_image_grid()
+    (col, row) = ~transform*(x, y)
+    return (x, y, np.floor(row).astype(np.int64),
+            np.floor(col).astype(np.int64))
+
+image_grids = {}
+
+def get_image_grid():
+    filepath = get_image_filepaths()[0]
+    if filepath not in image_grids:
+        with rasterio.open(filepath) as src:
+            image_grids[filepath] = (src.transform, src.shape)
+    return image_grids[filepath]
+
+def get_image_filepaths():
+    if (pwpd.popimage_type == 'GHS'):
+        return [pwpd.GHS_filepath]
+    return [pwpd.GPW_popcount_filepath, pwpd.GPW_popdensity_filepath]
+
+def sample_image(filepath, rows, cols):
+    """The values of the image at filepath at the pixels (rows, cols), NaN
+    off the image or on no-data (negative) pixels, reading each block
+    with points in it once"""
+    values = np.full(rows.size, np.nan)
+    src = pwpd.get_open_raster(filepath) if pwpd.keep_rasters_open \
+        else rasterio.open(filepath)
+    try:
+        (H, W) = src.shape
+        (bh, bw) = src.block_shapes[0]
+        index = np.flatnonzero((rows >= 0) & (rows < H)
+                               & (cols >= 0) & (cols < W))
+        (r, c) = (rows[index], cols[index])
+        block = (r//bh)*(-(-W//bw)) + c//bw
+        order = np.argsort(block, kind='stable')
+        (index, r, c, block) = (index[order], r[order], c[order], block[order])
+        starts = np.flatnonzero(np.r_[True, block[1:] != block[:-1]])
+        ends = np.r_[starts[1:], block.size]
+        cache = pwpd.block_cache
+        if ( (cache is not None) and (filepath not in cache.fileids) ):
+            cache = None
+        with pwpd_trace.stage('sample_blocks', file=filepath.split('/')[-1],
+                              blocks=starts.size, points=index.size):
+            for (i0, i1) in zip(starts, ends):
+                (r0, c0) = ((r[i0]//bh)*bh, (c[i0]//bw)*bw)
+                window = Window(c0, r0, min(bw, W - c0), min(bh, H - r0))
+                if cache is not None:
+                    data = cache.read_window(filepath, window)
+                else:
+                    data = src.read(1, window=window)
+                values[index[i0:i1]] = data[r[i0:i1] - r0, c[i0:i1] - c0]
+    finally:
+        if not pwpd.keep_rasters_open:
+            src.close()
+    values[values < 0] = np.nan
+    return values
+
+def get_containing_regions(layername, x, y):
+    """Index (in the layer) of the region containing each point, or -1"""
+    import shapely
+    (tree, columns) = point_layers[layername]
+    region = np.full(x.size, -1, dtype=np.int64)
+    with pwpd_trace.stage('strtree_query', layer=layername, points=x.size):
+        for i0 in range(0, x.size, points_chunk):
+            points = shapely.points(x[i0:i0+points_chunk],
+                                    y[i0:i0+points_chunk])
+            (ipoint, iregion) = tree.query(points, predicate='intersects')
+            # (on a boundary, the region that comes first in the layer)
+            order = np.lexsort((iregion, ipoint))
+            (ipoint, iregion) = (ipoint[order], iregion[order])
+            first = np.r_[True, ipoint[1:] != ipoint[:-1]]
+            region[i0 + ipoint[first]] = iregion[first]
+    return region
+
+def lookup_points(lats, lons, layerlist=None):
+    """
+    The pixel population and density at each of the points (lat/lon,
+    EPSG:4326) and the regions of the loaded layers (all of them, if
+    layerlist is None) containing them, as a dataframe with one row per
+    point (see above)
+    """
+    lats = np.asarray(lats, dtype=np.float64)
+    lons = np.asarray(lons, dtype=np.float64)
+    (x, y, rows, cols) = get_point_pixels(lats, lons)
+    result = {'lat': lats, 'lon': lons, 'row': rows, 'col': cols}
+    filepaths = get_image_filepaths()
+    result['pop'] = sample_image(filepaths[0], rows, cols)
+    if (pwpd.popimage_type == 'GHS'):
+        result['density'] = result['pop'] / pwpd.GHS_Acell_in_kmsqd
+    else:
+        result['density'] = sample_image(filepaths[1], rows, cols)
+    if layerlist is None:
+        layerlist = list(point_layers)
+    for layername in layerlist:
+        region = get_containing_regions(layername, x, y)
+        found = (region >= 0)
+        for (col, values) in point_layers[layername][1].items():
+            if (values.dtype == object):
+                out = np.full(x.size, None, dtype=object)
+                out[found] = values[region[found]]
+            else:
+                out = pd.arrays.IntegerArray(
+                    values[np.where(found, region, 0)].astype(np.int64),
+                    ~found)
+            result[col] = out
+    return pd.DataFrame(result)
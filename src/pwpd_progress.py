@@ -0,0 +1,145 @@
+# Use the pwpd.yml conda environment
+#
+# Progress reporting for the loops over many regions (all US counties,
+# all countries, all health regions, composites).
+#
+# Instead of a multi-line banner per region, the console shows a single
+# status line, refreshed at most once every progress_refresh_s seconds,
+#
+#     counties  1234/3233  38.2%  41.7 regions/s  ETA 0:00:48  RSS 412 MB
+#
+# and the end of the loop prints the totals and the slowest regions.  The
+# per-region results go to the "pwpd" logger (at level INFO) as
+# structured records; set_log_output() sends them, as JSON lines, to a
+# file or to the console at a chosen level:
+#
+#     pwpd_progress.set_log_output("../output/run.jsonl", 'INFO')
+#     progress = pwpd_progress.Progress(len(df), "counties")
+#     for ...:
+#         ...
+#         progress.update(name, pop=pop, pwpd=pwd, window=imgshape)
+#     progress.finish()
+#
+import os
+import sys
+import json
+import time
+import heapq
+import logging
+
+logger = logging.getLogger("pwpd")
+
+#--- Minimum time (s) between refreshes of the console status line
+progress_refresh_s = 1.0
+#--- Number of slowest regions to report at the end
+progress_Nslowest = 5
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record, with the record's fields"""
+    def format(self, record):
+        entry = {'time': record.created, 'level': record.levelname,
+                 'message': record.getMessage()}
+        entry.update(getattr(record, 'fields', {}))
+        return json.dumps(entry, default=str)
+
+def set_log_output(log_filepath=None, log_level='WARNING'):
+    """
+    Send the "pwpd" log records at log_level or above to log_filepath (or
+    to stderr if None) as JSON lines.  Per-region results are logged at
+    INFO, so the default (WARNING, to stderr) keeps them off the console.
+    """
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        handler.close()
+    if log_filepath is None:
+        handler = logging.StreamHandler(sys.stderr)
+    else:
+        handler = logging.FileHandler(log_filepath, mode='w')
+    handler.setFormatter(JsonFormatter())
+    logger.addHandler(handler)
+    logger.setLevel(log_level)
+    logger.propagate = False
+
+def get_rss_MB():
+    """Current resident memory of the process (peak, if not on Linux)"""
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages*os.sysconf('SC_PAGE_SIZE')/1e6
+    except (OSError, ValueError):
+        import resource
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # (kB on Linux, bytes on macOS)
+        return rss/1e6 if (sys.platform == 'darwin') else rss/1e3
+
+def format_seconds(seconds):
+    seconds = int(round(seconds))
+    return f"{seconds//3600:d}:{(seconds//60) % 60:02d}:{seconds % 60:02d}"
+
+class Progress:
+    """Rate-limited progress of a loop over Ntotal regions"""
+    def __init__(self, Ntotal, label="regions", stream=None):
+        self.Ntotal = Ntotal
+        self.label = label
+        self.stream = sys.stdout if stream is None else stream
+        self.tty = hasattr(self.stream, 'isatty') and self.stream.isatty()
+        self.Ndone = 0
+        self.Nshown = 0
+        self.slowest = []
+        self.t0 = time.perf_counter()
+        self.t_last = self.t0
+        self.t_refresh = self.t0
+
+    def update(self, name, **fields):
+        """One more region done; fields are logged with it"""
+        now = time.perf_counter()
+        seconds = now - self.t_last
+        self.t_last = now
+        self.Ndone += 1
+        # keep the slowest regions (a min-heap of the largest times)
+        item = (seconds, self.Ndone, name)
+        if (len(self.slowest) < progress_Nslowest):
+            heapq.heappush(self.slowest, item)
+        elif (seconds > self.slowest[0][0]):
+            heapq.heapreplace(self.slowest, item)
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(name, extra={'fields': dict(fields, region=name,
+                                                    seconds=seconds)})
+        if ( (now - self.t_refresh >= progress_refresh_s)
+             | (self.Ndone == self.Ntotal) ):
+            self.t_refresh = now
+            self.show(now)
+
+    def show(self, now):
+        self.Nshown = self.Ndone
+        elapsed = now - self.t0
+        rate = self.Ndone/elapsed if (elapsed > 0) else 0.0
+        eta = (self.Ntotal - self.Ndone)/rate if (rate > 0) else 0.0
+        line = (f"{self.label:s} {self.Ndone:6d}/{self.Ntotal:d}"
+                + f" {100.0*self.Ndone/max(self.Ntotal, 1):5.1f}%"
+                + f" {rate:7.1f} regions/s  ETA {format_seconds(eta):s}"
+                + f"  RSS {get_rss_MB():.0f} MB")
+        if self.tty:
+            self.stream.write("\r" + line)
+        else:
+            self.stream.write(line + "\n")
+        self.stream.flush()
+
+    def finish(self):
+        """Final status line, totals and the slowest regions"""
+        now = time.perf_counter()
+        if (self.Ndone != self.Nshown):
+            self.show(now)
+        if self.tty:
+            self.stream.write("\n")
+        elapsed = now - self.t0
+        self.stream.write(f"Done: {self.Ndone:d} {self.label:s} in"
+                          + f" {format_seconds(elapsed):s}\n")
+        if self.slowest:
+            self.stream.write("Slowest:\n")
+            for (seconds, i, name) in sorted(self.slowest, reverse=True):
+                self.stream.write(f"\t{seconds:8.2f} s\t{name}\n")
+        self.stream.flush()
+        logger.info(f"{self.label:s} done",
+                    extra={'fields': {'Nregions': self.Ndone,
+                                      'seconds': elapsed}})
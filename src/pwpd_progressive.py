@@ -0,0 +1,322 @@
+# Use the pwpd.yml conda environment
+#
+# Progressive refinement of the population, PWPD and PWlogPD of a region
+# from sum-aggregated overviews of the population image, with rigorous
+# bounds at each level.
+#
+# build_overviews() makes (once, offline) overviews of the current
+# population image at factors 2, 4, ..., 2**progressive_levels, each a
+# GeoTIFF with, for each block of f x f pixels, the bands
+#
+#     sum p,  sum p*d,  sum p*log(d),  max d,  min d
+#
+# over its populated (p > 0) pixels, with d the density of a pixel (p
+# divided by the pixel area for GHS, the density image for GPW).  Since
+# the PWPD and PWlogPD are ratios of these sums, the blocks entirely
+# inside a region give their exact contributions.  Only the blocks crossed
+# by the region's boundary are uncertain: their populated pixels may or
+# may not be in the region, and their densities lie between the min and
+# max of the blocks.  The PWPD (a population-weighted mean of d) is then
+# bounded by
+#
+#     min(m_in, (S2_in + d_min*W)/(S1_in + W))   and
+#     max(m_in, (S2_in + d_max*W)/(S1_in + W))
+#
+# where S1_in, S2_in are the sums over the inside blocks, m_in = S2_in/S1_in,
+# and W is the population of the boundary blocks (and likewise for
+# PWlogPD with log(d)).  The estimate weights each boundary block by the
+# fraction of its area in the region (see pwpd_coverage.py).
+#
+# get_progressive_estimates() starts from the whole window at the
+# coarsest level and then, one level at a time, reads only the children
+# of the boundary blocks of the level above, down to the pixels of the
+# image itself, where the result is exact (the same as
+# pwpd.get_pop_pwpd_pwlogpd, up to rounding, with the pixels weighted by
+# their coverage if pwpd.coverage_weighting, and with the hot pixels of
+# the region removed if a hot-pixel layer is loaded, see
+# pwpd_hotpixels.py):
+#
+#     for est in pwpd.get_pop_pwpd_pwlogpd(country_t, progressive=True):
+#         print(est['factor'], est['pwpd'], est['pwpd_bounds'])
+#
+# Each refinement reads about the boundary of the region at the next
+# level, so the first estimates of large countries take a fraction of a
+# second, and the exact result does not need to read the interior.
+#
+import os
+import contextlib
+import time
+import numpy as np
+import rasterio
+import rasterio.features
+from rasterio.windows import Window
+import pwpd
+import pwpd_trace
+
+#--- Overviews at factors 2, 4, ..., 2**progressive_levels
+progressive_levels = 6
+#--- Directory for the overviews (None: next to the population image)
+overview_dir = None
+#--- The children of the boundary blocks are read in windows of (at most)
+#    this many pixels per side
+progressive_read_tile = 256
+#--- Overviews are built in tiles of this many blocks of the coarsest
+#    level per side (bounds the memory)
+overview_tile_blocks = 64
+#--- Block size of the overview GeoTIFFs (small blocks, since each read
+#    is of the blocks along a boundary, and each block holds 5 bands)
+overview_block = 128
+
+overview_bands = ['S1', 'S2', 'SL', 'dmax', 'dmin']
+
+def get_overview_filepath(level):
+    """Overview of the current population image at factor 2**level"""
+    if (pwpd.popimage_type == 'GHS'):
+        filepath = pwpd.GHS_filepath
+    else:
+        filepath = pwpd.GPW_popcount_filepath
+    (root, ext) = os.path.splitext(os.path.basename(filepath))
+    outdir = os.path.dirname(filepath) if overview_dir is None else overview_dir
+    return os.path.join(outdir, f"{root:s}_pwpd-overview{2**level:d}.tif")
+
+def get_pixel_quantities(pop, density):
+    """The five overview bands of single pixels"""
+    pop = pop.astype(np.float64)
+    density = density.astype(np.float64)
+    populated = (pop > 0)
+    S1 = np.where(populated, pop, 0.0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        S2 = np.where(populated, pop*density, 0.0)
+        SL = np.where(populated, pop*np.log(density), 0.0)
+    dmax = np.where(populated, density, -np.inf)
+    dmin = np.where(populated, density, np.inf)
+    return np.stack([S1, S2, SL, dmax, dmin])
+
+def aggregate2(q):
+    """Overview bands of the 2x2 blocks of an array of overview bands"""
+    (nb, h, w) = q.shape
+    (H, W) = (h + h % 2, w + w % 2)
+    padded = np.empty((nb, H, W))
+    padded[:3] = 0.0
+    padded[3] = -np.inf
+    padded[4] = np.inf
+    padded[:, :h, :w] = q
+    blocks = padded.reshape(nb, H//2, 2, W//2, 2)
+    return np.concatenate([blocks[:3].sum(axis=(2, 4)),
+                           blocks[3:4].max(axis=(2, 4)),
+                           blocks[4:5].min(axis=(2, 4))])
+
+def read_pixels(datasets, window):
+    """Overview bands of the pixels of the population image in a window"""
+    pop = datasets['count'].read(1, window=window)
+    if 'density' in datasets:
+        density = datasets['density'].read(1, window=window)
+    else:
+        density = pop / pwpd.GHS_Acell_in_kmsqd
+    return get_pixel_quantities(pop, density)
+
+def open_raster(filepath, exitstack):
+    """Open dataset closed with the contextlib.ExitStack, or, if
+    pwpd.keep_rasters_open, the handle kept open between calls (so that
+    the blocks already read stay in the GDAL block cache)"""
+    if pwpd.keep_rasters_open:
+        return pwpd.get_open_raster(filepath)
+    return exitstack.enter_context(rasterio.open(filepath))
+
+def open_image(exitstack):
+    datasets = {}
+    if (pwpd.popimage_type == 'GHS'):
+        datasets['count'] = open_raster(pwpd.GHS_filepath, exitstack)
+    else:
+        datasets['count'] = open_raster(pwpd.GPW_popcount_filepath, exitstack)
+        datasets['density'] = open_raster(pwpd.GPW_popdensity_filepath,
+                                          exitstack)
+    return datasets
+
+def build_overviews():
+    """Build the overviews of the current population image (see
+    pwpd.set_popimage_pars), one tile at a time"""
+    with contextlib.ExitStack() as exitstack:
+        datasets = open_image(exitstack)
+        src = datasets['count']
+        outs = {}
+        for level in range(1, progressive_levels + 1):
+            factor = 2**level
+            profile = {'driver': 'GTiff', 'dtype': 'float64',
+                       'count': len(overview_bands), 'crs': src.crs,
+                       'transform': src.transform*rasterio.Affine.scale(factor),
+                       'height': -(-src.height//factor),
+                       'width': -(-src.width//factor),
+                       'tiled': True, 'blockxsize': overview_block,
+                       'blockysize': overview_block,
+                       'compress': 'ZSTD', 'predictor': 3,
+                       'BIGTIFF': 'IF_SAFER'}
+            outs[level] = exitstack.enter_context(
+                rasterio.open(get_overview_filepath(level), 'w', **profile))
+            outs[level].descriptions = tuple(overview_bands)
+        tile = overview_tile_blocks*2**progressive_levels
+        for row0 in range(0, src.height, tile):
+            for col0 in range(0, src.width, tile):
+                window = Window(col0, row0, min(tile, src.width - col0),
+                                min(tile, src.height - row0))
+                q = read_pixels(datasets, window)
+                for level in range(1, progressive_levels + 1):
+                    q = aggregate2(q)
+                    factor = 2**level
+                    outs[level].write(q, window=Window(
+                        col0//factor, row0//factor, q.shape[2], q.shape[1]))
+
+def get_tile_windows(mask):
+    """Windows (one per progressive_read_tile square tile) around the
+    pixels of the mask"""
+    (rows, cols) = np.nonzero(mask)
+    if (rows.size == 0):
+        return []
+    tile = (rows//progressive_read_tile)*(mask.shape[1]//progressive_read_tile + 1) \
+        + cols//progressive_read_tile
+    order = np.argsort(tile, kind='stable')
+    (tile, rows, cols) = (tile[order], rows[order], cols[order])
+    starts = np.flatnonzero(np.r_[True, tile[1:] != tile[:-1]])
+    (r0, r1) = (np.minimum.reduceat(rows, starts), np.maximum.reduceat(rows, starts))
+    (c0, c1) = (np.minimum.reduceat(cols, starts), np.maximum.reduceat(cols, starts))
+    return [Window(int(c), int(r), int(cc - c + 1), int(rr - r + 1))
+            for (r, rr, c, cc) in zip(r0, r1, c0, c1)]
+
+def get_bounds(S_in, W, q_min, q_max):
+    """Bounds of a weighted mean with exact part S_in = (weight, weighted
+    sum), plus up to W more weight with values in [q_min, q_max]"""
+    (W_in, Q_in) = S_in
+    if (W <= 0):
+        return (Q_in/W_in, Q_in/W_in) if (W_in > 0) else (np.nan, np.nan)
+    lower = (Q_in + q_min*W)/(W_in + W)
+    upper = (Q_in + q_max*W)/(W_in + W)
+    if (W_in > 0):
+        lower = min(lower, Q_in/W_in)
+        upper = max(upper, Q_in/W_in)
+    return (lower, upper)
+
+def get_progressive_estimates(window_df):
+    """
+    Generator of the estimates of the pop, PWPD and PWlogPD of the
+    region(s) in window_df, from the coarsest overview down to the image
+    itself, each a dict with the level and factor, the estimates 'pop',
+    'pwpd', 'pwlogpd', their bounds ('pop_bounds', ...), the number of
+    boundary blocks, the time since the start and whether it is 'exact'
+    """
+    windowshapes = window_df["geometry"]
+    t0 = time.perf_counter()
+    with contextlib.ExitStack() as exitstack:
+        image = open_image(exitstack)
+        overviews = {}
+        for level in range(1, progressive_levels + 1):
+            filepath = get_overview_filepath(level)
+            if not os.path.exists(filepath):
+                print("\n***Error: No PWPD overview found at")
+                print("\n", filepath, "\n")
+                print("          Build them with pwpd_progressive.build_overviews()")
+                exit(0)
+            overviews[level] = open_raster(filepath, exitstack)
+        # exact sums over the blocks found to be inside the region
+        S_in = np.zeros(3)
+        parent_edge = None
+        for level in range(progressive_levels, -1, -1):
+            src = overviews[level] if (level > 0) else image['count']
+            window = rasterio.features.geometry_window(src, windowshapes)
+            (row_off, col_off) = (int(window.row_off), int(window.col_off))
+            shape = (int(window.height), int(window.width))
+            transform = src.window_transform(window)
+            with pwpd_trace.stage('progressive_classify'):
+                if (level > 0):
+                    import pwpd_coverage
+                    (coverage, edge) = pwpd_coverage.get_coverage(
+                        windowshapes, shape, transform, return_edge=True)
+                    inside = (coverage > 0) & ~edge
+                elif pwpd.coverage_weighting:
+                    # (the pixels of the image weighted by their coverage,
+                    # as by pwpd.get_pop_pwpd_pwlogpd)
+                    import pwpd_coverage
+                    coverage = pwpd_coverage.get_coverage(windowshapes, shape,
+                                                          transform)
+                    inside = (coverage > 0)
+                    edge = np.zeros(shape, dtype=bool)
+                else:
+                    # (the pixels of the image are in if their centers are)
+                    coverage = None
+                    inside = ~rasterio.features.geometry_mask(
+                        windowshapes, shape, transform)
+                    edge = np.zeros(shape, dtype=bool)
+            # the blocks to read: the whole window at the coarsest level,
+            # then the children of the boundary blocks of the level above
+            if parent_edge is None:
+                active = np.ones(shape, dtype=bool)
+                reads = [Window(0, 0, shape[1], shape[0])]
+            else:
+                active = np.zeros(shape, dtype=bool)
+                (prow, pcol) = parent_edge
+                for (i, j) in [(0, 0), (0, 1), (1, 0), (1, 1)]:
+                    (r, c) = (2*prow + i - row_off, 2*pcol + j - col_off)
+                    ok = (r >= 0) & (r < shape[0]) & (c >= 0) & (c < shape[1])
+                    active[r[ok], c[ok]] = True
+                reads = get_tile_windows(active)
+            Nedge = 0
+            W_edge = 0.0
+            S_est = np.zeros(3)
+            (d_min, d_max) = (np.inf, -np.inf)
+            edge_rows = []
+            edge_cols = []
+            with pwpd_trace.stage('progressive_read',
+                                  level=level, reads=len(reads)) as span:
+                nbytes = 0
+                for w in reads:
+                    read_window = Window(col_off + w.col_off,
+                                         row_off + w.row_off, w.width, w.height)
+                    if (level > 0):
+                        q = src.read(window=read_window)
+                    else:
+                        q = read_pixels(image, read_window)
+                    nbytes += q.nbytes
+                    rsl = slice(int(w.row_off), int(w.row_off + w.height))
+                    csl = slice(int(w.col_off), int(w.col_off + w.width))
+                    q_active = active[rsl, csl]
+                    q_in = inside[rsl, csl] & q_active
+                    if ( (level == 0) & (coverage is not None) ):
+                        S_in += (q[:3, q_in]
+                                 * coverage[rsl, csl][q_in]).sum(axis=1)
+                    else:
+                        S_in += q[:3, q_in].sum(axis=1)
+                    q_edge = edge[rsl, csl] & q_active & (q[0] > 0)
+                    if q_edge.any():
+                        Nedge += int(np.count_nonzero(q_edge))
+                        W_edge += q[0, q_edge].sum()
+                        S_est += (q[:3, q_edge]
+                                  * coverage[rsl, csl][q_edge]).sum(axis=1)
+                        d_max = max(d_max, q[3, q_edge].max())
+                        d_min = min(d_min, q[4, q_edge].min())
+                    # the populated boundary blocks are refined (the
+                    # children of the others are all unpopulated)
+                    (er, ec) = np.nonzero(q_edge)
+                    edge_rows.append(er + rsl.start + row_off)
+                    edge_cols.append(ec + csl.start + col_off)
+                span.add(bytes=nbytes)
+            parent_edge = (np.concatenate(edge_rows), np.concatenate(edge_cols))
+            if ( (level == 0) & (pwpd.hot_pixels is not None)
+                 & (pwpd.popimage_type == 'GHS') ):
+                # (the hot pixels are removed, as by pwpd.get_pwpd_from_count)
+                import pwpd_hotpixels
+                S_in -= pwpd_hotpixels.get_hot_pixel_sums(inside, transform,
+                                                          coverage)
+            S = S_in + S_est
+            with np.errstate(divide='ignore', invalid='ignore'):
+                estimate = {'level': level, 'factor': 2**level,
+                            'exact': (level == 0),
+                            'pop': S[0], 'pwpd': S[1]/S[0],
+                            'pwlogpd': S[2]/S[0],
+                            'pop_bounds': (S_in[0], S_in[0] + W_edge),
+                            'pwpd_bounds': get_bounds(S_in[:2], W_edge,
+                                                      d_min, d_max),
+                            'pwlogpd_bounds': get_bounds(S_in[[0, 2]], W_edge,
+                                                         np.log(d_min),
+                                                         np.log(d_max)),
+                            'edge_blocks': Nedge,
+                            'seconds': time.perf_counter() - t0}
+            yield estimate
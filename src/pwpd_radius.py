@@ -0,0 +1,163 @@
+# Use the pwpd.yml conda environment
+#
+# Population, PWPD and PWlogPD within a radius of each of many points
+# (hospitals, transit stops, ...), without buffer polygons.
+#
+# Pushing a buffer polygon of each point through rasterio.mask.mask costs
+# a polygon, a window read and a rasterization per point.  Here the pixels
+# in the circle are found analytically on the pixel grid: a pixel is in it
+# if its center is within the radius of the point,
+#
+#     Mollweide (GHS):  (dx**2 + dy**2) <= R**2   in the image plane (m),
+#     WGS84 (GPW):      (dlon*cos(lat)*k)**2 + (dlat*k)**2 <= R**2,
+#
+# with k the km per degree of a great circle and cos(lat) taken at each
+# row of the window (so the circle is an ellipse in the image, narrowing
+# toward the equator).  The distance in the Mollweide plane is exact in
+# the projection, which is equal area but not conformal, so far from the
+# central meridian and the equator the circle is a slightly sheared
+# ellipse on the ground.
+#
+# The points are bucketed by the radius_cache_pixels x radius_cache_pixels
+# tile of the image that they fall in, and the window around all of the
+# circles of a bucket is read once (from the shared block cache, if one
+# is attached, see pwpd_blockcache.py); each circle is then a slice of
+# that window, masked and reduced with pwpd.get_fused_sums (as in
+# pwpd.get_pwpd_from_count), in the order of the input:
+#
+#     pwpd.set_popimage_pars('GHS', '2015', '1km')
+#     df = pwpd_radius.get_radius_pwpd(lats, lons, 10.0)
+#
+#     columns = ['lat', 'lon', 'radius_km', 'pixels', 'pop', 'pwpd',
+#                'pwlogpd', 'gamma', 'centroid_lat', 'centroid_lon']
+#
+# with gamma over the area of the circle, pi*R**2.  The pixels are not
+# weighted by their coverage by the circle (pwpd.coverage_weighting).
+#
+import numpy as np
+import pandas as pd
+import rasterio
+from rasterio.windows import Window
+import pwpd
+import pwpd_trace
+import pwpd_points
+
+#--- Side (pixels) of the tiles in which the points share a window
+radius_cache_pixels = 1024
+#--- Mean radius of the Earth (km), for the degrees of the WGS84 images
+earth_radius_km = 6371.0088
+
+def read_window(filepath, window):
+    """The pixels of the image at filepath in the window (within the
+    image), from the block cache if one is attached"""
+    cache = pwpd.block_cache
+    if ( (cache is not None) and (filepath in cache.fileids) ):
+        return cache.read_window(filepath, window)
+    if pwpd.keep_rasters_open:
+        return pwpd.get_open_raster(filepath).read(1, window=window)
+    with rasterio.open(filepath) as src:
+        return src.read(1, window=window)
+
+def get_pixel_scales(transform, rows):
+    """(km per row, km per col) of the pixels, the latter for each of the
+    rows if the image is in lat/lon"""
+    if pwpd.is_geographic(pwpd.get_image_crs()):
+        km_per_degree = np.pi*earth_radius_km/180.0
+        lat = transform.f + (np.asarray(rows) + 0.5)*transform.e
+        return (abs(transform.e)*km_per_degree,
+                transform.a*km_per_degree*np.cos(np.radians(lat)))
+    return (abs(transform.e)/1e3, np.full(np.shape(rows), transform.a/1e3))
+
+def get_circle_boxes(row, col, radius_km, transform, shape):
+    """[r0, r1) x [c0, c1) pixel boxes (clipped to the image) of the
+    circles about the (fractional) pixel positions (row, col)"""
+    (H, W) = shape
+    (km_per_row, km_per_col) = get_pixel_scales(transform, row)
+    half_rows = radius_km/km_per_row
+    r0 = np.clip(np.floor(row - half_rows), 0, H).astype(np.int64)
+    r1 = np.clip(np.ceil(row + half_rows) + 1, 0, H).astype(np.int64)
+    # (in lat/lon, the circle is widest on its poleward row)
+    (s0, s1) = (get_pixel_scales(transform, r0)[1],
+                get_pixel_scales(transform, r1 - 1)[1])
+    half_cols = radius_km/np.maximum(np.minimum(s0, s1), 1e-9)
+    c0 = np.clip(np.floor(col - half_cols), 0, W).astype(np.int64)
+    c1 = np.clip(np.ceil(col + half_cols) + 1, 0, W).astype(np.int64)
+    return (r0, r1, c0, c1)
+
+def get_circle_mask(row, col, radius_km, r0, r1, c0, c1, transform):
+    """Which pixels of the box [r0, r1) x [c0, c1) have their centers
+    within radius_km of the (fractional) pixel position (row, col)"""
+    rows = np.arange(r0, r1)
+    (km_per_row, km_per_col) = get_pixel_scales(transform, rows)
+    dy = (rows + 0.5 - row)*km_per_row
+    dx = (np.arange(c0, c1) + 0.5 - col)[np.newaxis, :] \
+        * km_per_col[:, np.newaxis]
+    return (dy[:, np.newaxis]**2 + dx**2) <= radius_km**2
+
+def get_radius_pwpd(lats, lons, radius_km, do_gamma=True):
+    """
+    Pixels, population, PWPD, PWlogPD, gamma (over pi*radius_km**2) and
+    population centroid within radius_km (a number, or one per point) of
+    each of the points (lat/lon, EPSG:4326), as a dataframe with one row
+    per point (see above)
+    """
+    lats = np.asarray(lats, dtype=np.float64)
+    lons = np.asarray(lons, dtype=np.float64)
+    radius_km = np.broadcast_to(np.asarray(radius_km, dtype=np.float64),
+                                lats.shape)
+    N = lats.size
+    filepaths = pwpd_points.get_image_filepaths()
+    (transform, shape) = pwpd_points.get_image_grid()
+    # (fractional pixel positions, with pixel centers at +0.5)
+    (x, y, rows, cols) = pwpd_points.get_point_pixels(lats, lons)
+    (col, row) = ~transform*(x, y)
+    (r0, r1, c0, c1) = get_circle_boxes(row, col, radius_km, transform,
+                                        shape)
+    (Npix, S1, S2, SL) = (np.zeros(N, dtype=np.int64), np.zeros(N),
+                          np.zeros(N), np.zeros(N))
+    (pc_row, pc_col) = (np.full(N, np.nan), np.full(N, np.nan))
+    # the points (with circles on the image) by tile
+    valid = np.flatnonzero((r1 > r0) & (c1 > c0))
+    T = radius_cache_pixels
+    tile = (np.clip(rows[valid], 0, shape[0] - 1)//T)*(-(-shape[1]//T)) \
+        + np.clip(cols[valid], 0, shape[1] - 1)//T
+    order = np.argsort(tile, kind='stable')
+    (valid, tile) = (valid[order], tile[order])
+    starts = np.flatnonzero(np.r_[True, tile[1:] != tile[:-1]])
+    ends = np.r_[starts[1:], tile.size]
+    with pwpd_trace.stage('radius_queries', points=N, windows=starts.size):
+        for (i0, i1) in zip(starts, ends):
+            group = valid[i0:i1]
+            (R0, R1) = (r0[group].min(), r1[group].max())
+            (C0, C1) = (c0[group].min(), c1[group].max())
+            window = Window(C0, R0, C1 - C0, R1 - R0)
+            popimg = read_window(filepaths[0], window)
+            pdimg = read_window(filepaths[1], window) \
+                if (len(filepaths) > 1) else None
+            for i in group:
+                box = (slice(r0[i] - R0, r1[i] - R0),
+                       slice(c0[i] - C0, c1[i] - C0))
+                mask = get_circle_mask(row[i], col[i], radius_km[i],
+                                       r0[i], r1[i], c0[i], c1[i], transform)
+                box_transform = transform*transform.translation(c0[i], r0[i])
+                (S1[i], S2[i], SL[i], moments) = pwpd.get_fused_sums(
+                    popimg[box], pdimg=None if pdimg is None else pdimg[box],
+                    Acell_in_kmsqd=pwpd.GHS_Acell_in_kmsqd,
+                    img_transform=box_transform, coverage=mask)
+                Npix[i] = np.count_nonzero(mask)
+                (pr, pc) = pwpd.get_pop_centroid(moments, S1[i], box_transform)
+                (pc_row[i], pc_col[i]) = (r0[i] + pr, c0[i] + pc)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        populated = (S1 > 0)
+        pwd = np.where(populated, S2/S1, 0.0)
+        pwlogpd = np.where(populated, SL/S1, 0.0)
+    result = {'lat': lats, 'lon': lons, 'radius_km': radius_km,
+              'pixels': Npix, 'pop': S1, 'pwpd': pwd, 'pwlogpd': pwlogpd}
+    if do_gamma:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            result['gamma'] = pwpd.get_gamma(S1, np.pi*radius_km**2, pwd,
+                                             pwpd.popimage_type,
+                                             pwpd.popimage_resolution)
+    (result['centroid_lat'], result['centroid_lon']) = \
+        pwpd.get_pixel_latlon(pc_row, pc_col, transform)
+    return pd.DataFrame(result)
@@ -0,0 +1,527 @@
+# Use the pwpd.yml conda environment
+#
+# Memory-aware scheduling of the regions of a run over a pool of worker
+# processes.
+#
+# The windows of the regions differ in size by four to five orders of
+# magnitude (Manhattan and Alaska, or Nunavut), so a plain pool of N
+# workers either runs out of memory when several giants meet, or leaves
+# cores idle behind one.  plan_regions() first finds, from the bounds of
+# the (transformed) shapes alone, without reading any pixels, the window
+# of each region and the bytes it needs (the masked reads, the mask and
+# the coverage, see get_bytes_per_pixel) and its time (a fixed cost plus
+# a cost per window pixel, see calibrate()).  Then
+#
+#   * regions above schedule_giant_fraction of the memory budget run
+#     alone, and those above the budget itself run tiled, in row strips
+#     of the window that each fit the budget (the sums of the strips add
+#     up exactly, see get_tiled_pop_pwpd_pwlogpd),
+#   * the small regions are packed into tasks of about
+#     schedule_batch_seconds each (so that the pool's overhead per task is
+#     small next to the work), largest first,
+#
+# and the tasks are started, longest first, whenever a worker is free and
+# the bytes of the tasks in flight stay within schedule_memory_budget.  The
+# same rules are simulated before the run, which gives its makespan and
+# peak memory in advance (the makespan assumes a core for each worker):
+#
+#     shapes_t = pwpd.transform_shapefile(countyshapes_df)
+#     plan = pwpd_schedule.plan_regions(shapes_t)
+#     pwpd_schedule.print_plan(plan)
+#     df = pwpd_schedule.run_plan(shapes_t, plan)
+#
+# A single huge region (Russia or Canada at 250m) would still run on one
+# core, so with pwpd.region_Nworkers set, pwpd.get_pop_pwpd_pwlogpd splits
+# the window of a large region into row strips, clipped from the region
+# in the parent, that are masked, read and reduced on a pool of that many
+# workers (see get_parallel_pop_pwpd_pwlogpd).  The sums of the strips,
+# and the centroid moments shifted to the region's window, add up to those
+# of the single window.
+#
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import numpy as np
+import pandas as pd
+import rasterio
+import pwpd
+import pwpd_progress
+import pwpd_trace
+
+#--- Memory budget (bytes) of the windows in flight (None: half of the
+#    machine's memory)
+schedule_memory_budget = None
+#--- Number of worker processes (None: number of CPUs)
+schedule_Nworkers = None
+#--- Regions above this fraction of the memory budget run alone
+schedule_giant_fraction = 0.25
+#--- Small regions are packed into tasks of about this many seconds
+schedule_batch_seconds = 0.5
+#--- Time model of a region: a fixed cost and a cost per window pixel
+#    (seconds; fit them on the current machine and image with calibrate)
+schedule_seconds_per_region = 5.0e-3
+schedule_seconds_per_pixel = 2.0e-8
+#--- Resident memory of an idle worker process (bytes)
+schedule_worker_base_bytes = 150e6
+
+image_grids = {}
+
+def get_memory_budget():
+    if schedule_memory_budget is not None:
+        return schedule_memory_budget
+    return os.sysconf('SC_PAGE_SIZE')*os.sysconf('SC_PHYS_PAGES')/2
+
+def get_Nworkers():
+    return os.cpu_count() if schedule_Nworkers is None else schedule_Nworkers
+
+def get_image_filepaths():
+    if (pwpd.popimage_type == 'GHS'):
+        return [pwpd.GHS_filepath]
+    return [pwpd.GPW_popcount_filepath, pwpd.GPW_popdensity_filepath]
+
+def get_image_grid():
+    """(transform, shape, itemsizes) of the current population image(s)"""
+    filepaths = tuple(get_image_filepaths())
+    if filepaths not in image_grids:
+        itemsizes = []
+        for f in filepaths:
+            with rasterio.open(f) as src:
+                (transform, shape) = (src.transform, src.shape)
+                itemsizes.append(np.dtype(src.dtypes[0]).itemsize)
+        image_grids[filepaths] = (transform, shape, itemsizes)
+    return image_grids[filepaths]
+
+def get_bytes_per_pixel():
+    """
+    Peak bytes per window pixel of one region: for each image, the masked
+    read (rasterio.mask.mask holds the data, its mask, and the filled
+    copy), plus the coverage and boundary pixels if pwpd.coverage_weighting.
+    (The reduction itself works on reduction_block_rows rows at a time.)
+    """
+    (transform, shape, itemsizes) = get_image_grid()
+    nbytes = sum(2*itemsize + 1 for itemsize in itemsizes)
+    if pwpd.coverage_weighting:
+        nbytes += 4 + 1 + 1
+    return nbytes
+
+def get_windows(bounds, transform, shape):
+    """(row_off, col_off, height, width) of the windows of the pixels
+    within the (minx, miny, maxx, maxy) bounds, clipped to the image"""
+    (minx, miny, maxx, maxy) = np.asarray(bounds, dtype=np.float64).T
+    (a, c, e, f) = (transform.a, transform.c, transform.e, transform.f)
+    (c0, c1) = np.sort([(minx - c)/a, (maxx - c)/a], axis=0)
+    (r0, r1) = np.sort([(maxy - f)/e, (miny - f)/e], axis=0)
+    c0 = np.clip(np.floor(c0), 0, shape[1]).astype(np.int64)
+    c1 = np.clip(np.ceil(c1), 0, shape[1]).astype(np.int64)
+    r0 = np.clip(np.floor(r0), 0, shape[0]).astype(np.int64)
+    r1 = np.clip(np.ceil(r1), 0, shape[0]).astype(np.int64)
+    return (r0, c0, r1 - r0, c1 - c0)
+
+def get_region_seconds(pixels):
+    return schedule_seconds_per_region + schedule_seconds_per_pixel*pixels
+
+def plan_regions(shapes_t):
+    """
+    Plan the run of the regions (rows) of shapes_t, already transformed to
+    the coordinates of the population image: the window and bytes of each
+    region and the tasks they are packed into, with the makespan and peak
+    memory of the run as simulated with the same rules as run_plan
+    """
+    (transform, shape, itemsizes) = get_image_grid()
+    budget = get_memory_budget()
+    Nworkers = get_Nworkers()
+    (rows, cols, height, width) = get_windows(shapes_t.geometry.bounds.values,
+                                              transform, shape)
+    regions = pd.DataFrame({'row_off': rows, 'col_off': cols,
+                            'height': height, 'width': width})
+    regions['pixels'] = regions['height']*regions['width']
+    regions['bytes'] = regions['pixels']*get_bytes_per_pixel()
+    regions['seconds'] = get_region_seconds(regions['pixels'])
+    # the giants run alone, and those that do not fit the budget, tiled
+    regions['Ntiles'] = np.maximum(
+        1, np.ceil(regions['bytes']/budget)).astype(int)
+    regions['mode'] = 'batch'
+    regions.loc[regions['bytes'] > schedule_giant_fraction*budget,
+                'mode'] = 'alone'
+    regions.loc[regions['Ntiles'] > 1, 'mode'] = 'tiled'
+    regions['task'] = -1
+    tasks = []
+    order = np.argsort(-regions['seconds'].values, kind='stable')
+    (batch, batch_seconds) = ([], 0.0)
+    for i in order:
+        if (regions.at[i, 'mode'] != 'batch'):
+            tasks.append([i])
+            continue
+        # (next fit, in decreasing order of time)
+        batch.append(i)
+        batch_seconds += regions.at[i, 'seconds']
+        if (batch_seconds >= schedule_batch_seconds):
+            tasks.append(batch)
+            (batch, batch_seconds) = ([], 0.0)
+    if batch:
+        tasks.append(batch)
+    plan_tasks = []
+    for (t, members) in enumerate(tasks):
+        regions.loc[members, 'task'] = t
+        # (the regions of a task are run one after the other, and a tiled
+        # region holds one strip at a time)
+        plan_tasks.append({
+            'regions': [int(i) for i in members],
+            'exclusive': (regions.at[members[0], 'mode'] != 'batch'),
+            'bytes': float((regions.loc[members, 'bytes']
+                            / regions.loc[members, 'Ntiles']).max()),
+            'seconds': float(regions.loc[members, 'seconds'].sum())})
+    (makespan, peak_bytes) = simulate(plan_tasks, Nworkers, budget)
+    return {'regions': regions, 'tasks': plan_tasks, 'Nworkers': Nworkers,
+            'budget': budget, 'makespan': makespan, 'peak_bytes': peak_bytes,
+            'peak_rss': (pwpd_progress.get_rss_MB()*1e6
+                         + Nworkers*schedule_worker_base_bytes + peak_bytes)}
+
+def get_task_order(tasks):
+    """The tasks are started longest first"""
+    return sorted(range(len(tasks)), key=lambda t: -tasks[t]['seconds'])
+
+def can_start(task, running, Nworkers, budget):
+    """Whether the task can start next to the running ones (a list of
+    tasks): a worker is free and the bytes in flight fit the budget, or,
+    for an exclusive task, nothing else is running"""
+    if task['exclusive']:
+        return (len(running) == 0)
+    if running and running[0]['exclusive']:
+        return False
+    return ( (len(running) < Nworkers)
+             and ( (len(running) == 0)
+                   or (sum(r['bytes'] for r in running) + task['bytes']
+                       <= budget) ) )
+
+def simulate(tasks, Nworkers, budget):
+    """(makespan, peak bytes in flight) of the tasks with their estimated
+    times, started in order as soon as can_start allows"""
+    t = 0.0
+    running = []
+    peak_bytes = 0.0
+    for k in get_task_order(tasks):
+        task = tasks[k]
+        while not can_start(task, [r for (end, r) in running], Nworkers,
+                            budget):
+            # wait for the next task to finish
+            running.sort(key=lambda x: x[0])
+            (t, r) = running.pop(0)
+        running.append((t + task['seconds'], task))
+        peak_bytes = max(peak_bytes, sum(r['bytes'] for (end, r) in running))
+    makespan = max([end for (end, r) in running], default=t)
+    return (makespan, peak_bytes)
+
+def print_plan(plan):
+    regions = plan['regions']
+    print("=" * 80)
+    print(f"Plan: {len(regions):d} regions in {len(plan['tasks']):d} tasks"
+          + f" on {plan['Nworkers']:d} workers,"
+          + f" memory budget {plan['budget']/1e6:,.0f} MB")
+    for mode in ['batch', 'alone', 'tiled']:
+        sel = (regions['mode'] == mode)
+        if sel.any():
+            print(f"    {mode:s}: {int(sel.sum()):d} regions,"
+                  + f" {regions.loc[sel, 'pixels'].sum():,d} pixels,"
+                  + f" largest {regions.loc[sel, 'bytes'].max()/1e6:,.1f} MB"
+                  + (f" in {regions.loc[sel, 'Ntiles'].max():d} strips"
+                     if (mode == 'tiled') else ""))
+    print(f"Predicted makespan {pwpd_progress.format_seconds(plan['makespan'])},"
+          + f" peak windows in flight {plan['peak_bytes']/1e6:,.0f} MB,"
+          + f" peak RSS {plan['peak_rss']/1e6:,.0f} MB")
+    print("=" * 80)
+
+def calibrate(shapes_t, Nsample=20):
+    """Fit schedule_seconds_per_region and schedule_seconds_per_pixel by
+    timing Nsample regions of shapes_t (spread over their window sizes)"""
+    global schedule_seconds_per_region, schedule_seconds_per_pixel
+    (transform, shape, itemsizes) = get_image_grid()
+    (rows, cols, height, width) = get_windows(shapes_t.geometry.bounds.values,
+                                              transform, shape)
+    pixels = height*width
+    order = np.argsort(pixels, kind='stable')
+    sample = order[np.linspace(0, len(order) - 1,
+                               min(Nsample, len(order))).astype(int)]
+    seconds = []
+    for i in sample:
+        t0 = time.perf_counter()
+        pwpd.get_pop_pwpd_pwlogpd(shapes_t.iloc[[i]])
+        seconds.append(time.perf_counter() - t0)
+    A = np.vstack([np.ones(len(sample)), pixels[sample]]).T
+    (schedule_seconds_per_region, schedule_seconds_per_pixel) = \
+        np.maximum(np.linalg.lstsq(A, np.array(seconds), rcond=None)[0], 0.0)
+    return (schedule_seconds_per_region, schedule_seconds_per_pixel)
+
+############################################################
+#          Tiled evaluation of a region (row strips)       #
+############################################################
+
+def read_strip(geom):
+    """Masked read(s) of the population image(s) for (a strip of) a region,
+    and the coverage of its pixels (if pwpd.coverage_weighting)"""
+    filepaths = get_image_filepaths()
+    (popimg, img_transform) = pwpd.get_masked_subimage(
+        [geom], filepaths[0], all_touched=pwpd.coverage_weighting)
+    pdimg = None
+    if (len(filepaths) > 1):
+        (pdimg, pdimg_transform) = pwpd.get_masked_subimage(
+            [geom], filepaths[1], all_touched=pwpd.coverage_weighting)
+    coverage = pwpd.get_region_coverage({'geometry': [geom]}, popimg,
+                                        img_transform)
+    return (popimg, pdimg, img_transform, coverage)
+
+def clip_to_rows(geom, row0, row1, window):
+    """The part of the region in rows row0 to row1 of its window
+    (row_off, col_off, height, width), or None if it has none"""
+    import shapely
+    (transform, shape, itemsizes) = get_image_grid()
+    (row_off, col_off, height, width) = window
+    # (the strip edges are pixel edges, so each pixel keeps its membership)
+    (x0, y0) = transform*(col_off, row0)
+    (x1, y1) = transform*(col_off + width, row1)
+    part = shapely.clip_by_rect(geom, min(x0, x1), min(y0, y1),
+                                max(x0, x1), max(y0, y1))
+    return None if part.is_empty else part
+
+def get_part_sums(part, window):
+    """(S1, S2, SL, centroid moments, candidate hot pixels) of the pixels
+    of a part of a region, with the moments relative to the window
+    (row_off, col_off, height, width) of the whole region, or None for no
+    part.  The candidates (see pwpd_hotpixels.py) are None if no hot-pixel
+    layer is loaded."""
+    if part is None:
+        return None
+    (transform, shape, itemsizes) = get_image_grid()
+    (row_off, col_off, height, width) = window
+    (popimg, pdimg, img_transform, coverage) = read_strip(part)
+    (S1, S2, SL, moments) = pwpd.get_fused_sums(
+        popimg, pdimg=pdimg, Acell_in_kmsqd=pwpd.GHS_Acell_in_kmsqd,
+        img_transform=img_transform, coverage=coverage)
+    if (np.size(moments) == 2):
+        # (sum p*row, sum p*col) in the rows and columns of the window
+        (col, row) = ~transform*(img_transform.c, img_transform.f)
+        moments = moments + np.array([round(row) - row_off,
+                                      round(col) - col_off])*S1
+    candidates = None
+    if ( (pwpd.hot_pixels is not None) & (pdimg is None) ):
+        import pwpd_hotpixels
+        candidates = pwpd_hotpixels.get_window_candidates(popimg,
+                                                          img_transform,
+                                                          coverage)
+    return (np.array([S1, S2, SL]), moments, candidates)
+
+def get_strip_sums(geom, row0, row1, window):
+    """Sums (see get_part_sums) of the pixels of the region in rows row0
+    to row1 of its window"""
+    return get_part_sums(clip_to_rows(geom, row0, row1, window), window)
+
+def get_strip_rows(window, Ntiles):
+    (row_off, col_off, height, width) = window
+    Nrows = -(-height//Ntiles)
+    return [(r, min(r + Nrows, row_off + height))
+            for r in range(row_off, row_off + height, Nrows)]
+
+def combine_strip_sums(strip_sums, window):
+    """Pop, PWPD, PWlogPD, window shape and population centroid of a
+    region from the sums of its strips (as pwpd.get_pop_pwpd_pwlogpd),
+    with the region's hot pixels, picked from the candidates of all of
+    its strips, removed if a hot-pixel layer is loaded"""
+    (transform, shape, itemsizes) = get_image_grid()
+    (row_off, col_off, height, width) = window
+    S = np.zeros(3)
+    moments = 0.0
+    for result in strip_sums:
+        if result is not None:
+            S += result[0]
+            moments = moments + result[1]
+    (totalpop, S2, SL) = S
+    window_transform = transform*rasterio.Affine.translation(col_off, row_off)
+    if pwpd.hot_pixels is not None:
+        import pwpd_hotpixels
+        candidates = pwpd_hotpixels.merge_candidates(
+            [result[2] for result in strip_sums if result is not None])
+        (totalpop, S2, SL, moments) = pwpd_hotpixels.remove_hot_pixels(
+            (totalpop, S2, SL, np.atleast_1d(moments)), candidates,
+            window_transform)
+    (pwd, pwlogpd) = (S2/totalpop, SL/totalpop) if (totalpop > 0) \
+        else (0.0, 0.0)
+    (pc_row, pc_col) = pwpd.get_pop_centroid(np.atleast_1d(moments), totalpop,
+                                             window_transform)
+    (lat, lon) = pwpd.get_latlon(pc_col, pc_row, (height, width),
+                                 window_transform)
+    return (totalpop, pwd, pwlogpd, (height, width), lat, lon)
+
+def get_geometry_window(geom):
+    (transform, shape, itemsizes) = get_image_grid()
+    return tuple(int(w[0]) for w in
+                 get_windows([geom.bounds], transform, shape))
+
+def get_tiled_pop_pwpd_pwlogpd(geom, Ntiles, window=None):
+    """
+    Pop, PWPD, PWlogPD, window shape and population centroid of a region
+    (a single geometry, in the image coordinates) read in Ntiles row
+    strips of its window, one at a time
+    """
+    if window is None:
+        window = get_geometry_window(geom)
+    return combine_strip_sums([get_strip_sums(geom, r0, r1, window)
+                               for (r0, r1) in get_strip_rows(window, Ntiles)],
+                              window)
+
+############################################################
+#        Parallel strips of a single large region          #
+############################################################
+
+#--- Number of row strips per worker of a region split over the workers
+#    (more strips than workers, so that the busier strips even out)
+region_strips_per_worker = 4
+#--- Regions with smaller windows are not split
+region_min_pixels = 2**22
+
+region_pool = None
+region_pool_settings = None
+
+def get_region_pool(Nworkers):
+    """The pool of workers for the strips of single regions, kept between
+    regions (and started again if the image settings change)"""
+    global region_pool, region_pool_settings
+    import pwpd_batch
+    import pwpd_blockcache
+    import pwpd_hotpixels
+    settings = (Nworkers, pwpd.popimage_type, pwpd.popimage_epoch,
+                pwpd.popimage_resolution, pwpd.pop_centroid_on_sphere,
+                pwpd.coverage_weighting, pwpd_blockcache.get_spec(),
+                pwpd_hotpixels.get_layer_filepath())
+    if (settings != region_pool_settings):
+        if region_pool is not None:
+            region_pool.shutdown(wait=True)
+        region_pool = ProcessPoolExecutor(
+            max_workers=Nworkers,
+            initializer=pwpd_batch.init_reduction_worker,
+            initargs=settings[1:])
+        region_pool_settings = settings
+    return region_pool
+
+def get_parallel_pop_pwpd_pwlogpd(window_df, Nworkers):
+    """
+    Pop, PWPD, PWlogPD, window shape and population centroid of the
+    region(s) in window_df, as pwpd.get_pop_pwpd_pwlogpd, with the window
+    split into row strips that are masked, read and reduced on Nworkers
+    worker processes, and their sums added
+    """
+    import shapely
+    geom = shapely.union_all(np.asarray(window_df["geometry"]))
+    window = get_geometry_window(geom)
+    if (window[2]*window[3] < region_min_pixels):
+        return combine_strip_sums([get_part_sums(geom, window)], window)
+    Nstrips = min(Nworkers*region_strips_per_worker, window[2])
+    with pwpd_trace.stage('clip_strips', strips=Nstrips):
+        parts = [clip_to_rows(geom, r0, r1, window)
+                 for (r0, r1) in get_strip_rows(window, Nstrips)]
+    pool = get_region_pool(Nworkers)
+    with pwpd_trace.stage('parallel_strips', strips=Nstrips,
+                          window=(window[2], window[3])):
+        futures = [pool.submit(get_part_sums, part, window)
+                   for part in parts if part is not None]
+        strip_sums = [future.result() for future in futures]
+    return combine_strip_sums(strip_sums, window)
+
+############################################################
+#                     Running a plan                       #
+############################################################
+
+def run_task(geoms, Ntiles, windows):
+    """Run the regions of a task (in a worker), returning their results
+    and the worker's resident memory"""
+    results = []
+    for (geom, N, window) in zip(geoms, Ntiles, windows):
+        try:
+            if (N > 1):
+                results.append(get_tiled_pop_pwpd_pwlogpd(geom, N, window))
+            else:
+                results.append(pwpd.get_pop_pwpd_pwlogpd({'geometry': [geom]}))
+        except (ValueError, SystemExit) as e:
+            pwpd_progress.logger.warning(f"region could not be scored ({e})")
+            results.append(None)
+    return (results, pwpd_progress.get_rss_MB())
+
+def run_plan(shapes_t, plan):
+    """
+    Run the plan of the regions of shapes_t (see plan_regions) on the
+    pool, starting the tasks in the simulated order, and return a
+    dataframe (in the order of shapes_t) with the pop, pwpd, pwlogpd,
+    window size and population centroid of each region
+    """
+    import pwpd_batch
+    import pwpd_blockcache
+    import pwpd_hotpixels
+    regions = plan['regions']
+    tasks = plan['tasks']
+    geoms = shapes_t.geometry.values
+    windows = list(zip(*[regions[c].values.tolist() for c in
+                         ['row_off', 'col_off', 'height', 'width']]))
+    results = [None]*len(regions)
+    progress = pwpd_progress.Progress(len(regions), "regions")
+    max_worker_rss = 0.0
+    t0 = time.perf_counter()
+    with ProcessPoolExecutor(
+            max_workers=plan['Nworkers'],
+            initializer=pwpd_batch.init_reduction_worker,
+            initargs=(pwpd.popimage_type, pwpd.popimage_epoch,
+                      pwpd.popimage_resolution, pwpd.pop_centroid_on_sphere,
+                      pwpd.coverage_weighting,
+                      pwpd_blockcache.get_spec(),
+                      pwpd_hotpixels.get_layer_filepath())) as pool:
+        queue = get_task_order(tasks)
+        running = {}
+        while (queue or running):
+            # start the next tasks while they fit
+            while ( queue and can_start(tasks[queue[0]],
+                                        list(running.values()),
+                                        plan['Nworkers'], plan['budget']) ):
+                task = tasks[queue.pop(0)]
+                members = task['regions']
+                future = pool.submit(run_task, [geoms[i] for i in members],
+                                     [int(regions.at[i, 'Ntiles'])
+                                      for i in members],
+                                     [windows[i] for i in members])
+                future.members = members
+                running[future] = task
+            (done, pending) = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in done:
+                del running[future]
+                (task_results, rss) = future.result()
+                max_worker_rss = max(max_worker_rss, rss)
+                for (i, result) in zip(future.members, task_results):
+                    results[i] = result
+                    progress.update(str(i), task=int(regions.at[i, 'task']),
+                                    mode=regions.at[i, 'mode'],
+                                    window=(int(regions.at[i, 'height']),
+                                            int(regions.at[i, 'width'])))
+    progress.finish()
+    seconds = time.perf_counter() - t0
+    print(f"Makespan {pwpd_progress.format_seconds(seconds)}"
+          + f" (predicted {pwpd_progress.format_seconds(plan['makespan'])}),"
+          + f" largest worker RSS {max_worker_rss:,.0f} MB")
+    columns = ['pop', 'pwpd', 'pwlogpd', 'pop_centroid_lat',
+               'pop_centroid_lon']
+    rows = [(np.nan,)*5 if r is None else (r[0], r[1], r[2], r[4], r[5])
+            for r in results]
+    return pd.DataFrame(rows, index=shapes_t.index, columns=columns)
+
+def get_pwpd_regions_scheduled(shapes_df, outfilepath):
+    """
+    Pop, PWPD, PWlogPD and population centroid of each region (row) of
+    shapes_df, with its other (non-geometry) columns, run on the pool with
+    a memory-aware plan (printed before the run starts), saved (as CSV or
+    Parquet, see pwpd_table.py) to outfilepath
+    """
+    import pwpd_table
+    shapes_t = pwpd.transform_shapefile(shapes_df).reset_index(drop=True)
+    plan = plan_regions(shapes_t)
+    print_plan(plan)
+    results = run_plan(shapes_t, plan)
+    pwpd_df = shapes_df.drop(columns='geometry').reset_index(drop=True)
+    pwpd_df = pwpd_df.join(results)
+    pwpd_table.write_table(pwpd_df, outfilepath)
+    return pwpd_df
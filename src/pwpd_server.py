@@ -0,0 +1,280 @@
+# Use the pwpd.yml conda environment
+#
+# Long-lived local query server for PWPD calculations.
+#
+# The shapefile layers are loaded and transformed to the coordinates of
+# the population image once, at start-up, and the raster handles are
+# kept open between requests (one set per worker thread).  Each request
+# then only pays for the masked read and the reduction done by
+# pwpd.get_pop_pwpd_pwlogpd().
+#
+# Requests (all responses are JSON):
+#
+#    GET  /pwpd?layer=countries&key=USA
+#    GET  /pwpd?layer=us-counties&key=36,91          (FIPS state,county)
+#    GET  /pwpd?layer=us-counties&key=NY,Saratoga    (state abb,county)
+#    GET  /pwpd?layer=canada-hr&key=3595
+#    POST /pwpd      body = GeoJSON Polygon/MultiPolygon geometry, Feature
+#                    or FeatureCollection (lat/lon, EPSG:4326, unless the
+#                    query string has, e.g., ?crs=esri:54009)
+#    GET  /metrics   request-latency histograms
+#    GET  /health
+#
+# See run_pwpd-server.py for the parameters used to start the server.
+#
+import json
+import time
+import threading
+import http.server
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pwpd
+
+############################################################
+#                 Resident shapefile layers                #
+############################################################
+#
+#  layers[layername] = {key: single-row dataframe in image coordinates}
+#
+layers = {}
+layer_names = ['countries', 'us-counties', 'canada-hr']
+
+def load_layers(layerlist, hr_type="covid19"):
+    """Load, transform and index the requested shapefile layers"""
+    for layername in layerlist:
+        if (layername == 'countries'):
+            df = pwpd.load_world_shapefiles()
+            keys = df['threelett'].to_list()
+        elif (layername == 'us-counties'):
+            df = pwpd.load_UScounty_shapefiles()
+            keys = [f"{s:d},{c:d}" for (s, c)
+                    in zip(df['fips_state'], df['fips_county'])]
+        elif (layername == 'canada-hr'):
+            df = pwpd.load_CanadaHR_shapefiles(hr_type)
+            keys = [f"{h:d}" for h in df['hr_uid']]
+        else:
+            print("\n***Error: Layer", layername, "not recognized.")
+            exit(0)
+        df_t = pwpd.transform_shapefile(df)
+        layers[layername] = {}
+        for i in range(len(df_t)):
+            layers[layername][keys[i]] = df_t.iloc[[i]]
+        # also allow US counties to be requested by name
+        if (layername == 'us-counties'):
+            for i in range(len(df_t)):
+                for name in [df['county'].iloc[i], df['countylong'].iloc[i]]:
+                    key = df['stateabb'].iloc[i].lower() + "," + name.lower()
+                    layers[layername][key] = df_t.iloc[[i]]
+        print(f"Loaded layer {layername:s} ({len(df_t):d} regions).")
+
+def get_layer_region(layername, key):
+    if layername not in layers:
+        raise KeyError(f"layer '{layername}' is not loaded")
+    key = key.strip()
+    if (layername == 'countries'):
+        key = key.upper()
+    elif (layername == 'us-counties'):
+        key = ",".join([k.strip() for k in key.lower().split(",")])
+        # strip leading zeros from FIPS codes
+        try:
+            key = ",".join([f"{int(k):d}" for k in key.split(",")])
+        except ValueError:
+            pass
+    if key not in layers[layername]:
+        raise KeyError(f"region '{key}' not found in layer '{layername}'")
+    return layers[layername][key]
+
+def get_geojson_region(geojson, crs='epsg:4326'):
+    """Make a dataframe in image coordinates from GeoJSON input"""
+    import geopandas as gpd
+    if not isinstance(geojson, dict):
+        raise ValueError("GeoJSON input must be an object")
+    if (geojson.get('type') == 'FeatureCollection'):
+        features = geojson.get('features')
+    elif (geojson.get('type') == 'Feature'):
+        features = [geojson]
+    else:
+        features = [{'type': 'Feature', 'properties': {},
+                     'geometry': geojson}]
+    try:
+        df = gpd.GeoDataFrame.from_features(features, crs=crs)
+    except Exception as e:
+        # (no geometry, a bad one, features that are not objects, ...)
+        raise ValueError("invalid GeoJSON geometry: " + repr(e))
+    if (len(df) == 0):
+        raise ValueError("no geometries given")
+    return pwpd.transform_shapefile(df)
+
+def get_region_result(window_df):
+    (pop, pwd, pwlogpd, imgshape, lat, lon) = \
+        pwpd.get_pop_pwpd_pwlogpd(window_df)
+    return {'pop': float(pop), 'pwpd': float(pwd),
+            'pwlogpd': float(pwlogpd),
+            'window': [int(imgshape[0]), int(imgshape[1])],
+            'pop_centroid_lat': float(lat), 'pop_centroid_lon': float(lon),
+            'popimage': {'type': pwpd.popimage_type,
+                         'epoch': pwpd.popimage_epoch,
+                         'resolution': pwpd.popimage_resolution}}
+
+############################################################
+#                Request-latency histograms                #
+############################################################
+#
+#  Cumulative-free (per-bucket) counts, with upper bucket edges in ms;
+#  the last bucket collects everything above the largest edge.
+#
+latency_bucket_edges_ms = [1, 2, 5, 10, 20, 50, 100, 200, 500,
+                           1000, 2000, 5000, 10000]
+latency_histograms = {}
+latency_lock = threading.Lock()
+
+def record_latency(endpoint, elapsed_ms):
+    ibucket = int(np.searchsorted(latency_bucket_edges_ms, elapsed_ms))
+    with latency_lock:
+        if endpoint not in latency_histograms:
+            latency_histograms[endpoint] = {
+                'count': 0, 'sum_ms': 0.0, 'max_ms': 0.0,
+                'counts': [0]*(len(latency_bucket_edges_ms) + 1)}
+        h = latency_histograms[endpoint]
+        h['count'] += 1
+        h['sum_ms'] += elapsed_ms
+        h['max_ms'] = max(h['max_ms'], elapsed_ms)
+        h['counts'][ibucket] += 1
+
+def get_histogram_quantile(h, q):
+    """Upper bucket edge (ms) below which a fraction q of requests fell"""
+    target = q*h['count']
+    cumcount = 0
+    for (edge, count) in zip(latency_bucket_edges_ms, h['counts']):
+        cumcount += count
+        if (cumcount >= target):
+            return edge
+    return h['max_ms']
+
+def get_metrics():
+    with latency_lock:
+        metrics = {'bucket_edges_ms': latency_bucket_edges_ms,
+                   'endpoints': {}}
+        for (endpoint, h) in latency_histograms.items():
+            metrics['endpoints'][endpoint] = {
+                'count': h['count'],
+                'mean_ms': h['sum_ms']/h['count'],
+                'max_ms': h['max_ms'],
+                'p50_ms_upper': get_histogram_quantile(h, 0.5),
+                'p90_ms_upper': get_histogram_quantile(h, 0.9),
+                'p99_ms_upper': get_histogram_quantile(h, 0.99),
+                'counts': list(h['counts'])}
+    return metrics
+
+############################################################
+#                      HTTP handling                       #
+############################################################
+
+class PwpdRequestHandler(http.server.BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        # per-request logging is replaced by the latency histograms
+        pass
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def run_query(self, endpoint, get_window_df):
+        start = time.perf_counter()
+        try:
+            result = get_region_result(get_window_df())
+            status = 200
+        except KeyError as e:
+            (status, result) = (400, {'error': e.args[0]})
+        except ValueError as e:
+            (status, result) = (400, {'error': str(e)})
+        except SystemExit:
+            # pwpd reports bad input by printing an error and exiting
+            (status, result) = (400, {'error': "request could not be computed"
+                                      + " (see server output)"})
+        except Exception as e:
+            # (anything else is the server's fault, but still gets an answer)
+            (status, result) = (500, {'error': repr(e)})
+        elapsed_ms = 1000*(time.perf_counter() - start)
+        record_latency(endpoint, elapsed_ms)
+        result['elapsed_ms'] = elapsed_ms
+        self.send_json(status, result)
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        if (url.path == '/pwpd'):
+            if ('layer' not in query) | ('key' not in query):
+                self.send_json(400, {'error': "layer and key are required"})
+                return
+            self.run_query('layer:' + query['layer'],
+                           lambda: get_layer_region(query['layer'],
+                                                    query['key']))
+        elif (url.path == '/metrics'):
+            self.send_json(200, get_metrics())
+        elif (url.path == '/health'):
+            self.send_json(200, {'status': 'ok',
+                                 'layers': {k: len(v) for (k, v)
+                                            in layers.items()}})
+        else:
+            self.send_json(404, {'error': "unknown path " + url.path})
+
+    def do_POST(self):
+        url = urllib.parse.urlparse(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        if (url.path != '/pwpd'):
+            self.send_json(404, {'error': "unknown path " + url.path})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            geojson = json.loads(self.rfile.read(length))
+        except ValueError as e:
+            self.send_json(400, {'error': "invalid GeoJSON: " + str(e)})
+            return
+        crs = query.get('crs', 'epsg:4326')
+        self.run_query('geojson',
+                       lambda: get_geojson_region(geojson, crs=crs))
+
+class PooledHTTPServer(http.server.HTTPServer):
+    """HTTP server that hands each connection to a fixed pool of worker
+    threads (each worker keeps its own open raster handles)"""
+
+    def __init__(self, address, handler, Nworkers):
+        super().__init__(address, handler)
+        self.pool = ThreadPoolExecutor(max_workers=Nworkers)
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self.process_request_in_worker,
+                         request, client_address)
+
+    def process_request_in_worker(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(wait=True)
+
+def serve(host, port, Nworkers):
+    """Serve requests until interrupted (layers must already be loaded)"""
+    pwpd.keep_rasters_open = True
+    server = PooledHTTPServer((host, port), PwpdRequestHandler, Nworkers)
+    print(f"Serving PWPD queries on http://{host:s}:{port:d}"
+          + f" with {Nworkers:d} workers...")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return server
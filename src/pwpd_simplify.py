@@ -0,0 +1,150 @@
+# Use the pwpd.yml conda environment
+#
+# Simplification of the region shapes before the masked reads.
+#
+# rasterio.mask.mask rasterizes the full-detail shape of each region,
+# and for coastlines and county boundaries with tens of thousands of
+# vertices that costs more than the reduction of the pixels at 1km or
+# 2.5am.  A pixel is in the mask if its center is in the shape, so moving
+# the boundary by a fraction of a pixel changes the membership of only a
+# few pixels along it.  With
+#
+#     pwpd.simplify_tolerance_pixels = 0.25
+#
+# pwpd.transform_shapefile simplifies the transformed shapes
+# (Douglas-Peucker, preserving topology, so the shapes stay valid) to
+# that fraction of the pixel size of the population image.  The
+# simplified shapes are cached, keyed by the image type and resolution
+# and the (untransformed) geometry, so each is transformed and simplified
+# once per resolution (the simplified_cache_size most recently used are
+# kept, so that a long-running server does not grow without bound).  If
+# simplify_check is True, one of every simplify_check_every simplified
+# shapes is rasterized along with its full-detail shape on the image grid
+# and the pixels that change membership are counted; print_summary()
+# reports the reduction in vertices and the largest change of any region
+# checked.
+#
+# (Each shape is simplified on its own, so neighbouring regions can gain
+# or lose the same boundary pixel; the check counts those pixels too.)
+#
+import hashlib
+import numpy as np
+import pwpd
+import pwpd_trace
+
+#--- Rasterize the full-detail shapes too, and count the pixels that
+#    change membership (costs two rasterizations of each checked region's
+#    window, at full detail), for one of every simplify_check_every regions
+simplify_check = False
+simplify_check_every = 10
+#--- Number of simplified shapefiles kept in the cache
+simplified_cache_size = 1024
+
+#  simplified_cache[key] = simplified shapefile, least recently used first
+simplified_cache = {}
+pixel_sizes = {}
+simplify_stats = {'Nregions': 0, 'Nvertices': 0, 'Nvertices_simplified': 0,
+                  'Nchecked': 0, 'max_changed_pixels': 0,
+                  'max_changed_fraction': 0.0}
+
+def get_image_filepath():
+    if (pwpd.popimage_type == 'GHS'):
+        return pwpd.GHS_filepath
+    return pwpd.GPW_popcount_filepath
+
+def get_pixel_size():
+    """Pixel size of the population image, in its coordinates"""
+    filepath = get_image_filepath()
+    if filepath not in pixel_sizes:
+        import rasterio
+        with rasterio.open(filepath) as src:
+            pixel_sizes[filepath] = min(abs(src.transform.a),
+                                        abs(src.transform.e))
+    return pixel_sizes[filepath]
+
+def get_cache_key(shapefile):
+    import shapely
+    digest = hashlib.sha1()
+    for wkb in shapely.to_wkb(shapefile.geometry.values):
+        digest.update(wkb)
+    return (pwpd.popimage_type, pwpd.popimage_resolution,
+            pwpd.simplify_tolerance_pixels, str(shapefile.crs),
+            digest.hexdigest())
+
+def clear_cache():
+    simplified_cache.clear()
+    for k in simplify_stats:
+        simplify_stats[k] = 0
+
+def get_membership_change(shapefile_t, simplified_t):
+    """(pixels that change membership, pixels in the full-detail mask) on
+    the image grid"""
+    import rasterio
+    import rasterio.features
+    with rasterio.open(get_image_filepath()) as src:
+        # (the simplified shape is within a pixel of the full one)
+        window = rasterio.features.geometry_window(
+            src, shapefile_t.geometry, pad_x=1, pad_y=1)
+        transform = src.window_transform(window)
+    shape = (int(window.height), int(window.width))
+    outside = rasterio.features.geometry_mask(shapefile_t.geometry, shape,
+                                              transform)
+    outside_simplified = rasterio.features.geometry_mask(
+        simplified_t.geometry, shape, transform)
+    return (int(np.count_nonzero(outside != outside_simplified)),
+            int(shape[0]*shape[1] - np.count_nonzero(outside)))
+
+def transform_and_simplify(shapefile):
+    """The shapefile transformed to the population image coordinates and
+    simplified to pwpd.simplify_tolerance_pixels of a pixel"""
+    import shapely
+    key = get_cache_key(shapefile)
+    if key in simplified_cache:
+        # (now the most recently used)
+        simplified_cache[key] = simplified_cache.pop(key)
+        return simplified_cache[key]
+    shapefile_t = pwpd.transform_shapefile(shapefile, simplify=False)
+    tolerance = pwpd.simplify_tolerance_pixels*get_pixel_size()
+    with pwpd_trace.stage('simplify') as span:
+        simplified_t = shapefile_t.assign(
+            geometry=shapefile_t.geometry.simplify(tolerance,
+                                                   preserve_topology=True))
+        Nvertices = int(shapely.get_num_coordinates(
+            shapefile_t.geometry.values).sum())
+        Nvertices_simplified = int(shapely.get_num_coordinates(
+            simplified_t.geometry.values).sum())
+        span.add(vertices=Nvertices, vertices_simplified=Nvertices_simplified)
+    simplify_stats['Nregions'] += 1
+    simplify_stats['Nvertices'] += Nvertices
+    simplify_stats['Nvertices_simplified'] += Nvertices_simplified
+    if ( simplify_check
+         and ((simplify_stats['Nregions'] - 1) % simplify_check_every == 0) ):
+        with pwpd_trace.stage('simplify_check') as span:
+            (Nchanged, Ninside) = \
+                get_membership_change(shapefile_t, simplified_t)
+            span.add(changed_pixels=Nchanged, mask_pixels=Ninside)
+        simplify_stats['Nchecked'] += 1
+        simplify_stats['max_changed_pixels'] = \
+            max(simplify_stats['max_changed_pixels'], Nchanged)
+        simplify_stats['max_changed_fraction'] = \
+            max(simplify_stats['max_changed_fraction'],
+                Nchanged/max(Ninside, 1))
+    simplified_cache[key] = simplified_t
+    while (len(simplified_cache) > simplified_cache_size):
+        del simplified_cache[next(iter(simplified_cache))]
+    return simplified_t
+
+def print_summary():
+    s = simplify_stats
+    if (s['Nregions'] == 0):
+        return
+    print("=" * 80)
+    print(f"Simplified {s['Nregions']:d} regions to"
+          + f" {pwpd.simplify_tolerance_pixels:g} pixel:"
+          + f" {s['Nvertices']:,d} -> {s['Nvertices_simplified']:,d} vertices")
+    if (s['Nchecked'] > 0):
+        print("Largest change in the masks of the"
+              + f" {s['Nchecked']:d} regions checked:"
+              + f" {s['max_changed_pixels']:d} pixels,"
+              + f" {100*s['max_changed_fraction']:.3f}% of a region's pixels")
+    print("=" * 80)
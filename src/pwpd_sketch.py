@@ -0,0 +1,185 @@
+# Use the pwpd.yml conda environment
+#
+# Streaming, mergeable, population-weighted quantile sketch of the
+# population density "experienced" by the residents of a region.
+#
+# The PWPD is the mean of this distribution (each pixel's density,
+# weighted by the pixel population).  The sketch keeps the rest of the
+# distribution: the median experienced density, other quantiles, and the
+# Lorenz curve/Gini coefficient of population concentration.
+#
+# The sketch is a histogram over logarithmically spaced density buckets
+# (as in DDSketch, Masson et al. 2019), holding the total population in
+# each bucket.  Any quantile read from it is within a relative error of
+# sketch_relative_accuracy of the exact pixel value.  Because all sketches
+# share the same fixed buckets:
+#
+#   * pixels can be added in blocks of any size (add_image_to_sketch
+#     never holds more than a block of rows),
+#   * sketches of disjoint regions merge exactly by adding their counts
+#     (merge_sketches), so composite regions (states, metros, ...) need
+#     no re-reading of pixels.
+#
+# A sketch is a dict:
+#
+#     sketch = {'counts': population in each density bucket,
+#               'Npix': number of populated pixels added}
+#
+import numpy as np
+
+############################################################
+#                   Sketch bucket layout                   #
+############################################################
+#
+#  Densities are in people per km^2.  Values outside the range are put
+#  in the first/last bucket.
+#
+sketch_relative_accuracy = 0.01
+sketch_min_density = 1.0e-4
+sketch_max_density = 1.0e8
+sketch_gamma = (1.0 + sketch_relative_accuracy) \
+    / (1.0 - sketch_relative_accuracy)
+sketch_log_gamma = np.log(sketch_gamma)
+sketch_min_index = int(np.floor(np.log(sketch_min_density)/sketch_log_gamma))
+sketch_max_index = int(np.ceil(np.log(sketch_max_density)/sketch_log_gamma))
+sketch_Nbuckets = sketch_max_index - sketch_min_index + 1
+#--- Representative density of each bucket (k-1 < log(d)/log(gamma) <= k)
+sketch_bucket_density = 2.0 * sketch_gamma**np.arange(sketch_min_index,
+                                                      sketch_max_index + 1) \
+                                                      / (sketch_gamma + 1.0)
+#--- Number of image rows added to the sketch at a time
+sketch_block_rows = 256
+
+def new_sketch():
+    return {'counts': np.zeros(sketch_Nbuckets), 'Npix': 0}
+
+def get_bucket_index(density):
+    k = np.ceil(np.log(density)/sketch_log_gamma).astype(np.int64)
+    return np.clip(k - sketch_min_index, 0, sketch_Nbuckets - 1)
+
+def add_to_sketch(sketch, density, pop):
+    """Add pixels with the given densities and populations (1D arrays)"""
+    if (len(pop) == 0):
+        return sketch
+    sketch['counts'] += np.bincount(get_bucket_index(density), weights=pop,
+                                    minlength=sketch_Nbuckets)
+    sketch['Npix'] += len(pop)
+    return sketch
+
+def add_image_to_sketch(sketch, popimg, Acell_in_kmsqd=None, pdimg=None,
+                        coverage=None, exclude=None):
+    """
+    Add a (masked) population image to the sketch, one block of rows at
+    a time.  The density of each pixel is either its population divided by
+    the pixel area (GHS), or taken from the population density image (GPW).
+    Nodata (negative) and zero-population pixels are skipped.  If the
+    coverage of each pixel by the region is given (see pwpd_coverage.py),
+    the pixels are weighted by their population in the region.  The
+    pixels of the bool image exclude (e.g., the region's hot pixels, see
+    pwpd_hotpixels.py), if given, are skipped too.
+    """
+    (rows, cols) = popimg.shape
+    for r in range(0, rows, sketch_block_rows):
+        pblock = np.asarray(popimg[r:r+sketch_block_rows])
+        selected = (pblock > 0)
+        if exclude is not None:
+            selected &= ~exclude[r:r+sketch_block_rows]
+        pop = pblock[selected]
+        if pdimg is None:
+            density = pop / Acell_in_kmsqd
+        else:
+            density = np.asarray(pdimg[r:r+sketch_block_rows])[selected]
+        if coverage is not None:
+            pop = pop * np.asarray(coverage[r:r+sketch_block_rows])[selected]
+        if pdimg is not None:
+            # a populated pixel with a nodata density cannot be placed
+            ok = (density > 0)
+            (pop, density) = (pop[ok], density[ok])
+        add_to_sketch(sketch, density, pop)
+    return sketch
+
+def merge_sketches(sketches):
+    """Sketch of the union of (disjoint) regions"""
+    merged = new_sketch()
+    for s in sketches:
+        merged['counts'] += s['counts']
+        merged['Npix'] += s['Npix']
+    return merged
+
+############################################################
+#             Quantiles and concentration measures         #
+############################################################
+
+def get_sketch_quantiles(sketch, qlist):
+    """Population-weighted quantiles of the experienced density, i.e., the
+    density below which a fraction q of the population lives"""
+    total = np.sum(sketch['counts'])
+    if (total <= 0):
+        return np.zeros(len(qlist))
+    cumcounts = np.cumsum(sketch['counts'])
+    k = np.searchsorted(cumcounts, np.asarray(qlist)*total, side='left')
+    k = np.clip(k, 0, sketch_Nbuckets - 1)
+    return sketch_bucket_density[k]
+
+def get_sketch_lorenz(sketch):
+    """
+    Lorenz curve of population concentration: with the land ordered from
+    the least to the most densely populated, returns the cumulative
+    fractions of (area, population), starting from (0, 0).
+    """
+    populated = (sketch['counts'] > 0)
+    pop = sketch['counts'][populated]
+    area = pop / sketch_bucket_density[populated]
+    cumarea = np.concatenate(([0.0], np.cumsum(area)))
+    cumpop = np.concatenate(([0.0], np.cumsum(pop)))
+    if (cumpop[-1] <= 0):
+        return (cumarea, cumpop)
+    return (cumarea/cumarea[-1], cumpop/cumpop[-1])
+
+def get_sketch_gini(sketch):
+    """Gini coefficient of the Lorenz curve (0 = evenly spread over the
+    populated land, 1 = everyone in a vanishingly small area)"""
+    (cumarea, cumpop) = get_sketch_lorenz(sketch)
+    if (len(cumarea) < 2):
+        return 0.0
+    return 1.0 - np.sum(np.diff(cumarea) * (cumpop[1:] + cumpop[:-1]))
+
+#--- Quantiles reported as dataframe columns, {column: q}
+sketch_quantile_columns = {'pd_p10': 0.10, 'pd_median': 0.50, 'pd_p90': 0.90}
+
+def get_sketch_summary(sketch):
+    """Dictionary of the quantile columns plus the Gini coefficient"""
+    qlist = list(sketch_quantile_columns.values())
+    summary = dict(zip(sketch_quantile_columns,
+                       get_sketch_quantiles(sketch, qlist)))
+    summary['pd_gini'] = get_sketch_gini(sketch)
+    return summary
+
+def get_sketch_summary_columns():
+    return list(sketch_quantile_columns) + ['pd_gini']
+
+############################################################
+#                 Saving and loading sketches              #
+############################################################
+
+def save_sketches(sketches, outfilepath):
+    """Save a dictionary {integer region key: sketch} to a .npz file"""
+    keys = np.array(sorted(sketches), dtype=np.int64)
+    counts = np.array([sketches[k]['counts'] for k in keys])
+    Npix = np.array([sketches[k]['Npix'] for k in keys], dtype=np.int64)
+    np.savez_compressed(outfilepath, keys=keys, counts=counts, Npix=Npix,
+                        relative_accuracy=sketch_relative_accuracy,
+                        min_index=sketch_min_index, max_index=sketch_max_index)
+
+def load_sketches(infilepath):
+    data = np.load(infilepath)
+    if ( (int(data['min_index']) != sketch_min_index)
+         | (int(data['max_index']) != sketch_max_index)
+         | (float(data['relative_accuracy']) != sketch_relative_accuracy) ):
+        print("\n***Error: The sketches in", infilepath)
+        print("          were made with a different bucket layout.")
+        exit(0)
+    sketches = {}
+    for (k, c, n) in zip(data['keys'], data['counts'], data['Npix']):
+        sketches[int(k)] = {'counts': c.copy(), 'Npix': int(n)}
+    return sketches
@@ -0,0 +1,146 @@
+# Use the pwpd.yml conda environment
+#
+# Kernel-smoothed "experienced density" (only for GHS-POP images).
+#
+# The PWPD uses the density of each person's own pixel, so it depends on
+# the pixel grid.  Here the density experienced by each person is instead
+# the population within a distance r of their pixel, divided by the area
+# of that disk:
+#
+#     D_r(i) = sum_{j : |x_j - x_i| <= r} p_j / (N_disk * A_cell)
+#
+# The surface D_r is computed by convolving the population image with a
+# disk kernel using FFTs, in independent tiles (overlap-save: each output
+# tile is convolved from an input tile padded by the kernel radius), so
+# memory is bounded by the tile size and whole countries or continents can
+# be done on one node.  Population outside the region (but within r of it)
+# is included, since the residents near a border experience it too.  The
+# GHS-POP images are in the equal-area Mollweide projection, so every
+# pixel has the same area on the ground and one kernel (the same set of
+# pixels) is used everywhere, with N_disk * A_cell the true area that it
+# covers.  Mollweide does not preserve distances, though: the kernel is a
+# ground disk of radius r only where the projection is free of distortion
+# (at 40 deg 44' N and S on the central meridian).  Elsewhere it covers an
+# ellipse of the same area on the ground, with its axes scaled apart in
+# latitude (east-west against north-south) and sheared away from the
+# central meridian, where the meridians cross the parallels at an angle.
+# So some of the population counted is more than r away and some within
+# r is missed, increasingly toward the poles and the edges of the map,
+# and the smoothing is at a scale of about r, not exactly r.
+#
+# The population-weighted mean of D_r over the region,
+#
+#     PWPD_r = sum_i p_i D_r(i) / sum_i p_i ,
+#
+# tends to the PWPD as r shrinks to the pixel size.
+#
+import numpy as np
+import rasterio
+import rasterio.features
+import rasterio.windows
+from scipy.signal import fftconvolve
+import pwpd
+
+#--- Size (in pixels) of the output tiles
+smooth_tile_size = 1024
+
+def get_disk_kernel(radius_in_pixels):
+    """Disk of pixels whose centers are within the radius of the center"""
+    K = int(np.floor(radius_in_pixels))
+    (y, x) = np.mgrid[-K:K+1, -K:K+1]
+    return ((x**2 + y**2) <= radius_in_pixels**2).astype(np.float64)
+
+def get_smoothed_pwpd(window_df, radii_km, outfileprefix=None,
+                      return_surface=False):
+    """
+    Population and population-weighted smoothed density of the region(s)
+    in window_df (already transformed to Mollweide), for each radius in
+    radii_km.  Returns
+
+        (totalpop, {radius: pwpd_r}, {radius: surface_r}, surface_transform)
+
+    where surface_r is the smoothed density (per km^2) on the cropped
+    window of the region (the same window as pwpd.get_windowed_subimage)
+    if return_surface is True, or None (the default, so that only a tile
+    of each surface is held in memory).  If outfileprefix is given, each
+    surface is also written, tile by tile, to the GeoTIFF
+    outfileprefix + "_r<radius>km.tif", which is then converted to a
+    cloud-optimized GeoTIFF (see pwpd_io.py).
+    """
+    # only do this for GHS-POP images
+    if (pwpd.popimage_type != 'GHS'):
+        print("\n***Error: Smoothed densities need the equal-area (GHS) images.")
+        exit(0)
+    shapes = window_df["geometry"]
+    Acell = pwpd.GHS_Acell_in_kmsqd
+    with rasterio.open(pwpd.GHS_filepath) as src:
+        pixel_km = src.res[0]/1000.0
+        # the kernels, padded to the largest one
+        kernels = {r: get_disk_kernel(r/pixel_km) for r in radii_km}
+        Kmax = max([(k.shape[0] - 1)//2 for k in kernels.values()])
+        # the same cropped window as rasterio.mask.mask(..., crop=True)
+        window = rasterio.features.geometry_window(src, shapes)
+        (H, W) = (int(window.height), int(window.width))
+        window_transform = rasterio.windows.transform(window, src.transform)
+        surfaces = {}
+        outfiles = {}
+        for r in radii_km:
+            surfaces[r] = np.zeros((H, W), dtype=np.float32) \
+                if return_surface else None
+            if outfileprefix is not None:
+                outfiles[r] = rasterio.open(
+                    outfileprefix + f"_r{r:g}km.tif", 'w', driver='GTiff',
+                    height=H, width=W, count=1, dtype='float32',
+                    crs=src.crs, transform=window_transform, nodata=None,
+                    tiled=True, blockxsize=256, blockysize=256,
+                    compress='deflate', predictor=3, BIGTIFF='IF_SAFER')
+        totalpop = 0.0
+        pwsum = {r: 0.0 for r in radii_km}
+        try:
+            for r0 in range(0, H, smooth_tile_size):
+                for c0 in range(0, W, smooth_tile_size):
+                    th = min(smooth_tile_size, H - r0)
+                    tw = min(smooth_tile_size, W - c0)
+                    # input tile, padded by the largest kernel radius
+                    in_window = rasterio.windows.Window(
+                        window.col_off + c0 - Kmax, window.row_off + r0 - Kmax,
+                        tw + 2*Kmax, th + 2*Kmax)
+                    tile = src.read(1, window=in_window, boundless=True,
+                                    fill_value=0).astype(np.float64)
+                    tile[tile < 0.0] = 0.0
+                    ptile = tile[Kmax:Kmax+th, Kmax:Kmax+tw]
+                    # region membership, as in rasterio.mask.mask
+                    out_window = rasterio.windows.Window(
+                        window.col_off + c0, window.row_off + r0, tw, th)
+                    inside = rasterio.features.geometry_mask(
+                        shapes, out_shape=(th, tw), invert=True,
+                        transform=rasterio.windows.transform(out_window,
+                                                             src.transform))
+                    wtile = ptile*inside
+                    totalpop += np.sum(wtile)
+                    for (r, kernel) in kernels.items():
+                        K = (kernel.shape[0] - 1)//2
+                        sub = tile[Kmax-K:Kmax+K+th, Kmax-K:Kmax+K+tw]
+                        dens = fftconvolve(sub, kernel, mode='valid')
+                        # remove the FFT round-off around zero
+                        dens = np.clip(dens, 0.0, None) \
+                            / (np.sum(kernel)*Acell)
+                        pwsum[r] += np.sum(wtile*dens)
+                        if return_surface:
+                            surfaces[r][r0:r0+th, c0:c0+tw] = dens
+                        if r in outfiles:
+                            outfiles[r].write(
+                                dens.astype(np.float32), 1,
+                                window=rasterio.windows.Window(c0, r0, tw, th))
+        finally:
+            for dst in outfiles.values():
+                dst.close()
+    if outfiles:
+        import pwpd_io
+        for dst in outfiles.values():
+            pwpd_io.convert_to_cog(dst.name)
+    if (totalpop > 0):
+        pwpd_r = {r: pwsum[r]/totalpop for r in radii_km}
+    else:
+        pwpd_r = {r: 0.0 for r in radii_km}
+    return (totalpop, pwpd_r, surfaces, window_transform)
@@ -0,0 +1,190 @@
+# Use the pwpd.yml conda environment
+#
+# Stacked input: several co-registered population images (the GHS-POP
+# epochs, which are all on the same Mollweide grid, GPW age/sex subgroup
+# images, or the bands of a VRT) reduced together, region by region.
+#
+# For each region, the window and the polygon mask (or the pixel coverage,
+# if pwpd.coverage_weighting) are computed once, from the first image of
+# the stack, and then each image is read in that window and reduced, so
+# a time series of N epochs costs one mask and N window reads instead of
+# N full runs of a helper script.  The result has one row per region and
+# the columns pop_<label>, pwpd_<label>, pwlogpd_<label> for each image.
+#
+#     pwpd.set_popimage_pars('GHS', '2015', '1km')
+#     stack = pwpd_stack.make_epoch_stack(['1975', '1990', '2000', '2015'])
+#     df = pwpd_stack.get_pwpd_regions_stack(countyshapes_df, stack,
+#                                            "../output/epochs.csv")
+#
+# A stack is a list of layers, each with a label, the population count
+# image (filepath and band) and, for GPW, the population density image.
+# (For the GPW subgroup images, which have no density images of their
+# own, the density image of the total population can be given, which
+# gives the total population density as experienced by the subgroup.)
+#
+import contextlib
+import rasterio
+import rasterio.mask
+import pwpd
+import pwpd_trace
+
+def make_layer(label, filepath, band=1, density_filepath=None,
+               density_band=1):
+    return {'label': label, 'filepath': filepath, 'band': band,
+            'density_filepath': density_filepath,
+            'density_band': density_band}
+
+def make_epoch_stack(epochs):
+    """Stack of the epochs of the current population image type and
+    resolution (see pwpd.set_popimage_pars)"""
+    (popimtype, epoch, resolution) = \
+        (pwpd.popimage_type, pwpd.popimage_epoch, pwpd.popimage_resolution)
+    stack = []
+    for e in epochs:
+        pwpd.set_popimage_pars(popimtype, e, resolution)
+        if (popimtype == 'GHS'):
+            stack.append(make_layer(e, pwpd.GHS_filepath))
+        else:
+            stack.append(make_layer(e, pwpd.GPW_popcount_filepath,
+                                    density_filepath=pwpd.GPW_popdensity_filepath))
+    pwpd.set_popimage_pars(popimtype, epoch, resolution)
+    return check_stack(stack)
+
+def make_file_stack(labels, filepaths, density_filepaths=None):
+    """Stack of a list of co-registered single-band images"""
+    if density_filepaths is None:
+        density_filepaths = [None]*len(filepaths)
+    return check_stack([make_layer(l, f, density_filepath=d) for (l, f, d)
+                        in zip(labels, filepaths, density_filepaths)])
+
+def make_vrt_stack(filepath, density_filepath=None):
+    """Stack of the bands of a (VRT or other) multi-band image, labelled
+    by the band descriptions (or b1, b2, ...)"""
+    with rasterio.open(filepath) as src:
+        labels = [d if d else f"b{i+1:d}" for (i, d)
+                  in enumerate(src.descriptions)]
+    return check_stack([make_layer(l, filepath, band=i+1,
+                                   density_filepath=density_filepath,
+                                   density_band=i+1)
+                        for (i, l) in enumerate(labels)])
+
+def check_stack(stack):
+    """The images of a stack must be on the same grid"""
+    grids = []
+    for layer in stack:
+        for f in [layer['filepath'], layer['density_filepath']]:
+            if f is None:
+                continue
+            try:
+                with rasterio.open(f) as src:
+                    grids.append((f, src.crs, src.transform, src.shape))
+            except rasterio.errors.RasterioIOError:
+                print("\n***Error: File with path:")
+                print("\n", f, "\n")
+                print("          not found.")
+                exit(0)
+    for (f, crs, transform, shape) in grids[1:]:
+        if ( (crs != grids[0][1]) | (transform != grids[0][2])
+             | (shape != grids[0][3]) ):
+            print("\n***Error: The stacked images are not on the same grid:")
+            print("          " + grids[0][0])
+            print("          " + f)
+            exit(0)
+    return stack
+
+def get_stack_columns(stack):
+    return [f"{col:s}_{layer['label']:s}" for layer in stack
+            for col in ['pop', 'pwpd', 'pwlogpd']]
+
+def open_stack(stack, exitstack):
+    """Open datasets of the stack's images (each file once), closed with
+    the contextlib.ExitStack"""
+    datasets = {}
+    for layer in stack:
+        for f in [layer['filepath'], layer['density_filepath']]:
+            if ( (f is not None) & (f not in datasets) ):
+                datasets[f] = exitstack.enter_context(rasterio.open(f))
+    return datasets
+
+def get_stack_pop_pwpd_pwlogpd(window_df, stack, datasets):
+    """
+    Population, PWPD and PWlogPD of the region(s) in window_df for each
+    image of the stack, {label: (pop, pwpd, pwlogpd)}, and the window
+    shape
+    """
+    windowshapes = window_df["geometry"]
+    src = datasets[stack[0]['filepath']]
+    # the window and mask (True outside the region), once for the stack
+    with pwpd_trace.stage('mask'):
+        (outside, img_transform, window) = \
+            rasterio.mask.raster_geometry_mask(
+                src, windowshapes, crop=True,
+                all_touched=pwpd.coverage_weighting)
+    coverage = None
+    if pwpd.coverage_weighting:
+        import pwpd_coverage
+        coverage = pwpd_coverage.get_coverage(windowshapes, outside.shape,
+                                              img_transform)
+    results = {}
+    for layer in stack:
+        with pwpd_trace.stage('window_read',
+                              file=layer['filepath'].split('/')[-1]) as span:
+            popimg = datasets[layer['filepath']].read(layer['band'],
+                                                      window=window)
+            # pixels outside the region are not counted
+            popimg[outside] = 0
+            nbytes = popimg.nbytes
+            if layer['density_filepath'] is not None:
+                pdimg = datasets[layer['density_filepath']].read(
+                    layer['density_band'], window=window)
+                nbytes += pdimg.nbytes
+            span.add(bytes=nbytes, window=popimg.shape)
+        with pwpd_trace.stage('reduce'):
+            if layer['density_filepath'] is None:
+                (totalpop, pwd, pwlogpd, pc_row, pc_col) = \
+                    pwpd.get_pwpd_from_count(popimg,
+                                             img_transform=img_transform,
+                                             coverage=coverage,
+                                             clean_hot_pixels=False)
+            else:
+                (totalpop, pwd, pwlogpd, pc_row, pc_col) = \
+                    pwpd.get_pwpd_from_count_and_density(
+                        popimg, pdimg, img_transform=img_transform,
+                        coverage=coverage)
+        results[layer['label']] = (totalpop, pwd, pwlogpd)
+    return (results, outside.shape)
+
+def get_pwpd_regions_stack(shapes_df, stack, outfilepath, name_col=None):
+    """
+    Pop, PWPD and PWlogPD of each region (row) of shapes_df for each image
+    of the stack, with the other (non-geometry) columns of shapes_df, saved
+    (as CSV or Parquet, see pwpd_table.py) to outfilepath
+    """
+    import pwpd_progress
+    import pwpd_table
+    pwpd_df = shapes_df.drop(columns='geometry').reset_index(drop=True)
+    for col in get_stack_columns(stack):
+        pwpd_df[col] = 0.0
+    progress = pwpd_progress.Progress(len(pwpd_df), "regions")
+    tablewriter = pwpd_table.TableWriter(outfilepath)
+    with contextlib.ExitStack() as exitstack:
+        datasets = open_stack(stack, exitstack)
+        for i in range(len(pwpd_df)):
+            name = str(pwpd_df.at[i, name_col]) if name_col else str(i)
+            with pwpd_trace.region(name):
+                region_t = pwpd.transform_shapefile(shapes_df.iloc[[i]])
+                (results, imgshape) = \
+                    get_stack_pop_pwpd_pwlogpd(region_t, stack, datasets)
+            for (label, (pop, pwd, pwlogpd)) in results.items():
+                pwpd_df.at[i, 'pop_' + label] = pop
+                pwpd_df.at[i, 'pwpd_' + label] = pwd
+                pwpd_df.at[i, 'pwlogpd_' + label] = pwlogpd
+            progress.update(name, window=imgshape,
+                            pop={l: r[0] for (l, r) in results.items()})
+            if ((i + 1) % pwpd_table.table_row_group_rows == 0):
+                with pwpd_trace.stage('write_table'):
+                    tablewriter.write(pwpd_df, Ndone=i+1)
+    tablewriter.write(pwpd_df)
+    tablewriter.close()
+    progress.finish()
+    return pwpd_df
@@ -0,0 +1,278 @@
+# Use the pwpd.yml conda environment
+#
+# Synthetic population images and region layers, laid out like the real
+# inputs, so that the pwpd methods can be timed (see bench_pwpd-suite.py)
+# or tried out without downloading the multi-GB GHS-POP/GPW images and
+# the shapefiles.
+#
+# The images cover the same lat/lon box in both layouts:
+#
+#   GHS:  Mollweide (esri:54009), 1km pixels, float64, nodata = -200
+#   GPW:  WGS84 lat/lon (epsg:4326), 30as pixels, float32, nodata =
+#         -3.4028230607370965e+38, as a population count image and a
+#         population density image
+#
+# and are written under the file names that pwpd.set_popimage_pars
+# expects, so that
+#
+#     pwpd_synthetic.make_synthetic_images(datadir, 2000)
+#     pwpd_synthetic.set_synthetic_popimage_pars(datadir, 'GHS')
+#
+# points pwpd at them.  The population is a set of Gaussian "cities" on a
+# sparse lognormal rural background, with a few isolated "hot" pixels (as
+# in the GHS-POP images of countries with poor satellite coverage; see the
+# cleaning methods) and a "lake" of nodata pixels.
+#
+# The region layers (Voronoi cells over the box) have the columns of the
+# dataframes returned by pwpd.load_UScounty_shapefiles,
+# pwpd.load_CanadaHR_shapefiles and pwpd.load_world_shapefiles.
+#
+import os
+import numpy as np
+import rasterio
+import rasterio.windows
+from rasterio.transform import Affine
+import pwpd
+
+#--- Lat/lon box covered by the synthetic images
+synthetic_center_latlon = (40.0, -100.0)
+#--- Number of cities, and their (lognormal) central densities and sizes
+synthetic_Ncities = 200
+synthetic_city_density_lognormal = (7.0, 1.0)   # per km^2
+synthetic_city_sigma_lognormal = (1.5, 0.6)     # km
+#--- Rural background: fraction of populated pixels, lognormal density
+synthetic_rural_fraction = 0.4
+synthetic_rural_density_lognormal = (1.0, 1.5)  # per km^2
+#--- Number of isolated hot pixels, and their population
+synthetic_Nhot = 50
+synthetic_hot_pop = 5.0e4
+#--- Number of image rows generated at a time
+synthetic_strip_rows = 512
+#--- Earth radius used to convert km to degrees
+earth_radius_km = 6371.0
+
+GHS_nodata = -200.0
+GPW_nodata = -3.4028230607370965e+38
+GPW_pixel_deg = 1.0/120.0
+
+def get_synthetic_filepaths(datadir):
+    """(GHS, GPW count, GPW density) file paths, named as in
+    pwpd.set_popimage_pars for the 2015 epoch (1km GHS, 30as GPW)"""
+    ghs_string = pwpd.GHS_file_string1 + "_E2015_" + pwpd.GHS_file_string2 \
+        + "_1K_" + pwpd.GHS_file_string3
+    ghs = os.path.join(datadir, "ghs", ghs_string, ghs_string + ".tif")
+    gpw_string = "_" + pwpd.GPW_file_string2 + "_2015_30_sec.tif"
+    gpwc = os.path.join(datadir, "gpw", pwpd.GPW_file_string1
+                        + "_population_count" + gpw_string)
+    gpwd = os.path.join(datadir, "gpw", pwpd.GPW_file_string1
+                        + "_population_density" + gpw_string)
+    return (ghs, gpwc, gpwd)
+
+def set_synthetic_popimage_pars(datadir, popimtype):
+    """Point pwpd at the synthetic images in datadir"""
+    pwpd.GHS_dir = os.path.join(datadir, "ghs") + "/"
+    pwpd.GPW_dir = os.path.join(datadir, "gpw") + "/"
+    if (popimtype == 'GHS'):
+        pwpd.set_popimage_pars('GHS', '2015', '1km')
+    else:
+        pwpd.set_popimage_pars('GPW', '2015', '30as')
+
+def get_synthetic_latlon_box(size):
+    """(south, north, west, east) of a GPW image of size x size pixels"""
+    half = 0.5*size*GPW_pixel_deg
+    (lat0, lon0) = synthetic_center_latlon
+    return (lat0 - half, lat0 + half, lon0 - half, lon0 + half)
+
+def get_synthetic_cities(size, seed):
+    """Lat, lon, central density and size (km) of the cities"""
+    rng = np.random.default_rng(seed)
+    (south, north, west, east) = get_synthetic_latlon_box(size)
+    lat = rng.uniform(south, north, synthetic_Ncities)
+    lon = rng.uniform(west, east, synthetic_Ncities)
+    density = rng.lognormal(*synthetic_city_density_lognormal,
+                            synthetic_Ncities)
+    sigma = rng.lognormal(*synthetic_city_sigma_lognormal, synthetic_Ncities)
+    return (lat, lon, density, sigma)
+
+def get_strip_density(x, y, cities_xy, density, sigma_xy, rng):
+    """Population density (per km^2) on a strip of pixel centers x (cols)
+    by y (rows), with city centers and sizes in the image coordinates"""
+    (cx, cy) = cities_xy
+    (sx, sy) = sigma_xy
+    dens = rng.lognormal(*synthetic_rural_density_lognormal,
+                         (len(y), len(x)))
+    dens[rng.random((len(y), len(x))) > synthetic_rural_fraction] = 0.0
+    for i in range(len(cx)):
+        # only the rows/cols within 4 sigma of the city
+        rows = np.flatnonzero(np.abs(y - cy[i]) < 4.0*sy[i])
+        cols = np.flatnonzero(np.abs(x - cx[i]) < 4.0*sx[i])
+        if ( (len(rows) == 0) | (len(cols) == 0) ):
+            continue
+        gy = np.exp(-0.5*((y[rows] - cy[i])/sy[i])**2)
+        gx = np.exp(-0.5*((x[cols] - cx[i])/sx[i])**2)
+        dens[rows[0]:rows[-1]+1, cols[0]:cols[-1]+1] += \
+            density[i]*np.outer(gy, gx)
+    return dens
+
+def write_synthetic_image(filepath, height, width, transform, crs, dtype,
+                          nodata, strip_func):
+    """Write an image strip by strip, with strip_func(row_off, Nrows)
+    giving the strip"""
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    with rasterio.open(filepath, 'w', driver='GTiff', height=height,
+                       width=width, count=1, dtype=dtype, crs=crs,
+                       transform=transform, nodata=nodata, tiled=True,
+                       blockxsize=256, blockysize=256, compress='lzw',
+                       BIGTIFF='IF_SAFER') as dst:
+        for row_off in range(0, height, synthetic_strip_rows):
+            Nrows = min(synthetic_strip_rows, height - row_off)
+            window = rasterio.windows.Window(0, row_off, width, Nrows)
+            dst.write(strip_func(row_off, Nrows).astype(dtype), 1,
+                      window=window)
+
+def add_hot_pixels_and_lake(strip, row_off, hot_rows, hot_cols, lake,
+                            nodata):
+    """Hot pixels (with empty neighbors) and a disk of nodata pixels"""
+    (Nrows, Ncols) = strip.shape
+    for (r, c) in zip(hot_rows - row_off, hot_cols):
+        if ( (r >= 1) & (r < Nrows - 1) ):
+            strip[r-1:r+2, c-1:c+2] = 0.0
+            strip[r, c] = synthetic_hot_pop
+    (lr, lc, lradius) = lake
+    rr = np.arange(row_off, row_off + Nrows)[:, None]
+    cc = np.arange(Ncols)[None, :]
+    strip[(rr - lr)**2 + (cc - lc)**2 < lradius**2] = nodata
+    return strip
+
+def make_synthetic_images(datadir, size, seed=1):
+    """
+    Write the synthetic GHS (Mollweide, 1km) and GPW (lat/lon, 30as) images
+    covering the lat/lon box of a size x size GPW image.  Returns the file
+    paths (GHS, GPW count, GPW density).
+    """
+    (ghs, gpwc, gpwd) = get_synthetic_filepaths(datadir)
+    (south, north, west, east) = get_synthetic_latlon_box(size)
+    (clat, clon, cdens, csigma) = get_synthetic_cities(size, seed)
+    #=== GPW: lat/lon grid
+    gpw_transform = Affine(GPW_pixel_deg, 0.0, west, 0.0, -GPW_pixel_deg,
+                           north)
+    km_per_deg = np.pi*earth_radius_km/180.0
+    rng = np.random.default_rng(seed + 1)
+    hot = (rng.integers(1, size - 1, synthetic_Nhot),
+           rng.integers(1, size - 1, synthetic_Nhot))
+    lake = (0.3*size, 0.7*size, 0.05*size)
+
+    def gpw_area(row_off, Nrows):
+        lat = north - (row_off + 0.5 + np.arange(Nrows))*GPW_pixel_deg
+        return (GPW_pixel_deg*km_per_deg)**2*np.cos(np.radians(lat))
+
+    def gpw_density(row_off, Nrows):
+        lon = west + (0.5 + np.arange(size))*GPW_pixel_deg
+        lat = north - (row_off + 0.5 + np.arange(Nrows))*GPW_pixel_deg
+        sigma_lat = csigma/km_per_deg
+        sigma_lon = sigma_lat/np.cos(np.radians(clat))
+        strip_rng = np.random.default_rng([seed, row_off])
+        dens = get_strip_density(lon, lat, (clon, clat), cdens,
+                                 (sigma_lon, sigma_lat), strip_rng)
+        pop = dens*gpw_area(row_off, Nrows)[:, None]
+        pop = add_hot_pixels_and_lake(pop, row_off, hot[0], hot[1], lake,
+                                      GPW_nodata)
+        return pop
+
+    write_synthetic_image(gpwc, size, size, gpw_transform, 'EPSG:4326',
+                          'float32', GPW_nodata, gpw_density)
+
+    def gpw_density_image(row_off, Nrows):
+        pop = gpw_density(row_off, Nrows)
+        return np.where(pop >= 0.0, pop/gpw_area(row_off, Nrows)[:, None],
+                        GPW_nodata)
+
+    write_synthetic_image(gpwd, size, size, gpw_transform, 'EPSG:4326',
+                          'float32', GPW_nodata, gpw_density_image)
+    #=== GHS: Mollweide grid, 1km pixels, over the envelope of the box
+    to_mollweide = pwpd.get_transformer('epsg:4326', pwpd.GHS_coordinates)
+    blat = np.concatenate([np.linspace(south, north, 50)]*2
+                          + [np.full(50, south), np.full(50, north)])
+    blon = np.concatenate([np.full(50, west), np.full(50, east)]
+                          + [np.linspace(west, east, 50)]*2)
+    (bx, by) = to_mollweide.transform(blat, blon)
+    (xmin, xmax) = (1000.0*np.floor(bx.min()/1000.0),
+                    1000.0*np.ceil(bx.max()/1000.0))
+    (ymin, ymax) = (1000.0*np.floor(by.min()/1000.0),
+                    1000.0*np.ceil(by.max()/1000.0))
+    (gheight, gwidth) = (int((ymax - ymin)/1000.0), int((xmax - xmin)/1000.0))
+    ghs_transform = Affine(1000.0, 0.0, xmin, 0.0, -1000.0, ymax)
+    (cx, cy) = to_mollweide.transform(clat, clon)
+    rng = np.random.default_rng(seed + 1)
+    hot = (rng.integers(1, gheight - 1, synthetic_Nhot),
+           rng.integers(1, gwidth - 1, synthetic_Nhot))
+    lake = (0.3*gheight, 0.7*gwidth, 0.05*min(gheight, gwidth))
+
+    def ghs_pop(row_off, Nrows):
+        x = xmin + 1000.0*(0.5 + np.arange(gwidth))
+        y = ymax - 1000.0*(row_off + 0.5 + np.arange(Nrows))
+        strip_rng = np.random.default_rng([seed, row_off])
+        # (1km pixels, so the population is the density)
+        pop = get_strip_density(x, y, (cx, cy), cdens,
+                                (1000.0*csigma, 1000.0*csigma), strip_rng)
+        return add_hot_pixels_and_lake(pop, row_off, hot[0], hot[1], lake,
+                                       GHS_nodata)
+
+    write_synthetic_image(ghs, gheight, gwidth, ghs_transform, 'ESRI:54009',
+                          'float64', GHS_nodata, ghs_pop)
+    return (ghs, gpwc, gpwd)
+
+def make_synthetic_regions(layer, Nregions, size, seed=1):
+    """
+    Voronoi-cell regions over the lat/lon box of a size x size synthetic
+    image, as a geodataframe with the columns of the loaded shapefiles of
+    layer = 'counties', 'healthregions' or 'countries'
+    """
+    import geopandas as gpd
+    import shapely
+    from shapely.geometry import box
+    rng = np.random.default_rng(seed)
+    (south, north, west, east) = get_synthetic_latlon_box(size)
+    # keep the regions a little inside the images
+    margin = 0.02*(north - south)
+    extent = box(west + margin, south + margin, east - margin, north - margin)
+    points = shapely.multipoints(np.column_stack(
+        [rng.uniform(west + margin, east - margin, Nregions),
+         rng.uniform(south + margin, north - margin, Nregions)]))
+    cells = shapely.get_parts(shapely.voronoi_polygons(points, extend_to=extent))
+    cells = shapely.intersection(cells, extent)
+    cells = cells[~shapely.is_empty(cells)]
+    # order west to east in bands of latitude, and group into "states"
+    centroids = shapely.centroid(cells)
+    (cx, cy) = (shapely.get_x(centroids), shapely.get_y(centroids))
+    Ngroups = max(1, int(np.round(np.sqrt(len(cells))/2)))
+    group = np.minimum((Ngroups*(cx - west)/(east - west)).astype(int),
+                       Ngroups - 1)
+    order = np.lexsort((cy, group))
+    (cells, group) = (cells[order], group[order])
+    df = gpd.GeoDataFrame(geometry=cells, crs='epsg:4326')
+    area_m2 = df.to_crs({'proj': 'cea'})['geometry'].area.to_numpy()
+    member = np.concatenate([np.arange(np.sum(group == g))
+                             for g in range(Ngroups)])
+    if (layer == 'counties'):
+        df.insert(0, 'fips_state', group + 1)
+        df.insert(1, 'fips_county', 2*member + 1)
+        df.insert(2, 'county', [f"County{i:d}" for i in range(len(df))])
+        df.insert(3, 'countylong', df['county'] + " County")
+        df.insert(4, 'landarea', area_m2)
+        df['state'] = [f"State{g + 1:d}" for g in group]
+        df['stateabb'] = [f"S{g + 1:d}" for g in group]
+        df = df.set_crs('epsg:4269', allow_override=True)
+    elif (layer == 'healthregions'):
+        df.insert(0, 'hr_uid', 100*(group + 10) + member + 1)
+        df.insert(1, 'region', [f"Region{i:d}" for i in range(len(df))])
+        df.insert(2, 'area', area_m2)
+        df['province'] = [f"Province{g + 1:d}" for g in group]
+        df['province_abb'] = [f"P{g + 1:d}" for g in group]
+    elif (layer == 'countries'):
+        df.insert(0, 'name', [f"Country{i:d}" for i in range(len(df))])
+        df.insert(1, 'threelett', [f"C{i:02d}" for i in range(len(df))])
+    else:
+        print("\n***Error: Synthetic region layer", layer, "not recognized.")
+        exit(0)
+    return df
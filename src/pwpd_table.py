@@ -0,0 +1,185 @@
+# Use the pwpd.yml conda environment
+#
+# Result tables (pop, PWPD, PWlogPD, popdens, gamma, population centroid,
+# ... of each region) as CSV or as Parquet, chosen by the extension of
+# the file (.csv or .parquet).
+#
+# The Parquet tables have the same columns as the CSV files, with their
+# types kept (FIPS codes stay integers, nothing is re-parsed from text),
+# plus the partition columns
+#
+#     dataset      'GHS' or 'GPW'
+#     epoch        '2015', '2020'
+#     resolution   '250m', '1km', '30as', ...
+#
+# so that the tables of several datasets and resolutions can be read and
+# joined as one.  A TableWriter adds the rows finished since its last
+# write as a new row group (the US counties are written one state per row
+# group).  Each write rewrites the whole file (as for the CSV files), to a
+# temporary file that then replaces it, so the file on disk is always a
+# complete table of the rows done, even if the run dies.  read_table()
+# passes its filters down to the row-group statistics, so that only the
+# row groups (and files) that can match are read, e.g., the GHS results,
+# at all resolutions, for California:
+#
+#     df = pwpd_table.read_table(["../output/pwpd_all-us-counties_GHS_2015_1km.parquet",
+#                                 "../output/pwpd_all-us-counties_GHS_2015_250m.parquet"],
+#                                filters=[('dataset', '==', 'GHS'),
+#                                         ('fips_state', '==', 6)])
+#
+import os
+import glob
+import pwpd
+
+#--- Minimum number of rows in a row group of a TableWriter (the rows are
+#    held back until there are this many, or until close())
+table_row_group_rows = 64
+#--- Compression of the Parquet files
+table_compression = 'zstd'
+#--- The partition columns added to the Parquet tables
+partition_columns = ['dataset', 'epoch', 'resolution']
+
+def is_parquet(filepath):
+    return filepath.endswith('.parquet') or filepath.endswith('.pq')
+
+def add_partition_columns(df):
+    """Copy of df with the dataset, epoch and resolution of the current
+    population image (see pwpd.set_popimage_pars)"""
+    return df.assign(dataset=pwpd.popimage_type, epoch=pwpd.popimage_epoch,
+                     resolution=pwpd.popimage_resolution)
+
+def get_arrow_table(df, schema=None):
+    import pyarrow as pa
+    return pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+
+def get_table_schema(df):
+    """Arrow schema of the rows of a results dataframe, with any column
+    with no values to type it (e.g., an object column of strings, as in
+    pandas < 3, with only None) taken as strings"""
+    import pyarrow as pa
+    schema = get_arrow_table(df).schema
+    for (i, field) in enumerate(schema):
+        if pa.types.is_null(field.type):
+            schema = schema.set(i, field.with_type(pa.string()))
+    return schema
+
+def write_table(df, filepath):
+    """Write a whole results dataframe to CSV or Parquet"""
+    if not is_parquet(filepath):
+        df.to_csv(filepath, index=False)
+        return filepath
+    import pyarrow.parquet as pq
+    pq.write_table(get_arrow_table(add_partition_columns(df)), filepath,
+                   compression=table_compression)
+    return filepath
+
+class TableWriter:
+    """
+    Writes a results dataframe that is filled in row by row: the file is
+    rewritten whole at each write (as the helper scripts always did for
+    CSV), a Parquet file with the rows done since the last write as new
+    row group(s), so the file is complete after every write.
+    """
+    def __init__(self, filepath, row_group_rows=None):
+        self.filepath = filepath
+        self.parquet = is_parquet(filepath)
+        self.row_group_rows = \
+            table_row_group_rows if row_group_rows is None else row_group_rows
+        self.schema = None
+        self.row_groups = []
+        self.df = None
+        self.Ndone = 0
+        self.Nwritten = 0
+
+    def write(self, df, Ndone=None):
+        """The first Ndone rows of df (all, if None) are done"""
+        self.df = df
+        self.Ndone = len(df) if Ndone is None else Ndone
+        if not self.parquet:
+            df.to_csv(self.filepath, index=False)
+        elif (self.Ndone - self.Nwritten >= self.row_group_rows):
+            self.flush()
+
+    def flush(self):
+        if (self.Ndone <= self.Nwritten):
+            return
+        import pyarrow.parquet as pq
+        self.row_groups.append((self.Nwritten, self.Ndone))
+        chunks = [add_partition_columns(self.df.iloc[i0:i1])
+                  for (i0, i1) in self.row_groups]
+        if self.schema is None:
+            # the schema of the whole table, from the first rows (an empty
+            # object column, e.g. of strings in pandas < 3, has no type)
+            self.schema = get_table_schema(chunks[0])
+        # (the file is replaced only once the new one is complete)
+        tmpfilepath = self.filepath + ".tmp"
+        with pq.ParquetWriter(tmpfilepath, self.schema,
+                              compression=table_compression) as writer:
+            for chunk in chunks:
+                writer.write_table(get_arrow_table(chunk, schema=self.schema))
+        os.replace(tmpfilepath, self.filepath)
+        self.Nwritten = self.Ndone
+
+    def close(self):
+        if self.parquet:
+            self.flush()
+
+def get_parquet_filepaths(source):
+    """The Parquet files of a file, a directory or a list of files"""
+    if isinstance(source, str):
+        if os.path.isdir(source):
+            return sorted(glob.glob(os.path.join(source, "*.parquet")))
+        return [source]
+    return list(source)
+
+def apply_filters(df, filters):
+    """Rows of df that pass the (column, op, value) filters (all of them)"""
+    import numpy as np
+    selected = np.ones(len(df), dtype=bool)
+    for (col, op, val) in filters:
+        if op in ['==', '=']:
+            selected &= (df[col] == val).to_numpy()
+        elif (op == '!='):
+            selected &= (df[col] != val).to_numpy()
+        elif (op == '<'):
+            selected &= (df[col] < val).to_numpy()
+        elif (op == '<='):
+            selected &= (df[col] <= val).to_numpy()
+        elif (op == '>'):
+            selected &= (df[col] > val).to_numpy()
+        elif (op == '>='):
+            selected &= (df[col] >= val).to_numpy()
+        elif (op == 'in'):
+            selected &= df[col].isin(val).to_numpy()
+        elif (op == 'not in'):
+            selected &= ~df[col].isin(val).to_numpy()
+        else:
+            print("\n***Error: unknown filter operation " + str(op))
+            exit(0)
+    return df[selected].reset_index(drop=True)
+
+def read_table(source, columns=None, filters=None):
+    """
+    Read a results table (CSV or Parquet), or several Parquet tables (a
+    list of files, or a directory) as one, keeping only the given columns
+    and the rows that pass the filters, a list of (column, op, value)
+    with op one of ==, !=, <, <=, >, >=, in, not in.  For Parquet, the
+    filters are applied to the row-group statistics before reading.
+    """
+    if ( isinstance(source, str) and not os.path.isdir(source)
+         and not is_parquet(source) ):
+        import pandas as pd
+        df = pd.read_csv(source)
+        if filters:
+            df = apply_filters(df, filters)
+        return df if columns is None else df[columns]
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+    filepaths = get_parquet_filepaths(source)
+    # the files may differ in columns (e.g., with and without the density
+    # quantiles)
+    schema = pa.unify_schemas([pq.read_schema(f) for f in filepaths])
+    dataset = ds.dataset(filepaths, schema=schema, format='parquet')
+    expression = pq.filters_to_expression(filters) if filters else None
+    return dataset.to_table(columns=columns, filter=expression).to_pandas()
@@ -0,0 +1,164 @@
+# Use the pwpd.yml conda environment
+#
+# Per-stage timing and I/O instrumentation.
+#
+# The pwpd methods mark their stages (shapefile lookup, transformation of
+# the shapes to the image coordinates, the masked read of the image, the
+# reduction, csv writes, ...) with
+#
+#     with pwpd_trace.stage('mask_read') as span:
+#         ...
+#         span.add(bytes=img.nbytes, window=img.shape)
+#
+# ('bytes' is the number of bytes read, 'array_bytes' the size of any
+# other large array made in the stage), and the helper scripts mark each
+# region with pwpd_trace.region(name).
+# Nothing is recorded unless tracing is switched on with
+# pwpd_trace.enable() (stage() then returns a shared no-op object, so the
+# cost of the marks is negligible).  When on, the wall and (thread) CPU
+# time of every stage and region is recorded, along with the bytes read,
+# the window sizes and the largest array of each region, and
+#
+#     pwpd_trace.print_summary()            table of totals per stage
+#     pwpd_trace.write_trace(filepath)      every span, as JSON lines
+#                                           (.jsonl) or in the Chrome trace
+#                                           format (.json, for
+#                                           chrome://tracing or Perfetto)
+#
+import os
+import json
+import time
+import threading
+
+trace_enabled = False
+trace_events = []
+trace_t0 = time.perf_counter()
+trace_lock = threading.Lock()
+# the region being worked on, per thread
+trace_current = threading.local()
+
+def enable():
+    """Switch tracing on (and clear anything recorded before)"""
+    global trace_enabled, trace_t0
+    trace_enabled = True
+    trace_t0 = time.perf_counter()
+    trace_events.clear()
+
+def disable():
+    global trace_enabled
+    trace_enabled = False
+
+class Span:
+    """A timed stage or region; extra information is added with add()"""
+    def __init__(self, name, category, args):
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def add(self, **args):
+        self.args.update(args)
+
+    def __enter__(self):
+        if (self.category == 'region'):
+            self.parent = getattr(trace_current, 'region', None)
+            trace_current.region = self
+            self.args.update({'bytes_read': 0, 'peak_array_bytes': 0})
+        self.region = getattr(trace_current, 'region', None)
+        self.t0 = time.perf_counter()
+        self.cpu0 = time.thread_time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        wall = time.perf_counter() - self.t0
+        cpu = time.thread_time() - self.cpu0
+        if (self.category == 'region'):
+            trace_current.region = self.parent
+        elif self.region is not None:
+            # pass the I/O ('bytes' read) and array sizes ('array_bytes')
+            # of the stage up to its region
+            nbytes = self.args.get('bytes', 0)
+            self.region.args['bytes_read'] += nbytes
+            self.region.args['peak_array_bytes'] = \
+                max(self.region.args['peak_array_bytes'], nbytes,
+                    self.args.get('array_bytes', 0))
+            self.args['region'] = self.region.name
+        event = {'name': self.name, 'cat': self.category,
+                 'ts': 1e6*(self.t0 - trace_t0), 'dur': 1e6*wall,
+                 'tid': threading.get_ident(),
+                 'args': dict(self.args, cpu_us=1e6*cpu)}
+        with trace_lock:
+            trace_events.append(event)
+        return False
+
+class NullSpan:
+    """Stand-in for Span when tracing is off"""
+    def add(self, **args):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+null_span = NullSpan()
+
+def stage(name, **args):
+    if not trace_enabled:
+        return null_span
+    return Span(name, 'stage', args)
+
+def region(name, **args):
+    if not trace_enabled:
+        return null_span
+    return Span(name, 'region', args)
+
+############################################################
+#                Summary table and trace files             #
+############################################################
+
+def get_stage_totals():
+    """{stage: (calls, wall s, cpu s, bytes)} over the recorded stages"""
+    totals = {}
+    for e in trace_events:
+        if (e['cat'] != 'stage'):
+            continue
+        (n, wall, cpu, nbytes) = totals.get(e['name'], (0, 0.0, 0.0, 0))
+        totals[e['name']] = (n + 1, wall + e['dur']/1e6,
+                             cpu + e['args']['cpu_us']/1e6,
+                             nbytes + e['args'].get('bytes', 0))
+    return totals
+
+def print_summary():
+    """Print the time, CPU and bytes read per stage since enable()"""
+    if not trace_enabled:
+        return
+    run_wall = time.perf_counter() - trace_t0
+    regions = [e for e in trace_events if (e['cat'] == 'region')]
+    totals = get_stage_totals()
+    print("=" * 80)
+    print(f"Timing summary: {len(regions):d} regions in {run_wall:.2f} s")
+    print(f"{'stage':>16s} {'calls':>7s} {'wall s':>9s} {'% run':>6s}"
+          + f" {'cpu s':>9s} {'mean ms':>9s} {'MB read':>9s}")
+    for name in sorted(totals, key=lambda k: totals[k][1], reverse=True):
+        (n, wall, cpu, nbytes) = totals[name]
+        print(f"{name:>16s} {n:7d} {wall:9.3f} {100*wall/run_wall:6.1f}"
+              + f" {cpu:9.3f} {1e3*wall/n:9.2f} {nbytes/1e6:9.1f}")
+    if regions:
+        peak = max(regions, key=lambda e: e['args']['peak_array_bytes'])
+        print(f"\nLargest array: {peak['args']['peak_array_bytes']/1e6:.1f} MB"
+              + f" (region {peak['name']})")
+    print("=" * 80)
+
+def write_trace(filepath):
+    """Write the recorded spans as JSON lines (.jsonl) or as a Chrome
+    trace (any other extension)"""
+    if filepath.endswith('.jsonl'):
+        with open(filepath, 'w') as f:
+            for e in trace_events:
+                f.write(json.dumps(e) + "\n")
+    else:
+        pid = os.getpid()
+        events = [dict(e, ph='X', pid=pid) for e in trace_events]
+        with open(filepath, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
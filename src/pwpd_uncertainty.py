@@ -0,0 +1,200 @@
+# Use the pwpd.yml conda environment
+#
+# Monte Carlo uncertainty of the population, PWPD, PWlogPD and gamma of
+# a region.
+#
+# The GHS-POP and GPW pixel counts are modeled estimates, not censuses,
+# so the PWPD of a region is uncertain too.  get_uncertainty() draws
+# perturbed realizations of the region's populated pixels, each pixel's
+# count multiplied by independent lognormal noise of mean one,
+#
+#     p' = p*e,    e = exp(sigma*z - sigma**2/2),    z ~ N(0,1)
+#
+# (the density of the pixel, count over land area, is multiplied by the
+# same e) and, optionally, with each of the region's candidate hot pixels
+# (the largest pixels with few populated neighbours, as in
+# pwpd_cleaning.py) removed at random.  The sums of each draw are then
+#
+#     sum p*e,    sum p*d*e**2,    sum p*e*(log(d) + log(e))
+#
+# which are three matrix-vector products of the (draws x pixels) noise
+# matrix, so all of the draws are computed together, in chunks of at most
+# uncertainty_chunk_bytes, in float32.  Since the noise multiplies both
+# the weight and the density of a pixel, the PWPD of the draws is larger
+# than that of the image, by about a factor exp(sigma**2) for regions of
+# many pixels, and their raw percentiles can exclude the point value.  So
+# the draws of each quantity are shifted by (point value - mean of the
+# draws), with the point value that of the unperturbed pixels (each
+# candidate hot pixel weighted by its probability of being kept), and the
+# means and the percentile intervals of the shifted draws are reported:
+#
+#     pwpd.set_popimage_pars('GHS', '2015', '1km')
+#     unc = pwpd_uncertainty.get_uncertainty(county_t, area=landarea)
+#     print(unc['pwpd_mean'], unc['pwpd_lo'], unc['pwpd_hi'])
+#
+# Set do_uncertainty = True in get_pwpd_all-us-counties.py to add these
+# columns to the counties table.
+#
+import numpy as np
+import pwpd
+import pwpd_trace
+
+#--- Number of draws
+uncertainty_Ndraws = 1000
+#--- Lognormal sigma of the multiplicative noise of each pixel count
+uncertainty_sigma = 0.2
+#--- Percentiles of the reported interval
+uncertainty_interval = (2.5, 97.5)
+#--- Random hot-pixel removal: of the uncertainty_hot_Ncheck largest
+#    pixels, those with more than uncertainty_hot_maxNzero (of 8) zero
+#    valued neighbours are each removed, in each draw, with probability
+#    uncertainty_hot_prob
+uncertainty_hot_removal = False
+uncertainty_hot_Ncheck = 50
+uncertainty_hot_maxNzero = 5
+uncertainty_hot_prob = 0.5
+#--- Size of the chunks of the noise matrix (bounds the memory)
+uncertainty_chunk_bytes = 2**26
+#--- Seed of the random draws (None: different each run); each region
+#    given a key (e.g., its FIPS code) gets its own stream from it
+uncertainty_seed = 0
+
+uncertainty_quantities = ['pop', 'pwpd', 'pwlogpd', 'gamma']
+
+def get_uncertainty_columns(do_gamma=True):
+    quantities = uncertainty_quantities if do_gamma \
+        else uncertainty_quantities[:-1]
+    return [f"{q:s}_{s:s}" for q in quantities for s in ['mean', 'lo', 'hi']]
+
+def get_hot_candidates(img, index):
+    """Which of the pixels (flat index into img) are candidate hot
+    pixels"""
+    populated = np.pad(img > 0, 1)
+    (rows, cols) = img.shape
+    Nnonzero = sum(populated[1+i:1+i+rows, 1+j:1+j+cols].astype(np.int8)
+                   for i in [-1, 0, 1] for j in [-1, 0, 1]
+                   if (i, j) != (0, 0))
+    hot = np.zeros(index.size, dtype=bool)
+    values = img.ravel()[index]
+    Ncheck = min(uncertainty_hot_Ncheck, index.size)
+    top = np.argpartition(values, index.size - Ncheck)[index.size - Ncheck:]
+    hot[top] = ((8 - Nnonzero.ravel()[index[top]])
+                > uncertainty_hot_maxNzero)
+    return hot
+
+def get_region_pixels(window_df):
+    """The populated pixels of the region(s) in window_df: (pop, density,
+    candidate hot pixels), with pop weighted by the pixel coverage if
+    pwpd.coverage_weighting, and without the region's hot pixels if a
+    hot-pixel layer is loaded (see pwpd_hotpixels.py)"""
+    if (pwpd.popimage_type == 'GHS'):
+        (popimg, img_transform) = pwpd.get_windowed_subimage(
+            window_df, pwpd.GHS_filepath,
+            all_touched=pwpd.coverage_weighting)
+        pdimg = None
+    else:
+        (popimg, img_transform) = pwpd.get_windowed_subimage(
+            window_df, pwpd.GPW_popcount_filepath,
+            all_touched=pwpd.coverage_weighting)
+        (pdimg, pdimg_transform) = pwpd.get_windowed_subimage(
+            window_df, pwpd.GPW_popdensity_filepath,
+            all_touched=pwpd.coverage_weighting)
+    coverage = pwpd.get_region_coverage(window_df, popimg, img_transform)
+    populated = (popimg > 0)
+    if ( (pwpd.hot_pixels is not None) & (pdimg is None) ):
+        # (the hot pixels are removed, as from the point values)
+        import pwpd_hotpixels
+        populated &= ~pwpd_hotpixels.get_hot_pixel_mask(popimg, img_transform)
+    index = np.flatnonzero(populated)
+    pop = popimg.ravel()[index].astype(np.float64)
+    if pdimg is None:
+        density = pop / pwpd.GHS_Acell_in_kmsqd
+    else:
+        density = pdimg.ravel()[index].astype(np.float64)
+    hot = get_hot_candidates(popimg, index) if uncertainty_hot_removal \
+        else np.zeros(index.size, dtype=bool)
+    if coverage is not None:
+        pop = pop * coverage.ravel()[index]
+    return (pop, density, hot)
+
+def get_draw_sums(pop, density, hot, Ndraws, rng):
+    """(sum p, sum p*d, sum p*log(d)) of each of Ndraws perturbed
+    realizations of the pixels"""
+    sigma = uncertainty_sigma
+    p = pop.astype(np.float32)
+    pd_ = (pop*density).astype(np.float32)
+    plogd = (pop*np.log(density)).astype(np.float32)
+    hot_index = np.flatnonzero(hot)
+    sums = np.empty((3, Ndraws))
+    # (two float32 matrices of the chunk are held at a time)
+    Nchunk = max(1, uncertainty_chunk_bytes // (8*max(p.size, 1)))
+    for d0 in range(0, Ndraws, Nchunk):
+        n = min(Nchunk, Ndraws - d0)
+        logE = rng.standard_normal((n, p.size), dtype=np.float32)
+        logE *= sigma
+        logE -= sigma**2/2
+        E = np.exp(logE)
+        if (hot_index.size > 0):
+            E[:, hot_index] *= (rng.random((n, hot_index.size))
+                                >= uncertainty_hot_prob)
+        sums[0, d0:d0+n] = E @ p
+        # sum p*e*(log(d) + log(e))
+        logE *= E
+        sums[2, d0:d0+n] = E @ plogd + logE @ p
+        # sum p*d*e**2
+        E *= E
+        sums[1, d0:d0+n] = E @ pd_
+    return sums
+
+def get_point_sums(pop, density, hot):
+    """(sum p, sum p*d, sum p*log(d)) of the unperturbed pixels, with each
+    candidate hot pixel weighted by its probability of being kept"""
+    if uncertainty_hot_removal:
+        pop = pop * np.where(hot, 1.0 - uncertainty_hot_prob, 1.0)
+    return np.array([np.sum(pop), np.dot(pop, density),
+                     np.dot(pop, np.log(density))])
+
+def get_quantities(S1, S2, SL, area=None):
+    """pop, PWPD, PWlogPD and, if the area is given, gamma of the sums"""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        quantities = {'pop': S1, 'pwpd': S2/S1, 'pwlogpd': SL/S1}
+        if area is not None:
+            quantities['gamma'] = pwpd.get_gamma(S1, area, quantities['pwpd'],
+                                                 pwpd.popimage_type,
+                                                 pwpd.popimage_resolution)
+    return quantities
+
+def get_rng(key=None):
+    """Random generator of a region, with its own stream if it has a key"""
+    if ( (uncertainty_seed is None) | (key is None) ):
+        return np.random.default_rng(uncertainty_seed)
+    return np.random.default_rng([uncertainty_seed, int(key)])
+
+def get_uncertainty(window_df, area=None, Ndraws=None, key=None):
+    """
+    Means and percentile intervals (uncertainty_interval) of the pop,
+    PWPD, PWlogPD and, if the region's area (km^2) is given, gamma of
+    the region(s) in window_df over Ndraws (uncertainty_Ndraws, if None)
+    perturbed realizations of the population image, shifted to the point
+    values (see above), as a dict with the keys <quantity>_mean,
+    <quantity>_lo and <quantity>_hi.  The draws are seeded with the key
+    (a non-negative integer, e.g., the region's FIPS code), if given, so
+    that the regions' errors are independent.
+    """
+    if Ndraws is None:
+        Ndraws = uncertainty_Ndraws
+    (pop, density, hot) = get_region_pixels(window_df)
+    rng = get_rng(key)
+    with pwpd_trace.stage('uncertainty', pixels=pop.size, draws=Ndraws):
+        (S1, S2, SL) = get_draw_sums(pop, density, hot, Ndraws, rng)
+        draws = get_quantities(S1, S2, SL, area)
+        points = get_quantities(*get_point_sums(pop, density, hot), area)
+        results = {}
+        for (q, x) in draws.items():
+            with np.errstate(invalid='ignore'):
+                x = x + (points[q] - np.mean(x))
+            (lo, hi) = np.percentile(x, uncertainty_interval)
+            results[q + '_mean'] = np.mean(x)
+            results[q + '_lo'] = lo
+            results[q + '_hi'] = hi
+    return results
@@ -0,0 +1,58 @@
+# Use the pwpd.yml conda environment
+#
+# Start a local PWPD query server (see pwpd_server.py for the requests
+# it accepts).  Example, once started:
+#
+#     curl "http://127.0.0.1:8765/pwpd?layer=us-counties&key=NY,Saratoga"
+#     curl "http://127.0.0.1:8765/metrics"
+#
+import sys
+import pwpd
+import pwpd_server
+
+#===========================================
+#=== Parameters for the population image ===
+#===========================================
+#
+#--- possible types are 'GHS' and 'GPW'
+popimage_type = 'GHS'
+#popimage_type = 'GPW'
+#--- possible epochs are 2015 (GHS or GPW) and 2020 (GPW only)
+popimage_epoch = '2015'
+#--- possible resolutions (~ pixel length scale) are:
+#      GHS: '250m', '1km'
+#      GPW: '30as' (~1km), 2.5am', '15am', '30am', '1deg'
+popimage_resolution = '1km'
+
+#=========================
+#=== Server parameters ===
+#=========================
+#
+host = "127.0.0.1"
+port = 8765
+#--- Number of worker threads serving requests
+Nworkers = 8
+#--- Shapefile layers to keep resident: 'countries', 'us-counties', 'canada-hr'
+layers = ['countries', 'us-counties']
+#--- Canadian health-region shapefile ("statscanada" or "covid19")
+hr_type = "covid19"
+
+#--- Port can also be given on the command line
+if (len(sys.argv) == 2):
+    port = int(sys.argv[1])
+elif (len(sys.argv) > 2):
+    print("***Error: Unrecognized commandline option")
+    exit(0)
+
+#=================
+#=== Main code ===
+#=================
+#
+#=== Set the population image parameters
+pwpd.set_popimage_pars(popimage_type, popimage_epoch, popimage_resolution)
+
+#=== Load and transform the shapefile layers once
+pwpd_server.load_layers(layers, hr_type=hr_type)
+
+#=== Serve requests until interrupted
+pwpd_server.serve(host, port, Nworkers)